@@ -0,0 +1,8 @@
+import uvicorn
+
+from weather_api.asgi import create_asgi_app
+
+app = create_asgi_app()
+
+if __name__ == '__main__':
+    uvicorn.run(app)
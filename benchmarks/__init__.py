@@ -0,0 +1 @@
+"""Offline benchmarks for the weather API wrapper."""
@@ -0,0 +1,72 @@
+"""
+Compare cache encodings on a realistic 15 day hourly forecast.
+
+Run from the repository root:
+
+    python -m benchmarks.codec_benchmark
+"""
+import timeit
+
+import msgpack
+import zstandard
+from cachelib.serializers import RedisSerializer
+
+from weather_api.codec import (COMPRESSIONS, FORMAT_VERSION, PAYLOAD_EXT, SERIALIZERS,
+                               CacheCodec)
+from weather_api.payload import CachedPayload
+
+from .fixtures import forecast_document
+
+CODECS = {
+    "pickle (before)": RedisSerializer(),
+    "msgpack+zstd": CacheCodec("msgpack", "zstd"),
+    "msgpack+zlib": CacheCodec("msgpack", "zlib"),
+    "pickle+zstd": CacheCodec("pickle", "zstd"),
+}
+
+
+def measure(codec, value, number: int = 200) -> tuple[int, float, float]:
+    """:returns: encoded size, encode and decode time in microseconds"""
+    encoded = codec.dumps(value)
+    encode = timeit.timeit(lambda: codec.dumps(value), number=number) / number
+    decode = timeit.timeit(lambda: codec.loads(encoded), number=number) / number
+    return len(encoded), encode * 1e6, decode * 1e6
+
+
+def legacy_payload(payload: CachedPayload) -> bytes:
+    """A payload as encoded before only its smallest body was stored."""
+    fields = (None, payload.etag, payload.gzip_body, payload.created_at, payload.br_body)
+    value = msgpack.packb(msgpack.ExtType(PAYLOAD_EXT, msgpack.packb(fields)))
+    return bytes((FORMAT_VERSION, COMPRESSIONS["zstd"] << 4 | SERIALIZERS["msgpack"])) + \
+        zstandard.ZstdCompressor(level=3).compress(value)
+
+
+def serve(codec, encoded: bytes, accept_encoding: str) -> bytes:
+    """Read a cached payload and pick the body of a response."""
+    return codec.loads(encoded).representation(accept_encoding)[0]
+
+
+def main():
+    """Print one row per value kind and codec."""
+    document = forecast_document()
+    payload = CachedPayload.from_data(document)
+    values = {"dict": document, "payload": payload}
+    print(f"{'value':<8} {'codec':<16} {'bytes':>8} {'encode us':>10} {'decode us':>10}")
+    for kind, value in values.items():
+        for name, codec in CODECS.items():
+            size, encode, decode = measure(codec, value)
+            print(f"{kind:<8} {name:<16} {size:>8} {encode:>10.1f} {decode:>10.1f}")
+
+    # cache hit served to a client, stored bodies before and now
+    codec = CacheCodec()
+    stored = {"all bodies": legacy_payload(payload), "one body": codec.dumps(payload)}
+    print(f"\n{'stored':<12} {'bytes':>8} {'br hit us':>10} {'gzip hit us':>12} "
+          f"{'identity us':>12}")
+    for name, encoded in stored.items():
+        hits = [timeit.timeit(lambda value=encoded, coding=coding: serve(codec, value, coding),
+                              number=200) / 200 * 1e6 for coding in ("br", "gzip", "")]
+        print(f"{name:<12} {len(encoded):>8} {hits[0]:>10.1f} {hits[1]:>12.1f} {hits[2]:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Compare two load benchmark results and fail on regressions.
+
+    python -m benchmarks.compare baseline.json candidate.json
+
+Exits with status 1 when a scenario makes more upstream calls, errors
+more, or got slower than the tolerance allows. Latencies below the
+noise floor are never reported, a 0.2ms hot path going to 0.3ms is
+timer noise on shared CI runners, not a regression.
+"""
+import argparse
+import json
+import sys
+
+# Latencies gated on, lower is better. p99 of a few hundred requests is a
+# single outlier, it is reported but not compared.
+LATENCIES = ("p50_ms", "p95_ms")
+
+
+def compare(baseline: dict, candidate: dict, tolerance: float = 0.25,
+            floor_ms: float = 1.0) -> list[str]:
+    """
+    :param tolerance: relative slowdown allowed, 0.25 is 25%
+    :param floor_ms: latency differences smaller than this are ignored
+    :returns: one message per regression, empty when there is none
+    """
+    regressions = []
+    for name, before in baseline["scenarios"].items():
+        after = candidate["scenarios"].get(name)
+        if after is None:
+            continue
+        for field in ("upstream_calls", "errors"):
+            if after[field] > before[field]:
+                regressions.append(f"{name}: {field} {before[field]} -> {after[field]}")
+        for field in LATENCIES:
+            if (after[field] > before[field] * (1 + tolerance)
+                    and after[field] - before[field] > floor_ms):
+                regressions.append(
+                    f"{name}: {field} {before[field]:.3f} -> {after[field]:.3f}")
+        if after["throughput_rps"] < before["throughput_rps"] / (1 + tolerance):
+            regressions.append(f"{name}: throughput_rps {before['throughput_rps']} "
+                               f"-> {after['throughput_rps']}")
+    return regressions
+
+
+def main():
+    """Print the regressions of the candidate, exit 1 if there are any."""
+    parser = argparse.ArgumentParser(description="Compare two load benchmark results.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--floor-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    with open(args.baseline, encoding="utf-8") as baseline, \
+            open(args.candidate, encoding="utf-8") as candidate:
+        regressions = compare(json.load(baseline), json.load(candidate),
+                              args.tolerance, args.floor_ms)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print("No regression")
+
+
+if __name__ == "__main__":
+    main()
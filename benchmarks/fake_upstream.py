@@ -0,0 +1,95 @@
+"""
+Local stand-in for the Visual Crossing timeline API.
+
+Serves synthetic documents from `fixtures` over real HTTP, so benchmarks
+go through the pooled upstream client, with a fixed latency per call.
+"""
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlsplit
+
+from .fixtures import forecast_document
+
+
+class FakeUpstream:
+    """
+    Threaded HTTP server answering timeline requests, counting them.
+    Use as a context manager, `base_url` replaces services.BASE_URL.
+    """
+
+    def __init__(self, latency: float = 0.05, days: int = 15, hours: bool = True):
+        """
+        :param latency: seconds every call is delayed by
+        :param days: days of a forecast document, sets the payload size
+        :param hours: include hourly periods in the documents
+        """
+        self.latency = latency
+        self.days = days
+        self.hours = hours
+        self.calls: Counter = Counter()
+        self._bodies: dict = {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def base_url(self) -> str:
+        """Timeline URL of the running server."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/timeline/"
+
+    @property
+    def total_calls(self) -> int:
+        """Calls answered since the last reset."""
+        with self._lock:
+            return sum(self.calls.values())
+
+    def reset(self) -> None:
+        """Forget the counted calls."""
+        with self._lock:
+            self.calls.clear()
+
+    def body(self, path: str) -> bytes:
+        """Encoded document for a timeline path, built once per path."""
+        parts = [part for part in path.split("/") if part]
+        city = parts[1] if len(parts) > 1 else "London"
+        days = 1 if parts[-1] == "today" else self.days
+        with self._lock:
+            self.calls[path] += 1
+            if path not in self._bodies:
+                document = forecast_document(city, days=days, hours=self.hours)
+                self._bodies[path] = json.dumps(document).encode()
+            return self._bodies[path]
+
+    def __enter__(self) -> "FakeUpstream":
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Answer every GET with a timeline document."""
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Timeline document of the requested city, after the latency."""
+                time.sleep(upstream.latency)
+                body = upstream.body(urlsplit(self.path).path)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Keep benchmark output clean."""
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-upstream",
+                         daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,85 @@
+"""
+Synthetic Visual Crossing timeline documents, shaped like real responses.
+"""
+import random
+from datetime import date, timedelta
+
+CONDITIONS = [
+    ("Clear", "clear-day", "Clear conditions throughout the day."),
+    ("Partially cloudy", "partly-cloudy-day", "Partly cloudy throughout the day."),
+    ("Rain, Overcast", "rain", "Cloudy skies throughout the day with rain."),
+    ("Overcast", "cloudy", "Cloudy skies throughout the day."),
+]
+STATIONS = ["EGLL", "EGLC", "D5621", "EGWU", "EGKB"]
+
+
+def _period(rng: random.Random, base_temp: float) -> dict:
+    """Weather elements shared by days, hours and current conditions."""
+    conditions, icon, _ = rng.choice(CONDITIONS)
+    temp = round(base_temp + rng.uniform(-4, 4), 1)
+    return {
+        "temp": temp,
+        "feelslike": round(temp - rng.uniform(0, 3), 1),
+        "humidity": round(rng.uniform(40, 100), 2),
+        "dew": round(temp - rng.uniform(1, 8), 1),
+        "precip": round(rng.choice([0.0, 0.0, rng.uniform(0, 5)]), 3),
+        "precipprob": round(rng.uniform(0, 100), 1),
+        "snow": 0.0,
+        "snowdepth": 0.0,
+        "preciptype": rng.choice([None, ["rain"]]),
+        "windgust": round(rng.uniform(5, 60), 1),
+        "windspeed": round(rng.uniform(0, 40), 1),
+        "winddir": round(rng.uniform(0, 360), 1),
+        "pressure": round(rng.uniform(990, 1030), 1),
+        "visibility": round(rng.uniform(5, 30), 1),
+        "cloudcover": round(rng.uniform(0, 100), 1),
+        "solarradiation": round(rng.uniform(0, 800), 1),
+        "solarenergy": round(rng.uniform(0, 3), 1),
+        "uvindex": float(rng.randint(0, 8)),
+        "severerisk": float(rng.randint(0, 30)),
+        "conditions": conditions,
+        "icon": icon,
+        "stations": rng.sample(STATIONS, 3),
+        "source": "fcst",
+    }
+
+
+def forecast_document(city: str = "London", days: int = 15, hours: bool = True,
+                      seed: int = 0) -> dict:
+    """
+    A timeline document for `days` days, with hourly rows by default.
+    :param seed: same seed, same document
+    """
+    rng = random.Random(seed)
+    start = date(2025, 1, 1)
+    day_rows = []
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        base = 8 + rng.uniform(-5, 5)
+        row = {"datetime": day.isoformat(),
+               "datetimeEpoch": 1735689600 + offset * 86400,
+               "tempmax": round(base + 4, 1), "tempmin": round(base - 4, 1),
+               **_period(rng, base),
+               "sunrise": "07:58:00", "sunset": "16:01:00", "moonphase": 0.03,
+               "description": rng.choice(CONDITIONS)[2]}
+        if hours:
+            row["hours"] = [
+                {"datetime": f"{hour:02d}:00:00",
+                 "datetimeEpoch": row["datetimeEpoch"] + hour * 3600,
+                 **_period(rng, base)}
+                for hour in range(24)
+            ]
+        day_rows.append(row)
+    return {
+        "queryCost": days,
+        "latitude": 51.5064,
+        "longitude": -0.12721,
+        "resolvedAddress": f"{city}, England, United Kingdom",
+        "address": city,
+        "timezone": "Europe/London",
+        "tzoffset": 0.0,
+        "description": "Similar temperatures continuing with a chance of rain.",
+        "days": day_rows,
+        "alerts": [],
+        "currentConditions": {"datetime": "12:00:00", **_period(rng, 8)},
+    }
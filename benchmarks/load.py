@@ -0,0 +1,286 @@
+"""
+Load scenarios of the Flask app against a fake upstream and Redis.
+
+Requests go through routes.py, services.py and the tiered cache exactly
+as in production, only the Visual Crossing API is replaced by a local
+server (see fake_upstream) and Redis by fakeredis, unless --redis-url
+points at a real server. Nothing leaves the machine.
+
+Run from the repository root:
+
+    python -m benchmarks.load --output results.json
+
+and compare two runs, e.g. a branch against main:
+
+    python -m benchmarks.compare main.json results.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Iterator
+from unittest.mock import patch
+
+import fakeredis
+from redis import Redis
+
+from .fake_upstream import FakeUpstream
+from .fixtures import forecast_document
+
+# Clients are swapped for the benchmark one, this only lets extensions import
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
+# Per request info logs would be most of the work measured
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+# Results format, bumped when fields change meaning
+FORMAT_VERSION = 1
+PROJECTED_ELEMENTS = "datetime,tempmax,tempmin,humidity,conditions"
+
+Job = Callable[[object], object]
+
+
+@contextmanager
+def bench_app(upstream: FakeUpstream, redis_client) -> Iterator:
+    """
+    The app wired to the fake upstream, every Redis user on `redis_client`.
+    The upstream budget is lifted so it never throttles a scenario.
+    """
+    # pylint: disable=import-outside-toplevel
+    from weather_api import create_app
+    from weather_api.extensions import (api_keys, cache, refresher,
+                                        single_flight, upstream_breaker,
+                                        upstream_budget)
+
+    with ExitStack() as stack:
+        stack.enter_context(patch("weather_api.services.BASE_URL", upstream.base_url))
+        stack.enter_context(patch.multiple(
+            upstream_budget, redis=redis_client, daily_records=10 ** 9,
+            burst=10 ** 9, rate=10 ** 9))
+        for extension in (single_flight, refresher, api_keys, upstream_breaker):
+            stack.enter_context(patch.object(extension, "redis", redis_client))
+        # no pre-warm pass in the middle of a measurement
+        stack.enter_context(patch.object(refresher, "interval", 3600))
+        app = create_app({"HISTORY_DIR": stack.enter_context(tempfile.TemporaryDirectory())})
+        app.config["API_AUTH_ENABLED"] = False
+        with app.app_context():
+            backend = cache.cache
+        stack.enter_context(patch.multiple(
+            backend, _read_client=redis_client, _write_client=redis_client))
+        yield app
+
+
+def percentile(samples: list[float], rank: float) -> float:
+    """Nearest rank percentile of sorted samples."""
+    if not samples:
+        return 0.0
+    index = max(0, min(len(samples) - 1, round(rank / 100 * len(samples)) - 1))
+    return samples[index]
+
+
+def run_jobs(app, jobs: list[Job], concurrency: int) -> dict:
+    """
+    Run jobs on `concurrency` threads, each with its own test client.
+    :returns: latencies in seconds, errors and wall time
+    """
+    local = threading.local()
+    latencies: list[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def timed(job: Job) -> None:
+        nonlocal errors
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        started = time.perf_counter()
+        response = job(local.client)
+        # batch responses are streamed, the body is part of the request
+        response.get_data()
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            errors += response.status_code >= 400
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, jobs))
+    return {"latencies": latencies, "errors": errors,
+            "wall": time.perf_counter() - started}
+
+
+def get(path: str) -> Job:
+    """Job requesting `path`."""
+    return lambda client: client.get(path)
+
+
+def cold(app, requests: int, concurrency: int) -> dict:
+    """Every request is for a city nobody asked for yet."""
+    return run_jobs(app, [get(f"/api/weather/Cold{i}") for i in range(requests)],
+                    concurrency)
+
+
+def hot(app, requests: int, concurrency: int) -> dict:
+    """The same cached city over and over, answered from the local tier."""
+    app.test_client().get("/api/weather/London")
+    return run_jobs(app, [get("/api/weather/London")] * requests, concurrency)
+
+
+def stampede(app, requests: int, concurrency: int) -> dict:
+    """
+    A popular key expires under load: `concurrency` clients miss it at
+    once, single flight should make a single upstream call per round.
+    """
+    # pylint: disable=import-outside-toplevel
+    from weather_api.extensions import cache
+
+    rounds = max(1, requests // concurrency)
+    result = {"latencies": [], "errors": 0, "wall": 0.0}
+    for _ in range(rounds):
+        with app.app_context():
+            cache.delete("forecast_London")
+        barrier = threading.Barrier(concurrency)
+
+        def job(client, barrier=barrier):
+            barrier.wait()
+            return client.get("/api/forecast/London")
+
+        round_result = run_jobs(app, [job] * concurrency, concurrency)
+        result["latencies"] += round_result["latencies"]
+        result["errors"] += round_result["errors"]
+        result["wall"] += round_result["wall"]
+    return result
+
+
+def batch(app, requests: int, concurrency: int, size: int = 20) -> dict:
+    """
+    Batches of `size` cities, half of them already cached, one batch per
+    10 requests. Cached cities are written directly, not fetched.
+    """
+    # pylint: disable=import-outside-toplevel
+    from weather_api.extensions import cache
+    from weather_api.payload import CachedPayload
+
+    jobs = []
+    with app.app_context():
+        for i in range(max(1, requests // 10)):
+            cities = [f"Batch{i}x{j}" for j in range(size)]
+            for city in cities[::2]:
+                cache.set(f"weather_{city}", CachedPayload.from_data(
+                    forecast_document(city, days=1)), timeout=3600)
+            jobs.append(lambda client, cities=cities: client.post(
+                "/api/weather/batch", json={"cities": cities}))
+    return run_jobs(app, jobs, concurrency)
+
+
+def projection(app, requests: int, concurrency: int) -> dict:
+    """Elements projected out of one cached full forecast."""
+    app.test_client().get("/api/forecast/London")
+    path = f"/api/forecast-elements/London?elements={PROJECTED_ELEMENTS}"
+    return run_jobs(app, [get(path)] * requests, concurrency)
+
+
+SCENARIOS = {
+    "cold": cold,
+    "hot": hot,
+    "stampede": stampede,
+    "batch": batch,
+    "projection": projection,
+}
+
+
+def summarize(result: dict, upstream_calls: int, concurrency: int) -> dict:
+    """Comparable figures of a scenario run, times in milliseconds."""
+    latencies = sorted(result["latencies"])
+    return {
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "errors": result["errors"],
+        "upstream_calls": upstream_calls,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "throughput_rps": round(len(latencies) / result["wall"], 1) if result["wall"] else 0.0,
+    }
+
+
+def git_revision() -> str:
+    """Commit being measured, empty outside a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def run(names: list[str], requests: int, concurrency: int, latency: float,
+        days: int, redis_url: str = "") -> dict:
+    """Run scenarios on a clean cache each, :returns: the results document"""
+    redis_client = Redis.from_url(redis_url) if redis_url else fakeredis.FakeRedis()
+    scenarios = {}
+    with FakeUpstream(latency=latency, days=days) as upstream, \
+            bench_app(upstream, redis_client) as app:
+        for name in names:
+            redis_client.flushdb()
+            with app.app_context():
+                # pylint: disable=import-outside-toplevel
+                from weather_api.extensions import cache
+                cache.cache.local.clear()
+            upstream.reset()
+            result = SCENARIOS[name](app, requests, concurrency)
+            scenarios[name] = summarize(result, upstream.total_calls, concurrency)
+    return {
+        "format": FORMAT_VERSION,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "settings": {"requests": requests, "concurrency": concurrency,
+                     "upstream_latency": latency, "days": days,
+                     "redis": "real" if redis_url else "fakeredis"},
+        "scenarios": scenarios,
+    }
+
+
+def print_table(results: dict) -> None:
+    """One row per scenario."""
+    print(f"{'scenario':<11} {'reqs':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'req/s':>9} {'upstream':>9} {'errors':>7}")
+    for name, row in results["scenarios"].items():
+        print(f"{name:<11} {row['requests']:>6} {row['p50_ms']:>9.3f} "
+              f"{row['p95_ms']:>9.3f} {row['p99_ms']:>9.3f} {row['throughput_rps']:>9.1f} "
+              f"{row['upstream_calls']:>9} {row['errors']:>7}")
+
+
+def main():
+    """Parse arguments, run the scenarios and save the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS),
+                        help=f"scenarios to run, all by default: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds the fake upstream takes per call")
+    parser.add_argument("--days", type=int, default=15,
+                        help="days per forecast document, sets the payload size")
+    parser.add_argument("--redis-url", default="",
+                        help="use a real Redis instead of fakeredis, it is flushed")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = run(args.scenarios, args.requests, args.concurrency,
+                  args.latency, args.days, args.redis_url)
+    print_table(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,62 @@
 """
 Module for 3rd party weather API and Redis Cache
 """
-from dotenv import load_dotenv
+import os
+import time
+from typing import Any, Mapping, Optional
+
 from flask import Flask
 from .routes import weather_bp
-from .services import error_logger
-from .extensions import cache
-
-load_dotenv()
+from .services import (error_logger, load_forecast, prewarm_popular,
+                       refresh_popular)
+from .extensions import (CACHE_CONFIG, CACHE_KEY_PREFIX, api_keys, cache, history,
+                         redis, refresh_queue, refresher, stream_hub)
+from .logs import configure_logging
+from . import metrics, readiness, snapshot
 
 
-def create_app():
+def create_app(config: Optional[Mapping[str, Any]] = None):
     """
     Create flask app.
+    No connection is opened here, clients connect on first use or when
+    /ready is probed, and the time it takes is checked against STARTUP_BUDGET.
+    :param config: settings overriding the defaults, CACHE_* ones included.
+        WARM_ON_START opens the connections before returning.
     """
+    started = time.perf_counter()
     app = Flask(__name__)
+    app.config.from_mapping(CACHE_CONFIG)
+    app.config["WARM_ON_START"] = os.getenv("WARM_ON_START", "false").lower() == "true"
+    app.config.from_mapping(config or {})
     app.logger = error_logger
+    # JSON logs written off the request threads
+    configure_logging(loggers=("weather_api", error_logger.name))
+    # Latency histograms and counters, served on /metrics
+    metrics.init_app(app)
+    # Readiness probe on /ready, warming the connections
+    readiness.init_app(app)
     # Initialize the cache extension
     cache.init_app(app)
+    # Background refresh of stale and popular cache entries
+    refresher.init_app(app, prewarm=prewarm_popular)
+    # Workers running the queued refreshes, most popular first
+    refresh_queue.init_app(app, run=refresh_popular)
+    # Hours of the fetched documents kept on local disk
+    history.init_app(app)
+    # Forecast changes written by any worker pushed to stream subscribers
+    stream_hub.init_app(app, load=load_forecast)
+    with app.app_context():
+        cache.cache.on_change(stream_hub.notify)
+    # API keys and rate limits on the api routes
+    api_keys.init_app(app, blueprints=(weather_bp.name,))
+    # flask cache-snapshot export/import, to warm up a new Redis
+    with app.app_context():
+        snapshot.init_app(app, redis, f"{CACHE_KEY_PREFIX}*",
+                          invalidate=cache.cache.invalidate_local)
     # app blueprints
     app.register_blueprint(weather_bp, url_prefix='/api')
+    readiness.record_startup(app, started)
+    if app.config["WARM_ON_START"]:
+        with app.app_context():
+            readiness.warm()
     return app
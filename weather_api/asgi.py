@@ -0,0 +1,426 @@
+"""
+ASGI application serving the weather routes with the asyncio services.
+
+Upstream misses are awaited instead of blocking a worker, so a single
+process can hold hundreds of concurrent upstream waits. Requests are
+routed with the URL map of the Flask app: the cached weather routes are
+served by coroutines sharing the conditional request logic of the Flask
+views, and forecast streams wait for events without a thread each. Every
+other route is answered by the Flask app itself on a worker thread, so
+both apps serve the same routes.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import queue
+import time
+from typing import Awaitable, Callable, Optional
+from urllib.parse import parse_qsl
+
+import httpx
+from redis.exceptions import RedisError
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from . import create_app, metrics
+from .async_services import (get_forecast_async, get_forecast_elements_async,
+                             get_fresh_validator_async,
+                             get_normalized_forecast_async,
+                             get_normalized_weather_async, get_weather_async)
+from .auth import API_KEY_HEADER
+from .breaker import CircuitOpenError
+from .extensions import async_api_keys, async_http_client, async_redis, stream_hub
+from .normalize import UnknownUnitsError
+from .quota import QuotaExceededError
+from .payload import CachedPayload, cache_control, matching_etag
+from .services import (STALE_IF_ERROR, UpstreamQuery, Validators,
+                       elements_validators, forecast_validators,
+                       normalized_forecast_validators,
+                       forecast_query, normalized_weather_validators,
+                       record_not_modified, weather_validators)
+from .routes import (STREAM_ARGUMENTS_ERROR, STREAM_HEADERS, STREAM_KEEPALIVE,
+                     stream_arguments)
+from .stream import Event, SubscribersExceededError, Subscription, error_event
+
+logger = logging.getLogger(__name__)
+
+View = Callable[[str, MultiDict], Awaitable[CachedPayload]]
+# Flask endpoints served by coroutines: the view, called with the city and
+# the query arguments, and the validators of the Flask view
+ASYNC_VIEWS: dict[str, tuple[View, Callable[[str, MultiDict], Validators]]] = {
+    "weather.city_weather": (
+        lambda city, args: get_weather_async(city), weather_validators),
+    "weather.city_forecast": (
+        lambda city, args: get_forecast_async(city), forecast_validators),
+    "weather.forecast_elements": (
+        lambda city, args: get_forecast_elements_async(city, args.getlist("elements")),
+        elements_validators),
+    "weather.normalized_weather": (
+        lambda city, args: get_normalized_weather_async(city, args.get("units", "metric")),
+        normalized_weather_validators),
+    "weather.normalized_forecast": (
+        lambda city, args: get_normalized_forecast_async(city, args.get("units", "metric")),
+        normalized_forecast_validators),
+}
+# Flask endpoint of the forecast streams
+STREAM_ENDPOINT = "weather.forecast_stream"
+
+
+async def send_response(send, status: int, body: bytes,
+                        headers: Optional[dict] = None) -> None:
+    """Send a complete http response."""
+    headers = {"Content-Type": "application/json",
+               "Content-Length": str(len(body)), **(headers or {})}
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode(), value.encode())
+                    for name, value in headers.items()],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_error(send, status: int, message: str,
+                     headers: Optional[dict] = None) -> None:
+    """Send an error in the same format as the Flask routes."""
+    body = json.dumps({"status": "error", "message": message}).encode()
+    await send_response(send, status, body, headers)
+
+
+async def authorize(request_headers: dict, send) -> Optional[dict]:
+    """
+    Authenticate and count a request like the Flask app does.
+    :returns: rate limit headers, None if the request was answered with an error
+    """
+    api_key = request_headers.get(API_KEY_HEADER.lower().encode(), b"").decode()
+    try:
+        client = await async_api_keys.authenticate(api_key or None)
+    except RedisError as redis_error:
+        logger.error("API key lookup failed: %s", redis_error)
+        await send_error(send, 503, "Authentication unavailable")
+        return None
+    if client is None:
+        await send_error(send, 401, f"Missing or invalid {API_KEY_HEADER} header")
+        return None
+    rate_limit = await async_api_keys.hit(client)
+    if rate_limit is None:
+        return {}
+    if not rate_limit.allowed:
+        await send_error(send, 429, "Rate limit exceeded", rate_limit.headers())
+        return None
+    return rate_limit.headers()
+
+
+def view_error(error: Exception) -> tuple[int, str, dict]:
+    """Status, message and headers answering a failed view."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return (error.response.status_code,
+                f"External service error: {error.response.status_code} - "
+                f"{error.response.text}", {})
+    if isinstance(error, (QuotaExceededError, CircuitOpenError)):
+        return 503, str(error), {"Retry-After": str(error.retry_after)}
+    if isinstance(error, UnknownUnitsError):
+        return 400, str(error), {}
+    logger.error("Request error: %s", error)
+    return 502, "External service unavailable", {}
+
+
+async def send_not_modified(send, validators: Validators, if_none_match: bytes,
+                            limit_headers: dict) -> bool:
+    """
+    Answer a conditional request from the validator of a fresh cache
+    entry, without reading the entry itself, like routes.not_modified.
+    :returns: False when the request has to be served
+    """
+    etags = parse_etags(if_none_match.decode())
+    for query, derive in validators:
+        validator = await get_fresh_validator_async(query)
+        if validator is None:
+            continue
+        # the client holds the body of one of the codings
+        etag = matching_etag(etags, derive(validator.etag) if derive else validator.etag)
+        if etag is None:
+            continue
+        record_not_modified(query)
+        await send_response(send, 304, b"", {
+            "ETag": f'"{etag}"',
+            "Vary": "Accept-Encoding",
+            "Cache-Control": cache_control(validator.created_at, query.soft_ttl,
+                                           query.cache_timeout, STALE_IF_ERROR),
+            **limit_headers})
+        return True
+    return False
+
+
+async def send_payload(send, payload: CachedPayload, request_headers: dict,
+                       query: UpstreamQuery, limit_headers: dict) -> None:
+    """
+    Send a payload like the Flask routes do, a 304 for a matching ETag.
+    :param query: cache entry the payload was served from, for its TTLs
+    """
+    body, headers = payload.representation(
+        request_headers.get(b"accept-encoding", b"").decode() or None)
+    headers["Cache-Control"] = cache_control(
+        payload.created_at, query.soft_ttl, query.cache_timeout, STALE_IF_ERROR)
+    if_none_match = request_headers.get(b"if-none-match")
+    if if_none_match and parse_etags(if_none_match.decode()).contains_weak(
+            headers["ETag"].strip('"')):
+        # the length is the one of the representation the client holds
+        headers = {name: value for name, value in headers.items()
+                   if name in ("ETag", "Vary", "Cache-Control", "Content-Length")}
+        await send_response(send, 304, b"", {**headers, **limit_headers})
+        return
+    await send_response(send, 200, body, {**headers, **limit_headers})
+
+
+async def serve_async(scope, send, endpoint: str, city: str,  # pylint: disable=too-many-locals
+                      auth: bool) -> None:
+    """Serve a cached weather route with its coroutine."""
+    view, validators_of = ASYNC_VIEWS[endpoint]
+    request_headers = dict(scope["headers"])
+    limit_headers = await authorize(request_headers, send) if auth else {}
+    if limit_headers is None:
+        return
+
+    args = MultiDict(parse_qsl(scope["query_string"].decode(), keep_blank_values=True))
+    if_none_match = request_headers.get(b"if-none-match")
+    try:
+        validators = validators_of(city, args)
+        if if_none_match and await send_not_modified(send, validators, if_none_match,
+                                                     limit_headers):
+            return
+        payload = await view(city, args)
+    except (httpx.HTTPError, QuotaExceededError, CircuitOpenError,
+            UnknownUnitsError) as error:
+        status, message, error_headers = view_error(error)
+        await send_error(send, status, message, {**error_headers, **limit_headers})
+        return
+
+    await send_payload(send, payload, request_headers, validators[0][0], limit_headers)
+
+
+async def wait_disconnect(receive) -> None:
+    """Return once the client went away."""
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_events(send, subscription: Subscription, sse: bool,
+                      disconnected: asyncio.Future) -> None:
+    """
+    Send the events of a subscription as the hub queues them, until it is
+    closed or the client goes away, like routes.stream_events.
+    """
+    keepalive = b": keepalive\n\n" if sse else b"\n"
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    subscription.wakeup = lambda: loop.call_soon_threadsafe(ready.set)
+    while True:
+        # cleared before polling, an event queued meanwhile sets it again
+        ready.clear()
+        try:
+            event = subscription.get_nowait()
+        except queue.Empty:
+            waiter = asyncio.ensure_future(ready.wait())
+            done, _ = await asyncio.wait({waiter, disconnected}, timeout=STREAM_KEEPALIVE,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if disconnected in done:
+                return
+            if not done:
+                await send({"type": "http.response.body", "body": keepalive,
+                            "more_body": True})
+            continue
+        if event is None:
+            return
+        await send({"type": "http.response.body",
+                    "body": event.sse() if sse else event.ndjson(), "more_body": True})
+
+
+async def subscribe_async(cities: list[str]) -> tuple[Subscription, list[Event]]:
+    """Subscribe to the forecast of cities, loaded with the asyncio services."""
+    loaded = dict(zip(cities, await asyncio.gather(
+        *(get_forecast_async(city) for city in cities))))
+    return stream_hub.subscribe(
+        cities, load=lambda city: (forecast_query(city).redis_key, loaded[city]))
+
+
+async def send_stream(receive, send,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                      subscription: Subscription, snapshots: list[Event],
+                      sse: bool, limit_headers: dict) -> None:
+    """Send the snapshots, then the events of a subscription, like routes.stream_events."""
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        headers = {"Content-Type": "text/event-stream" if sse else "application/x-ndjson",
+                   **STREAM_HEADERS, **limit_headers}
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(name.lower().encode(), value.encode())
+                                for name, value in headers.items()]})
+        for event in snapshots:
+            await send({"type": "http.response.body",
+                        "body": event.sse() if sse else event.ndjson(), "more_body": True})
+        await send_events(send, subscription, sse, disconnected)
+        closing = b""
+    # the response has started, the stream ends with an error event instead
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        logger.error("Stream error: %s", error, exc_info=True)
+        event = error_event("Stream interrupted")
+        closing = event.sse() if sse else event.ndjson()
+    finally:
+        gone = disconnected.done()
+        disconnected.cancel()
+        stream_hub.unsubscribe(subscription)
+    if not gone:
+        await send({"type": "http.response.body", "body": closing})
+
+
+async def serve_stream(scope, receive, send, auth: bool) -> None:
+    """Subscribe to the forecast of cities like routes.forecast_stream."""
+    limit_headers = await authorize(dict(scope["headers"]), send) if auth else {}
+    if limit_headers is None:
+        return
+    arguments = stream_arguments(
+        MultiDict(parse_qsl(scope["query_string"].decode(), keep_blank_values=True)))
+    if arguments is None:
+        await send_error(send, 400, STREAM_ARGUMENTS_ERROR, limit_headers)
+        return
+    cities, sse = arguments
+    try:
+        subscription, snapshots = await subscribe_async(cities)
+    except SubscribersExceededError as exceeded:
+        await send_error(send, 503, str(exceeded), {
+            "Retry-After": str(exceeded.retry_after), **limit_headers})
+        return
+    except (httpx.HTTPError, QuotaExceededError, CircuitOpenError) as error:
+        status, message, error_headers = view_error(error)
+        await send_error(send, status, message, {**error_headers, **limit_headers})
+        return
+    await send_stream(receive, send, subscription, snapshots, sse, limit_headers)
+
+
+async def read_body(receive) -> bytes:
+    """The whole body of a request."""
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            return body
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+
+def wsgi_environ(scope, body: bytes) -> dict:
+    """WSGI environ of an http request."""
+    client = scope.get("client") or ("", 0)
+    return EnvironBuilder(
+        path=scope["path"], method=scope["method"],
+        query_string=scope["query_string"].decode("latin-1"),
+        headers=[(name.decode("latin-1"), value.decode("latin-1"))
+                 for name, value in scope["headers"]],
+        data=body, environ_base={"REMOTE_ADDR": client[0]}).get_environ()
+
+
+async def serve_wsgi(wsgi_app, scope, receive, send) -> None:
+    """
+    Answer a request with the Flask app on worker threads, its body sent
+    as the app yields it.
+    """
+    environ = wsgi_environ(scope, await read_body(receive))
+    # streamed views push the request context in their generator, every
+    # step of it has to run in the same context
+    context = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+
+    def in_thread(func, *args):
+        return loop.run_in_executor(None, context.run, func, *args)
+
+    app_iter, status, headers = await in_thread(run_wsgi_app, wsgi_app, environ)
+    chunks = iter(app_iter)
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                        for name, value in headers.to_wsgi_list()],
+        })
+        while (chunk := await in_thread(next, chunks, None)) is not None:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk,
+                            "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(app_iter, "close"):
+            await in_thread(app_iter.close)
+
+
+async def handle_http(scope, receive, send, flask_app, auth: bool) -> None:
+    """
+    Dispatch an http request: the cached weather routes to their
+    coroutines, anything else to the Flask app, which records its metrics.
+    """
+    try:
+        endpoint, values = flask_app.url_map.bind("").match(
+            scope["path"], method=scope["method"])
+    except HTTPException:
+        endpoint, values = None, {}
+    if scope["method"] != "GET" or endpoint not in (*ASYNC_VIEWS, STREAM_ENDPOINT):
+        await serve_wsgi(flask_app, scope, receive, send)
+        return
+
+    # picked up by the request metrics
+    scope["endpoint"] = endpoint
+    started = time.perf_counter()
+    status: Optional[int] = None
+
+    async def send_recorded(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            # timed to the start of the response like the Flask app, streams included
+            metrics.observe_request(endpoint, scope["method"], status, started)
+        await send(message)
+
+    try:
+        if endpoint == STREAM_ENDPOINT:
+            await serve_stream(scope, receive, send_recorded, auth)
+        else:
+            await serve_async(scope, send_recorded, endpoint, values["city"], auth)
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        # answered like an unhandled error of a Flask view
+        logger.error("Request error: %s", error, exc_info=True)
+        if status is None:
+            await send_error(send_recorded, 500, "Internal Server Error")
+
+
+async def handle_lifespan(receive, send) -> None:
+    """Close pooled connections when the server shuts down."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_http_client.aclose()
+            await async_redis.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def create_asgi_app(auth: Optional[bool] = None):
+    """
+    Create the ASGI app, around a Flask app created with the default config.
+    :param auth: require API keys, API_AUTH_ENABLED decides by default
+    """
+    flask_app = create_app(None if auth is None else {"API_AUTH_ENABLED": auth})
+    auth = flask_app.config["API_AUTH_ENABLED"]
+
+    async def app(scope, receive, send):
+        if scope["type"] == "http":
+            await handle_http(scope, receive, send, flask_app, auth)
+        elif scope["type"] == "lifespan":
+            await handle_lifespan(receive, send)
+
+    return app
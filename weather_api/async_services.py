@@ -0,0 +1,237 @@
+"""
+Asyncio variants of the services, used by the ASGI entry point.
+
+They build the same upstream queries and read and write the same cache
+entries as the sync services, so both can run side by side.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+import httpx
+from redis.exceptions import RedisError
+
+from . import metrics
+from .breaker import CircuitOpenError, is_failure
+from .extensions import (CACHE_KEY_PREFIX, async_http_client, async_redis,
+                         async_single_flight, async_upstream_budget,
+                         async_upstream_router, refresher)
+from .normalize import check_units, normalize_payload
+from .payload import CachedPayload, as_payload
+from .projection import needs_upstream, project_payload, today_payload
+from .quota import Priority, QuotaExceededError
+from .services import (FORECAST_DAYS, STALE_IF_ERROR, UPSTREAM_TIMEOUT,
+                       UpstreamQuery, Validator, answer_records, count_saved,
+                       elements_query, forecast_query, fresh_validator,
+                       parse_elements, record_history, record_upstream_failure,
+                       timeline_query, weather_query)
+from .tiered_cache import L1_CHANNEL, TieredRedisCache, validator_key
+
+logger = logging.getLogger(__name__)
+
+# Values are encoded exactly like the Flask-Caching backend does
+serializer = TieredRedisCache.serializer
+# Background refreshes in flight, by cache key
+_refreshing: dict[str, asyncio.Task] = {}
+
+
+async def get_data_from_cache_async(redis_key: str) -> Optional[CachedPayload]:
+    """
+    Try to get cache data for a specific key.
+    :param redis_key: key name, without the cache prefix
+    :returns: None if key is not in cache, cached payload otherwise
+    """
+    try:
+        with metrics.CACHE_GET_REDIS.time():
+            raw = await async_redis.get(CACHE_KEY_PREFIX + redis_key)
+    except RedisError as redis_error:
+        logger.warning("Cache read failed for %s: %s", redis_key, redis_error)
+        return None
+    return as_payload(serializer.loads(raw))
+
+
+async def get_fresh_validator_async(query: UpstreamQuery) -> Optional[Validator]:
+    """Asyncio variant of services.get_fresh_validator"""
+    try:
+        raw = await async_redis.get(CACHE_KEY_PREFIX + validator_key(query.redis_key))
+    except RedisError as redis_error:
+        logger.warning("Validator read failed for %s: %s", query.redis_key, redis_error)
+        return None
+    return fresh_validator(serializer.loads(raw), query)
+
+
+async def cache_payload_async(redis_key: str, payload: CachedPayload,
+                              timeout: int) -> None:
+    """
+    Store a payload and its validator, like the cache backend does, and
+    drop stale local copies in sync workers.
+    """
+    try:
+        pipe = async_redis.pipeline(transaction=False)
+        pipe.setex(CACHE_KEY_PREFIX + redis_key, timeout,
+                   serializer.dumps(payload))
+        pipe.setex(CACHE_KEY_PREFIX + validator_key(redis_key), timeout,
+                   serializer.dumps((payload.etag, payload.created_at)))
+        pipe.publish(L1_CHANNEL, f"async:{redis_key}")
+        with metrics.CACHE_SET.time():
+            await pipe.execute()
+    except RedisError as redis_error:
+        logger.warning("Cache write failed for %s: %s", redis_key, redis_error)
+
+
+async def fetch_query_async(query: UpstreamQuery) -> CachedPayload:
+    """
+    Call the 3rd party API for a query and cache a successful response.
+    :raises httpx.HTTPStatusError: for an unsuccessful upstream response
+    :raises CircuitOpenError: when upstream is failing and calls fail fast
+    :raises QuotaExceededError: when the upstream budget has no room for it
+    """
+    await async_upstream_budget.take(query.cost, query.priority)
+    started = time.perf_counter()
+    try:
+        answer = await async_upstream_router.fetch(async_http_client, query,
+                                                   UPSTREAM_TIMEOUT)
+    except CircuitOpenError:
+        await async_upstream_budget.settle(-query.cost)
+        raise
+    except httpx.HTTPError as request_error:
+        metrics.UPSTREAM_ERRORS.labels(query.endpoint, type(request_error).__name__).inc()
+        await async_upstream_budget.settle(-query.cost)
+        raise
+    finally:
+        metrics.UPSTREAM_LATENCY.labels(query.endpoint).observe(time.perf_counter() - started)
+    response = answer.response
+    if response.is_error:
+        # failed calls are not billed
+        await async_upstream_budget.settle(-query.cost)
+        record_upstream_failure(query, response.status_code, response.text)
+        response.raise_for_status()
+    with metrics.JSON_DECODE.time():
+        data = response.json()
+    data = answer.provider.normalize(data, query)
+    await async_upstream_budget.settle(answer_records(answer, data, query) - query.cost)
+    payload = CachedPayload.from_data(data)
+    await cache_payload_async(query.redis_key, payload,
+                              query.cache_timeout + STALE_IF_ERROR)
+    await asyncio.to_thread(record_history, query, data, payload.created_at)
+    return payload
+
+
+async def get_fresh_data_from_cache_async(query: UpstreamQuery,
+                                          max_age: Optional[int] = None
+                                          ) -> Optional[CachedPayload]:
+    """Cached payload of a query, entries past `max_age` (soft TTL) are a miss."""
+    cached_data = await get_data_from_cache_async(query.redis_key)
+    if cached_data and cached_data.age() <= (max_age or query.soft_ttl):
+        return cached_data
+    return None
+
+
+async def refresh_query_async(query: UpstreamQuery) -> None:
+    """Repopulate the cache entry of a query, errors keep the stale entry."""
+    query = query._replace(priority=Priority.BACKGROUND)
+    try:
+        await async_single_flight.do(
+            query.redis_key, lambda: fetch_query_async(query),
+            lambda: get_fresh_data_from_cache_async(query))
+    except (httpx.HTTPError, RedisError, QuotaExceededError, CircuitOpenError) as error:
+        logger.warning("Background refresh of %s failed: %s",
+                       query.redis_key, error)
+    finally:
+        _refreshing.pop(query.redis_key, None)
+
+
+async def timeline_weather_async(query: UpstreamQuery) -> Optional[CachedPayload]:
+    """Asyncio variant of services.timeline_weather"""
+    timeline = await get_fresh_data_from_cache_async(timeline_query(query))
+    if timeline is None:
+        return None
+    # decoding the timeline is CPU work, kept off the event loop
+    today = await asyncio.to_thread(today_payload, timeline)
+    if today is None:
+        return None
+    await asyncio.to_thread(count_saved, "weather", today.etag, query.cost)
+    return today
+
+
+async def cached_fetch_async(
+        query: UpstreamQuery,
+        shared: Optional[Callable[[], Awaitable[Optional[CachedPayload]]]] = None
+) -> CachedPayload:
+    """
+    Serve a query from cache, concurrent misses share a single fetch.
+    :param shared: answer out of a document cached for another query,
+        tried before refreshing or fetching the entry of this one
+    """
+    if query.member:
+        refresher.record(query.member)
+    cached_data = await get_data_from_cache_async(query.redis_key)
+    if shared is not None and (cached_data is None or cached_data.age() > query.soft_ttl):
+        payload = await shared()
+        if payload is not None:
+            metrics.CACHE_LOOKUPS.labels(query.endpoint, "shared").inc()
+            return payload
+    if cached_data and cached_data.age() <= query.cache_timeout:
+        stale = cached_data.age() > query.soft_ttl
+        metrics.CACHE_LOOKUPS.labels(query.endpoint, "stale" if stale else "hit").inc()
+        if stale and query.redis_key not in _refreshing:
+            # serve stale while revalidating, the task is referenced until done
+            _refreshing[query.redis_key] = asyncio.create_task(
+                refresh_query_async(query))
+        return cached_data
+    metrics.CACHE_LOOKUPS.labels(
+        query.endpoint, "expired" if cached_data else "miss").inc()
+    try:
+        return await async_single_flight.do(
+            query.redis_key, lambda: fetch_query_async(query),
+            lambda: get_fresh_data_from_cache_async(query, query.cache_timeout))
+    except httpx.HTTPStatusError as status_error:
+        if cached_data is None or not is_failure(status_error.response.status_code):
+            raise
+    except (CircuitOpenError, QuotaExceededError, httpx.HTTPError):
+        if cached_data is None:
+            raise
+    logger.warning("Serving expired entry, upstream unavailable",
+                   extra={"query": query.description, "age": int(cached_data.age())})
+    return cached_data.as_stale()
+
+
+async def get_weather_async(city: str) -> CachedPayload:
+    """
+    Fetch weather data from weather.visualcrossing.com, or take it out of
+    the fresh forecast timeline of the city
+    """
+    query = weather_query(city)
+    return await cached_fetch_async(query, lambda: timeline_weather_async(query))
+
+
+async def get_forecast_async(city: str) -> CachedPayload:
+    """Get forecast for the next 15 days for a specific city"""
+    return await cached_fetch_async(forecast_query(city))
+
+
+async def get_forecast_elements_async(city: str,
+                                      elements_list: list[str]) -> CachedPayload:
+    """Get forecast for specific elements, projected out of the forecast"""
+    elements = parse_elements(elements_list)
+    if needs_upstream(elements):
+        return await cached_fetch_async(elements_query(city, elements))
+    forecast = await get_forecast_async(city)
+    if not elements:
+        return forecast
+    projected = await asyncio.to_thread(project_payload, forecast, elements)
+    await asyncio.to_thread(count_saved, "elements", projected.etag, FORECAST_DAYS)
+    return projected
+
+
+async def get_normalized_weather_async(city: str, units: str = "metric") -> CachedPayload:
+    """Today's weather in the normalized columnar format"""
+    check_units(units)
+    return await asyncio.to_thread(normalize_payload, await get_weather_async(city), units)
+
+
+async def get_normalized_forecast_async(city: str, units: str = "metric") -> CachedPayload:
+    """Forecast for the next 15 days in the normalized columnar format"""
+    check_units(units)
+    return await asyncio.to_thread(normalize_payload, await get_forecast_async(city), units)
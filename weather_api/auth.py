@@ -0,0 +1,274 @@
+"""
+API key authentication and per key rate limiting.
+
+Keys are stored in Redis as a hash of their SHA-256 digest and validated
+from an in-process cache, so a known key costs no round trip. Limits are
+sliding windows, approximated from the counts of the current and of the
+previous fixed window, checked and counted by one Lua script.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import secrets
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+import click
+from flask import current_app, g, jsonify, request
+from redis.exceptions import RedisError
+
+from .tiered_cache import LocalLRU
+
+logger = logging.getLogger(__name__)
+
+# Header clients send their key in
+API_KEY_HEADER = "X-API-Key"
+# Default limit of a key, requests per window of seconds
+DEFAULT_LIMIT = int(os.getenv("API_RATE_LIMIT", "60"))
+DEFAULT_WINDOW = int(os.getenv("API_RATE_WINDOW", "60"))
+
+# Count a request unless the sliding window estimate is at the limit.
+# returns {allowed, current window count, previous window count}
+HIT_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local weight = tonumber(ARGV[3])
+local current = tonumber(redis.call('GET', KEYS[1])) or 0
+local previous = tonumber(redis.call('GET', KEYS[2])) or 0
+if previous * weight + current + 1 > limit then
+    return {0, current, previous}
+end
+current = redis.call('INCR', KEYS[1])
+if current == 1 then
+    redis.call('EXPIRE', KEYS[1], window * 2)
+end
+return {1, current, previous}
+"""
+
+
+@dataclass(frozen=True)
+class ApiClient:
+    """Owner of an API key and its rate limit."""
+    name: str
+    limit: int = DEFAULT_LIMIT
+    window: int = DEFAULT_WINDOW
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """Outcome of one rate limit check."""
+    allowed: bool
+    limit: int
+    remaining: int
+    # seconds until the current window ends
+    reset: int
+    # seconds until a denied request could be allowed
+    retry_after: int = 0
+
+    def headers(self) -> dict:
+        """Standard X-RateLimit-* headers."""
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(self.reset),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(self.retry_after)
+        return headers
+
+
+def key_digest(api_key: str) -> str:
+    """Keys are only ever stored and cached by digest."""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+class KeyPolicy:
+    """
+    Key lookup and rate limit arithmetic shared by the sync and asyncio
+    authenticators.
+    """
+
+    def __init__(self, redis_client, keys_hash: str = "auth:keys",
+                 cache_ttl: float = 60, prefix: str = "ratelimit"):
+        """
+        :param redis_client: client holding keys and counters
+        :param keys_hash: Redis hash of key digest -> client json
+        :param cache_ttl: seconds a key lookup, known or not, is cached
+        :param prefix: prefix of the rate limit counters
+        """
+        self.redis = redis_client
+        self.keys_hash = keys_hash
+        self.prefix = prefix
+        self.clients = LocalLRU(max_bytes=1024 * 1024, max_ttl=cache_ttl)
+
+    def cached_client(self, digest: str):
+        """
+        :returns: the cached client, False for a cached unknown key and
+            None when the key is not cached
+        """
+        return self.clients.get(digest)
+
+    def remember(self, digest: str, raw: Optional[bytes]) -> Optional[ApiClient]:
+        """Cache the result of a Redis key lookup."""
+        client = ApiClient(**json.loads(raw)) if raw else None
+        self.clients.set(digest, client or False, 256, self.clients.max_ttl)
+        return client
+
+    def hit_args(self, client: ApiClient, now: float) -> tuple[list, list]:
+        """Keys and arguments of HIT_SCRIPT for a request at `now`."""
+        index, elapsed = divmod(now, client.window)
+        keys = [f"{self.prefix}:{client.name}:{int(index)}",
+                f"{self.prefix}:{client.name}:{int(index) - 1}"]
+        return keys, [client.limit, client.window, 1 - elapsed / client.window]
+
+    @staticmethod
+    def rate_limit(client: ApiClient, now: float, result) -> RateLimit:
+        """Turn the result of HIT_SCRIPT into a RateLimit."""
+        allowed, current, previous = (int(value) for value in result)
+        elapsed = now % client.window
+        weight = 1 - elapsed / client.window
+        used = previous * weight + current
+        retry_after = 0
+        if not allowed:
+            # the share of the previous window fades out as time passes,
+            # without one only the end of the current window helps
+            retry_after = ((used + 1 - client.limit) * client.window / previous
+                           if previous else client.window - elapsed)
+        return RateLimit(
+            allowed=bool(allowed), limit=client.limit,
+            remaining=max(client.limit - math.ceil(used), 0),
+            reset=math.ceil(client.window - elapsed),
+            retry_after=max(math.ceil(min(retry_after, client.window)), 1))
+
+    def create_key(self, name: str, limit: int = DEFAULT_LIMIT,
+                   window: int = DEFAULT_WINDOW) -> str:
+        """
+        Register a new key for a client.
+        :returns: the key, it cannot be read back later
+        """
+        api_key = secrets.token_urlsafe(32)
+        client = ApiClient(name=name, limit=limit, window=window)
+        self.redis.hset(self.keys_hash, key_digest(api_key),
+                        json.dumps(asdict(client)))
+        return api_key
+
+    def revoke_key(self, api_key: str) -> bool:
+        """Remove a key, processes forget it within the cache TTL."""
+        digest = key_digest(api_key)
+        self.clients.delete(digest)
+        return bool(self.redis.hdel(self.keys_hash, digest))
+
+
+class ApiKeyAuth(KeyPolicy):
+    """
+    Flask extension requiring an API key on the routes of some
+    blueprints and limiting how often each key can call them.
+    """
+
+    def init_app(self, app, blueprints: tuple[str, ...] = ("weather",)):
+        """
+        Protect the routes of `blueprints`. API_AUTH_ENABLED turns the
+        checks off, for local development.
+        """
+        app.config.setdefault(
+            "API_AUTH_ENABLED", os.getenv("API_AUTH_ENABLED", "true").lower() == "true")
+
+        @app.before_request
+        def check_api_key():
+            if request.blueprint in blueprints and current_app.config["API_AUTH_ENABLED"]:
+                return self.check(request.headers.get(API_KEY_HEADER))
+            return None
+
+        @app.after_request
+        def add_rate_limit_headers(response):
+            rate_limit = g.pop("rate_limit", None)
+            if rate_limit is not None:
+                response.headers.update(rate_limit.headers())
+            return response
+
+        @app.cli.command("create-api-key")
+        @click.argument("name")
+        @click.option("--limit", default=DEFAULT_LIMIT, help="Requests per window.")
+        @click.option("--window", default=DEFAULT_WINDOW, help="Window in seconds.")
+        def create_api_key(name, limit, window):
+            """Create an API key for client NAME and print it."""
+            click.echo(self.create_key(name, limit, window))
+
+    def authenticate(self, api_key: Optional[str]) -> Optional[ApiClient]:
+        """
+        :returns: the client owning the key, None for unknown keys
+        :raises RedisError: when the key is not cached and Redis is down
+        """
+        if not api_key:
+            return None
+        digest = key_digest(api_key)
+        client = self.cached_client(digest)
+        if client is None:
+            client = self.remember(digest, self.redis.hget(self.keys_hash, digest))
+        return client or None
+
+    def hit(self, client: ApiClient) -> Optional[RateLimit]:
+        """
+        Count a request of a client.
+        :returns: None when the limit could not be checked
+        """
+        now = time.time()
+        keys, args = self.hit_args(client, now)
+        try:
+            result = self.redis.eval(HIT_SCRIPT, 2, *keys, *args)
+        except RedisError as redis_error:
+            # never let the limiter turn into an outage
+            logger.warning("Rate limit unavailable for %s: %s", client.name, redis_error)
+            return None
+        return self.rate_limit(client, now, result)
+
+    def check(self, api_key: Optional[str]):
+        """
+        Authenticate and count a request.
+        :returns: an error response, or None to let the request through
+        """
+        try:
+            client = self.authenticate(api_key)
+        except RedisError as redis_error:
+            logger.error("API key lookup failed: %s", redis_error)
+            return jsonify({"status": "error",
+                            "message": "Authentication unavailable"}), 503
+        if client is None:
+            return jsonify({"status": "error",
+                            "message": f"Missing or invalid {API_KEY_HEADER} header"}), 401
+        rate_limit = self.hit(client)
+        g.rate_limit = rate_limit
+        if rate_limit is not None and not rate_limit.allowed:
+            return jsonify({"status": "error",
+                            "message": "Rate limit exceeded"}), 429
+        return None
+
+
+class AsyncApiKeyAuth(KeyPolicy):
+    """
+    Asyncio counterpart of ApiKeyAuth, for the ASGI app.
+    """
+
+    async def authenticate(self, api_key: Optional[str]) -> Optional[ApiClient]:
+        """Asyncio variant of ApiKeyAuth.authenticate"""
+        if not api_key:
+            return None
+        digest = key_digest(api_key)
+        client = self.cached_client(digest)
+        if client is None:
+            client = self.remember(digest, await self.redis.hget(self.keys_hash, digest))
+        return client or None
+
+    async def hit(self, client: ApiClient) -> Optional[RateLimit]:
+        """Asyncio variant of ApiKeyAuth.hit"""
+        now = time.time()
+        keys, args = self.hit_args(client, now)
+        try:
+            result = await self.redis.eval(HIT_SCRIPT, 2, *keys, *args)
+        except RedisError as redis_error:
+            logger.warning("Rate limit unavailable for %s: %s", client.name, redis_error)
+            return None
+        return self.rate_limit(client, now, result)
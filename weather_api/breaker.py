@@ -0,0 +1,266 @@
+"""
+Circuit breakers in front of the 3rd party API, shared by every worker
+through Redis.
+
+Each upstream endpoint has its own breaker. Calls are counted in fixed
+windows; once enough of them failed or were slow the breaker opens and
+calls fail fast instead of tying up workers behind a degraded upstream.
+After `open_seconds` a single worker is let through as a probe: its
+success closes the breaker, its failure opens it for another period.
+"""
+import logging
+import time
+from typing import Optional
+
+from redis.exceptions import RedisError
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+# Values of the breaker state gauge
+STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+# Whether a call may go upstream. Past the open period the first caller
+# gets the probe, the others are denied until the probe is over or lost.
+# returns {allowed, state, retry_after}
+ALLOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+local open_seconds = tonumber(ARGV[2])
+local probe_timeout = tonumber(ARGV[3])
+
+local state = redis.call('HMGET', KEYS[1], 'state', 'opened_at', 'probe_until')
+local status = state[1] or 'closed'
+if status == 'closed' then
+    return {1, status, '0'}
+end
+if status == 'open' then
+    local reopen = tonumber(state[2]) + open_seconds
+    if now < reopen then
+        return {0, status, tostring(reopen - now)}
+    end
+end
+local probe_until = tonumber(state[3]) or 0
+if status == 'half_open' and now < probe_until then
+    return {0, status, tostring(probe_until - now)}
+end
+redis.call('HSET', KEYS[1], 'state', 'half_open', 'probe_until', tostring(now + probe_timeout))
+redis.call('EXPIRE', KEYS[1], math.ceil(probe_timeout + open_seconds))
+return {1, 'half_open', '0'}
+"""
+
+# Count the outcome of a call and move the breaker to its next state.
+# returns the state after the call
+RECORD_SCRIPT = """
+local now = tonumber(ARGV[1])
+local failed = tonumber(ARGV[2])
+local slow = tonumber(ARGV[3])
+local window = tonumber(ARGV[4])
+local min_calls = tonumber(ARGV[5])
+local error_rate = tonumber(ARGV[6])
+local slow_rate = tonumber(ARGV[7])
+local ttl = tonumber(ARGV[8])
+
+local state = redis.call('HMGET', KEYS[1], 'state', 'window_start')
+local status = state[1] or 'closed'
+if status == 'half_open' then
+    if failed + slow > 0 then
+        redis.call('HSET', KEYS[1], 'state', 'open', 'opened_at', tostring(now))
+        redis.call('EXPIRE', KEYS[1], ttl)
+        return 'open'
+    end
+    redis.call('DEL', KEYS[1])
+    return 'closed'
+end
+if status == 'open' then
+    return status
+end
+if now - (tonumber(state[2]) or 0) >= window then
+    redis.call('HSET', KEYS[1], 'window_start', tostring(now),
+               'calls', 0, 'failures', 0, 'slow', 0)
+end
+local calls = redis.call('HINCRBY', KEYS[1], 'calls', 1)
+local failures = redis.call('HINCRBY', KEYS[1], 'failures', failed)
+local slows = redis.call('HINCRBY', KEYS[1], 'slow', slow)
+redis.call('EXPIRE', KEYS[1], ttl)
+if calls >= min_calls and (failures >= calls * error_rate or slows >= calls * slow_rate) then
+    redis.call('HSET', KEYS[1], 'state', 'open', 'opened_at', tostring(now))
+    return 'open'
+end
+return 'closed'
+"""
+
+
+class CircuitOpenError(Exception):
+    """The breaker of an endpoint does not let calls through."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_failure(status_code: int) -> bool:
+    """Upstream responses counting against the breaker, client errors do not."""
+    return status_code >= 500 or status_code == 429
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class BreakerPolicy:  # pylint: disable=too-many-instance-attributes
+    """
+    Settings and bookkeeping shared by the sync and asyncio breakers.
+    An error rate of 0 or less disables the breakers.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, redis_client, error_rate: float = 0.5, slow_rate: float = 0.5,
+                 slow_call_seconds: float = 3.0, min_calls: int = 10,
+                 window: float = 30, open_seconds: float = 30,
+                 probe_timeout: float = 30, key: str = "breaker"):
+        """
+        :param redis_client: client holding the shared breaker state
+        :param error_rate: share of failed calls in a window opening the breaker
+        :param slow_rate: share of slow calls in a window opening the breaker
+        :param slow_call_seconds: calls taking longer than this are slow
+        :param min_calls: calls in a window before the rates are considered
+        :param window: seconds calls are counted together
+        :param open_seconds: how long calls fail fast before a probe
+        :param probe_timeout: how long a probe may take before another
+            worker is allowed to probe
+        :param key: prefix of the Redis keys
+        """
+        self.redis = redis_client
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.probe_timeout = probe_timeout
+        self.key = key
+        # circuit -> monotonic time until which it is known to be open,
+        # spares a Redis round trip per call while failing fast
+        self._open_until: dict[str, float] = {}
+
+    @property
+    def enabled(self) -> bool:
+        """Whether breakers are used at all."""
+        return self.error_rate > 0
+
+    def state_key(self, circuit: str) -> str:
+        """Redis key of the state of a breaker."""
+        return f"{self.key}:{circuit}"
+
+    def denied(self, circuit: str) -> Optional[CircuitOpenError]:
+        """Error for a call this process already knows the breaker rejects."""
+        remaining = self._open_until.get(circuit, 0.0) - time.monotonic()
+        if remaining <= 0:
+            return None
+        return self.open_error(circuit, remaining)
+
+    def open_error(self, circuit: str, retry_after: float) -> CircuitOpenError:
+        """Count a rejected call and build its error."""
+        metrics.CIRCUIT_REJECTIONS.labels(circuit).inc()
+        return CircuitOpenError(f"Upstream {circuit} is unavailable",
+                                retry_after=int(retry_after) + 1)
+
+    def allowed(self, circuit: str, result) -> Optional[CircuitOpenError]:
+        """Remember the state returned by ALLOW_SCRIPT, error if denied."""
+        granted, state, retry_after = int(result[0]), _text(result[1]), float(result[2])
+        metrics.CIRCUIT_STATE.labels(circuit).set(STATE_VALUES[state])
+        if granted:
+            self._open_until.pop(circuit, None)
+            return None
+        self._open_until[circuit] = time.monotonic() + retry_after
+        return self.open_error(circuit, retry_after)
+
+    def record_args(self, failed: bool, elapsed: float, now: float) -> list:
+        """Arguments of RECORD_SCRIPT for one call."""
+        ttl = int(self.window + self.open_seconds + self.probe_timeout) + 1
+        return [now, int(failed), int(elapsed > self.slow_call_seconds), self.window,
+                self.min_calls, self.error_rate, self.slow_rate, ttl]
+
+    def recorded(self, circuit: str, state) -> None:
+        """Remember the state returned by RECORD_SCRIPT."""
+        state = _text(state)
+        metrics.CIRCUIT_STATE.labels(circuit).set(STATE_VALUES[state])
+        if state == OPEN:
+            logger.warning("Circuit breaker opened", extra={"circuit": circuit})
+            self._open_until[circuit] = time.monotonic() + self.open_seconds
+
+
+class CircuitBreaker(BreakerPolicy):
+    """
+    Ask the breaker of an endpoint before each upstream call, report the
+    outcome after it.
+    """
+
+    def allow(self, circuit: str) -> None:
+        """
+        :raises CircuitOpenError: when calls to `circuit` must fail fast
+        """
+        if not self.enabled:
+            return
+        error = self.denied(circuit)
+        if error is None:
+            try:
+                error = self.allowed(circuit, self.redis.eval(
+                    ALLOW_SCRIPT, 1, self.state_key(circuit),
+                    time.time(), self.open_seconds, self.probe_timeout))
+            except RedisError as redis_error:
+                # an unreachable breaker must not become an outage
+                logger.warning("Circuit breaker unavailable: %s", redis_error)
+                return
+        if error is not None:
+            raise error
+
+    def record(self, circuit: str, failed: bool, elapsed: float) -> None:
+        """
+        Count the outcome of a call.
+        :param failed: the call raised or got a failure status
+        :param elapsed: seconds the call took
+        """
+        if not self.enabled:
+            return
+        try:
+            self.recorded(circuit, self.redis.eval(
+                RECORD_SCRIPT, 1, self.state_key(circuit),
+                *self.record_args(failed, elapsed, time.time())))
+        except RedisError as redis_error:
+            logger.warning("Circuit breaker unavailable: %s", redis_error)
+
+
+class AsyncCircuitBreaker(BreakerPolicy):
+    """
+    Asyncio counterpart of CircuitBreaker, sharing the same Redis state.
+    """
+
+    async def allow(self, circuit: str) -> None:
+        """Asyncio variant of CircuitBreaker.allow"""
+        if not self.enabled:
+            return
+        error = self.denied(circuit)
+        if error is None:
+            try:
+                error = self.allowed(circuit, await self.redis.eval(
+                    ALLOW_SCRIPT, 1, self.state_key(circuit),
+                    time.time(), self.open_seconds, self.probe_timeout))
+            except RedisError as redis_error:
+                logger.warning("Circuit breaker unavailable: %s", redis_error)
+                return
+        if error is not None:
+            raise error
+
+    async def record(self, circuit: str, failed: bool, elapsed: float) -> None:
+        """Asyncio variant of CircuitBreaker.record"""
+        if not self.enabled:
+            return
+        try:
+            self.recorded(circuit, await self.redis.eval(
+                RECORD_SCRIPT, 1, self.state_key(circuit),
+                *self.record_args(failed, elapsed, time.time())))
+        except RedisError as redis_error:
+            logger.warning("Circuit breaker unavailable: %s", redis_error)
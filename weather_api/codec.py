@@ -0,0 +1,149 @@
+"""
+Compact binary encoding of the values stored in the Redis cache.
+
+Every value starts with a format version byte and a flags byte naming
+the serializer and the compression used, so formats can evolve without
+flushing the cache. Values written by the default pickle serializer of
+Flask-Caching are still read.
+"""
+import os
+import pickle
+import zlib
+from typing import Any, Optional
+
+import msgpack
+import zstandard
+from cachelib.serializers import RedisSerializer
+
+from . import metrics
+from .payload import CachedPayload
+
+# First byte of every encoded value, never "!" or a digit like legacy values
+FORMAT_VERSION = 1
+# msgpack extension code of a CachedPayload storing all its bodies, still read
+PAYLOAD_EXT = 1
+# msgpack extension code of a CachedPayload storing only its smallest body
+PAYLOAD_BODY_EXT = 2
+
+# CachedPayload argument of the body stored in each coding
+CODED_BODIES = {None: "body", "br": "br_body", "gzip": "gzip_body"}
+
+SERIALIZERS = {"msgpack": 1, "pickle": 2}
+COMPRESSIONS = {"none": 0, "zstd": 1, "zlib": 2}
+
+
+def _pack_default(value: Any) -> Any:
+    if isinstance(value, CachedPayload):
+        # the other bodies are rebuilt from the smallest one when sent
+        coding, body = value.stored_body()
+        fields = (value.etag, value.created_at, coding, body, value.codings)
+        return msgpack.ExtType(PAYLOAD_BODY_EXT, msgpack.packb(fields))
+    raise TypeError(f"Cannot serialize {type(value)}")
+
+
+def _unpack_ext(code: int, data: bytes) -> Any:
+    if code == PAYLOAD_BODY_EXT:
+        etag, created_at, coding, body, codings = msgpack.unpackb(data)
+        return CachedPayload(etag=etag, created_at=created_at, codings=tuple(codings),
+                             **{CODED_BODIES[coding]: body})
+    if code == PAYLOAD_EXT:
+        # payloads written before the brotli variant have 4 fields
+        body, etag, gzip_body, created_at, br_body, *_ = (*msgpack.unpackb(data), None)
+        return CachedPayload(body=body, etag=etag, gzip_body=gzip_body,
+                             created_at=created_at, br_body=br_body)
+    return msgpack.ExtType(code, data)
+
+
+def _msgpack_dumps(value: Any) -> bytes:
+    return msgpack.packb(value, default=_pack_default, use_bin_type=True)
+
+
+def _msgpack_loads(data: bytes) -> Any:
+    return msgpack.unpackb(data, ext_hook=_unpack_ext, raw=False,
+                           strict_map_key=False)
+
+
+class CacheCodec:
+    """
+    Serializer for the Redis cache backend, same interface as the
+    cachelib serializers.
+    """
+
+    def __init__(self, serializer: str = "msgpack", compression: str = "zstd",
+                 threshold: int = 1024, level: int = 3):
+        """
+        :param serializer: one of SERIALIZERS
+        :param compression: one of COMPRESSIONS
+        :param threshold: values smaller than this are never compressed
+        :param level: compression level
+        """
+        if serializer not in SERIALIZERS:
+            raise ValueError(f"Unknown cache serializer {serializer}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown cache compression {compression}")
+        self.serializer = serializer
+        self.compression = compression
+        self.threshold = threshold
+        self.level = level
+        self._legacy = RedisSerializer()
+        self._zstd_compressor = zstandard.ZstdCompressor(level=level)
+        self._zstd_decompressor = zstandard.ZstdDecompressor()
+
+    @classmethod
+    def from_env(cls) -> "CacheCodec":
+        """Build a codec configured from CACHE_CODEC_* environment variables."""
+        return cls(
+            serializer=os.getenv("CACHE_CODEC_SERIALIZER", "msgpack"),
+            compression=os.getenv("CACHE_CODEC_COMPRESSION", "zstd"),
+            threshold=int(os.getenv("CACHE_CODEC_THRESHOLD", "1024")),
+            level=int(os.getenv("CACHE_CODEC_LEVEL", "3")),
+        )
+
+    def _serialize(self, value: Any) -> tuple[int, bytes]:
+        if self.serializer == "msgpack":
+            try:
+                return SERIALIZERS["msgpack"], _msgpack_dumps(value)
+            except (TypeError, ValueError, OverflowError):
+                # anything msgpack cannot represent still gets cached
+                pass
+        return SERIALIZERS["pickle"], pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == "zstd":
+            return self._zstd_compressor.compress(data)
+        return zlib.compress(data, self.level)
+
+    def dumps(self, value: Any) -> bytes:
+        """Encode a value for Redis."""
+        with metrics.CODEC_ENCODE.time():
+            return self._dumps(value)
+
+    def _dumps(self, value: Any) -> bytes:
+        serializer, data = self._serialize(value)
+        compression = COMPRESSIONS["none"]
+        if len(data) >= self.threshold and self.compression != "none":
+            compressed = self._compress(data)
+            # already compressed content does not shrink any further
+            if len(compressed) < len(data):
+                compression, data = COMPRESSIONS[self.compression], compressed
+        return bytes((FORMAT_VERSION, compression << 4 | serializer)) + data
+
+    def loads(self, value: Optional[bytes]) -> Any:
+        """Decode a value read from Redis, None stays None."""
+        if value is None:
+            return None
+        with metrics.CODEC_DECODE.time():
+            return self._loads(value)
+
+    def _loads(self, value: bytes) -> Any:
+        if not value or value[0] != FORMAT_VERSION:
+            return self._legacy.loads(value)
+        compression, serializer = value[1] >> 4, value[1] & 0x0F
+        data = memoryview(value)[2:]
+        if compression == COMPRESSIONS["zstd"]:
+            data = self._zstd_decompressor.decompress(data)
+        elif compression == COMPRESSIONS["zlib"]:
+            data = zlib.decompress(data)
+        if serializer == SERIALIZERS["msgpack"]:
+            return _msgpack_loads(data)
+        return pickle.loads(data)
@@ -1,22 +1,151 @@
 """
 Module to integrate 3rd party extensions to our app.
+
+Nothing here connects to anything: clients are created on first use, so
+importing the package stays cheap and works without the services running.
 """
 import os
 
 from dotenv import load_dotenv
 from flask_caching import Cache
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+
+from .auth import ApiKeyAuth, AsyncApiKeyAuth
+from .breaker import AsyncCircuitBreaker, CircuitBreaker
+from .lazy import LazyClient
+from .history import HistoryStore
+from .locations import Gazetteer
+from .providers import (AsyncProviderRouter, ProviderRouter,
+                        providers_from_names)
+from .quota import AsyncUpstreamBudget, UpstreamBudget
+from .refresh import Refresher
+from .refresh_queue import RefreshQueue
+from .singleflight import AsyncSingleFlight, SingleFlight
+from .stream import StreamHub
+from .upstream import AsyncUpstreamClient, UpstreamClient
 
+# The only place .env is read, before any setting below
 load_dotenv()
 # Initialize Redis connection
 # Example Redis URL, change as needed
-redis_url = os.getenv('REDIS_URL')
-redis = Redis.from_url(redis_url)
+redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+redis = LazyClient(lambda: Redis.from_url(redis_url), "redis")
+# Same Redis for the asyncio services
+async_redis = LazyClient(lambda: AsyncRedis.from_url(redis_url), "redis")
+# Shared by the Flask-Caching backend and the asyncio services
+CACHE_KEY_PREFIX = 'flask_cache_'
 
-# Initialize Flask-Caching with Redis as the cache backend
-cache = Cache(config={
-    'CACHE_TYPE': 'redis',
+# Flask-Caching settings, defaults of the app config so create_app can
+# override them: Redis as the cache backend, with a bounded in-process
+# LRU tier in front of it
+CACHE_CONFIG = {
+    'CACHE_TYPE': 'weather_api.tiered_cache.TieredRedisCache',
     'CACHE_REDIS_URL': redis_url,  # Use the same Redis URL
+    'CACHE_KEY_PREFIX': CACHE_KEY_PREFIX,
     # Set a default cache timeout (e.g., 5 minutes)
-    'CACHE_DEFAULT_TIMEOUT': 300
-})
+    'CACHE_DEFAULT_TIMEOUT': 300,
+    # Local tier size and how long a local copy may live at most
+    'CACHE_L1_MAX_BYTES': int(os.getenv('CACHE_L1_MAX_BYTES', str(64 * 1024 * 1024))),
+    'CACHE_L1_MAX_TTL': float(os.getenv('CACHE_L1_MAX_TTL', '60')),
+}
+cache = Cache()
+
+# Shared keep-alive clients for the 3rd party weather API
+http_client = UpstreamClient.from_env()
+async_http_client = AsyncUpstreamClient.from_env()
+
+# Coalesce concurrent cache misses for the same key, across workers too
+single_flight = SingleFlight(
+    redis,
+    lease_seconds=float(os.getenv('SINGLE_FLIGHT_LEASE', '15')),
+    wait_timeout=float(os.getenv('SINGLE_FLIGHT_WAIT', '15')))
+async_single_flight = AsyncSingleFlight(
+    async_redis,
+    lease_seconds=float(os.getenv('SINGLE_FLIGHT_LEASE', '15')),
+    wait_timeout=float(os.getenv('SINGLE_FLIGHT_WAIT', '15')))
+
+# Refreshes stale entries in the background and pre-warms hot keys
+refresher = Refresher(
+    redis,
+    workers=int(os.getenv('REFRESH_WORKERS', '4')),
+    interval=float(os.getenv('REFRESH_INTERVAL', '60')),
+    top_n=int(os.getenv('REFRESH_TOP_N', '50')),
+    half_life=float(os.getenv('REFRESH_HALF_LIFE', '3600')))
+# Popular entries due for a refresh, most requested first, run by
+# REFRESH_QUEUE_WORKERS threads of one web process per host, 0 leaves them
+# to `flask refresh-worker` processes
+refresh_queue = RefreshQueue(
+    redis,
+    workers=int(os.getenv('REFRESH_QUEUE_WORKERS', '2')),
+    popular_key=refresher.popular_key,
+    lease=float(os.getenv('REFRESH_QUEUE_LEASE', '30')))
+
+# Daily budget of 3rd party API records, shared by all workers. Opt-in:
+# unset or 0 does not limit calls, set it to the records of the upstream plan
+upstream_budget = UpstreamBudget(
+    redis,
+    daily_records=int(os.getenv('UPSTREAM_DAILY_RECORDS') or '0'),
+    # records spendable at once, an hour worth of budget when not set
+    burst=float(os.getenv('UPSTREAM_BUDGET_BURST', '0')) or None,
+    wait_timeout=float(os.getenv('UPSTREAM_BUDGET_WAIT', '2')))
+async_upstream_budget = AsyncUpstreamBudget(
+    async_redis,
+    daily_records=upstream_budget.daily_records,
+    burst=upstream_budget.burst,
+    wait_timeout=upstream_budget.wait_timeout)
+
+# Fail fast while the 3rd party API is failing or slow, state shared by all workers
+upstream_breaker = CircuitBreaker(
+    redis,
+    error_rate=float(os.getenv('BREAKER_ERROR_RATE', '0.5')),
+    slow_rate=float(os.getenv('BREAKER_SLOW_RATE', '0.5')),
+    slow_call_seconds=float(os.getenv('BREAKER_SLOW_CALL', '3')),
+    min_calls=int(os.getenv('BREAKER_MIN_CALLS', '10')),
+    window=float(os.getenv('BREAKER_WINDOW', '30')),
+    open_seconds=float(os.getenv('BREAKER_OPEN_SECONDS', '30')))
+async_upstream_breaker = AsyncCircuitBreaker(
+    async_redis,
+    error_rate=upstream_breaker.error_rate,
+    slow_rate=upstream_breaker.slow_rate,
+    slow_call_seconds=upstream_breaker.slow_call_seconds,
+    min_calls=upstream_breaker.min_calls,
+    window=upstream_breaker.window,
+    open_seconds=upstream_breaker.open_seconds)
+
+# Weather providers, preferred first, the fastest one is asked first and
+# slow answers are hedged with the next one
+upstream_router = ProviderRouter(
+    providers_from_names(os.getenv('UPSTREAM_PROVIDERS', 'visualcrossing')),
+    upstream_breaker,
+    hedge_delay=float(os.getenv('HEDGE_DELAY', '1')),
+    hedge_quantile=float(os.getenv('HEDGE_QUANTILE', '0.95')),
+    workers=int(os.getenv('HEDGE_WORKERS', '32')))
+async_upstream_router = AsyncProviderRouter(
+    upstream_router.providers,
+    async_upstream_breaker,
+    tracker=upstream_router.tracker,
+    hedge_delay=upstream_router.hedge_delay_default,
+    hedge_quantile=upstream_router.hedge_quantile)
+
+# Forecast changes pushed to the clients subscribed to them
+stream_hub = StreamHub(
+    interval=float(os.getenv('STREAM_INTERVAL', '60')),
+    queue_size=int(os.getenv('STREAM_QUEUE_SIZE', '64')),
+    max_subscribers=int(os.getenv('STREAM_MAX_SUBSCRIBERS', '100')))
+
+# Completed hours of the fetched documents, kept on local disk
+# under HISTORY_DIR, or the instance folder of the app (see init_app)
+history = HistoryStore()
+
+# Client locations resolved to the one their cache entry is stored under
+locations = Gazetteer(
+    os.getenv('GAZETTEER_PATH'),
+    precision=int(os.getenv('GEOHASH_PRECISION', '5')),
+    cache_size=int(os.getenv('LOCATION_CACHE_SIZE', '65536')))
+
+# API keys of our own clients and their rate limits
+api_keys = ApiKeyAuth(
+    redis, cache_ttl=float(os.getenv('API_KEY_CACHE_TTL', '60')))
+async_api_keys = AsyncApiKeyAuth(
+    async_redis, cache_ttl=api_keys.clients.max_ttl)
@@ -0,0 +1,242 @@
+"""
+Local store of the hourly weather of the cities we fetch forecasts for.
+
+Forecast documents are dropped from the cache once they expire, the
+hours they hold that have already happened are appended here instead.
+Each city is a directory of append-only columns, one file of int64 local
+timestamps and one file of float64 values per element, NaN when missing.
+Reads memory-map the columns and binary search the timestamps, so a
+range query only touches the rows it returns.
+"""
+import fcntl
+import math
+import mmap
+import os
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional, Sequence
+from urllib.parse import quote
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+# Hourly elements of timeline documents kept, all numeric
+DEFAULT_ELEMENTS = ("temp", "feelslike", "humidity", "dew", "precip", "snow",
+                    "windspeed", "windgust", "winddir", "pressure", "cloudcover",
+                    "visibility", "uvindex", "solarradiation")
+# Aggregates of the daily summaries
+AGGREGATES = ("min", "max", "mean")
+
+EPOCH_COLUMN = "epoch"
+
+
+class HistoryQueryError(ValueError):
+    """A history range or element that cannot be answered."""
+
+
+def parse_range(start: Optional[str], end: Optional[str], today: date,
+                max_days: int) -> tuple[date, date]:
+    """
+    Days of a history query, the last week by default.
+    :raises HistoryQueryError: for malformed, reversed or too long ranges
+    """
+    try:
+        last = date.fromisoformat(end) if end else today
+        first = date.fromisoformat(start) if start else date.fromordinal(
+            last.toordinal() - 6)
+    except ValueError as error:
+        raise HistoryQueryError(f"Dates are expected as YYYY-MM-DD: {error}") from error
+    if first > last:
+        raise HistoryQueryError("`from` is after `to`")
+    if (last - first).days >= max_days:
+        raise HistoryQueryError(f"At most {max_days} days per history query")
+    return first, last
+
+
+def local_epoch(day: str, hour: str) -> Optional[int]:
+    """Seconds since 1970 of a local date and time, as if it were UTC."""
+    try:
+        moment = datetime.fromisoformat(f"{day}T{hour}")
+    except (TypeError, ValueError):
+        return None
+    return int(moment.replace(tzinfo=timezone.utc).timestamp())
+
+
+def day_epoch(day: date) -> int:
+    """local_epoch of midnight."""
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
+
+
+def format_epoch(epoch: int) -> str:
+    """Local date and time of a local_epoch."""
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def as_float(value) -> float:
+    """Stored value of an element, NaN when missing or not a number."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return math.nan
+
+
+def completed_hours(data, fetched_at: float) -> list[tuple[int, dict]]:
+    """
+    Hours of a timeline document over when it was fetched, by local_epoch.
+    Documents without a timezone offset tell nothing of what is over.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("tzoffset"), (int, float)):
+        return []
+    now = fetched_at + data["tzoffset"] * HOUR
+    hours = []
+    for day in data.get("days") or ():
+        for hour in day.get("hours") or ():
+            epoch = local_epoch(day.get("datetime"), hour.get("datetime"))
+            if epoch is not None and epoch + HOUR <= now:
+                hours.append((epoch, hour))
+    return sorted(hours, key=lambda item: item[0])
+
+
+@contextmanager
+def mapped(path: Path, typecode: str) -> Iterator[Sequence]:
+    """Memory-mapped column, empty when the file is missing."""
+    try:
+        column = path.open("rb")
+    except FileNotFoundError:
+        yield ()
+        return
+    with column:
+        if column.seek(0, 2) == 0:
+            yield ()
+            return
+        with mmap.mmap(column.fileno(), 0, access=mmap.ACCESS_READ) as memory:
+            view = memoryview(memory).cast(typecode)
+            try:
+                yield view
+            finally:
+                view.release()
+
+
+def summarize(values: list[float]) -> tuple[Optional[float], ...]:
+    """(min, max, mean) of the values of a day, missing ones left out."""
+    known = [value for value in values if not math.isnan(value)]
+    if not known:
+        return None, None, None
+    return min(known), max(known), round(sum(known) / len(known), 2)
+
+
+class HistoryStore:
+    """Append-only columnar files of the completed hours of each city."""
+
+    def __init__(self, root: Optional[str] = None,
+                 elements: Sequence[str] = DEFAULT_ELEMENTS):
+        """
+        :param root: directory holding a directory per city, set by
+            init_app when not given
+        :param elements: hourly elements stored
+        """
+        self.root = Path(root) if root else None
+        self.elements = tuple(elements)
+
+    def init_app(self, app) -> None:
+        """
+        Store under HISTORY_DIR, the history directory of the app instance
+        folder by default, never relative to the working directory.
+        """
+        app.config.setdefault("HISTORY_DIR", os.getenv("HISTORY_DIR")
+                              or os.path.join(app.instance_path, "history"))
+        self.root = Path(app.config["HISTORY_DIR"])
+
+    def directory(self, city: str) -> Path:
+        """Directory of the columns of a city."""
+        return self.root / quote(city, safe="")
+
+    @contextmanager
+    def _locked(self, directory: Path) -> Iterator[None]:
+        """Hold the append lock of a city, shared by all worker processes."""
+        directory.mkdir(parents=True, exist_ok=True)
+        with (directory / "lock").open("a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def record(self, city: str, data, fetched_at: float) -> int:
+        """
+        Append the hours of a timeline document that are over and newer
+        than the last one stored.
+        :param fetched_at: when the document was fetched, unix time
+        :returns: number of hours appended
+        """
+        hours = completed_hours(data, fetched_at)
+        if not hours:
+            return 0
+        directory = self.directory(city)
+        with self._locked(directory):
+            epochs = directory / EPOCH_COLUMN
+            rows = epochs.stat().st_size // 8 if epochs.exists() else 0
+            with mapped(epochs, "q") as stored:
+                last = stored[-1] if rows else None
+            if last is not None:
+                hours = [(epoch, hour) for epoch, hour in hours if epoch > last]
+            if not hours:
+                return 0
+            # values first, the timestamps make the rows visible
+            for element in self.elements:
+                self._append(directory / element, rows,
+                             array("d", (as_float(hour.get(element)) for _, hour in hours)))
+            with epochs.open("ab") as column:
+                array("q", (epoch for epoch, _ in hours)).tofile(column)
+        return len(hours)
+
+    @staticmethod
+    def _append(path: Path, rows: int, values: array) -> None:
+        """Append to a column, aligned on `rows` stored timestamps first."""
+        size = path.stat().st_size // 8 if path.exists() else 0
+        with path.open("ab") as column:
+            if size > rows:
+                # left over by an append that did not finish
+                column.truncate(rows * 8)
+            elif size < rows:
+                # element stored since fewer rows than the others
+                array("d", [math.nan] * (rows - size)).tofile(column)
+            values.tofile(column)
+
+    def hours(self, city: str, start: date, end: date,
+              elements: Sequence[str]) -> tuple[list[int], dict[str, list[float]]]:
+        """
+        Stored hours of the days from `start` to `end`, both included.
+        :returns: local_epoch of the hours and the values of each element
+        """
+        directory = self.directory(city)
+        with mapped(directory / EPOCH_COLUMN, "q") as epochs:
+            low = bisect_left(epochs, day_epoch(start))
+            high = bisect_left(epochs, day_epoch(end) + DAY)
+            selected = list(epochs[low:high])
+        values = {}
+        for element in elements:
+            with mapped(directory / element, "d") as column:
+                found = list(column[low:min(high, len(column))])
+            values[element] = found + [math.nan] * (len(selected) - len(found))
+        return selected, values
+
+    def days(self, city: str, start: date, end: date, elements: Sequence[str]
+             ) -> tuple[list[int], dict[str, dict[str, list]]]:
+        """
+        Daily min, max and mean of the stored hours from `start` to `end`.
+        :returns: local_epoch of the days and the aggregates of each element
+        """
+        epochs, values = self.hours(city, start, end, elements)
+        # index of the first hour of each day
+        starts = [index for index, epoch in enumerate(epochs)
+                  if index == 0 or epoch // DAY != epochs[index - 1] // DAY]
+        bounds = list(zip(starts, starts[1:] + [len(epochs)]))
+        summaries = {}
+        for element in elements:
+            daily = [summarize(values[element][first:last]) for first, last in bounds]
+            summaries[element] = {aggregate: [day[position] for day in daily]
+                                  for position, aggregate in enumerate(AGGREGATES)}
+        return [epochs[first] // DAY * DAY for first in starts], summaries
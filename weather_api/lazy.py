@@ -0,0 +1,49 @@
+"""
+Clients created on first use rather than when the package is imported.
+"""
+import threading
+from typing import Any, Callable, Generic, Optional, TypeVar
+
+Client = TypeVar("Client")
+
+
+class LazyClient(Generic[Client]):
+    """
+    Stand-in for a client, built by `factory` the first time one of its
+    attributes is used. Importing the app and creating it do no I/O and
+    need no configuration of the services it talks to.
+    """
+
+    def __init__(self, factory: Callable[[], Client], name: str):
+        """
+        :param factory: builds the client
+        :param name: what the client talks to, for logs and readiness checks
+        """
+        self._factory = factory
+        self._name = name
+        self._client: Optional[Client] = None
+        self._lock = threading.Lock()
+
+    @property
+    def created(self) -> bool:
+        """Whether the client was built already."""
+        return self._client is not None
+
+    def resolve(self) -> Client:
+        """The client, built once."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, attribute: str) -> Any:
+        # only called for what the proxy itself does not have, private
+        # names are left alone so copies of a proxy never recurse here
+        if attribute.startswith("_"):
+            raise AttributeError(attribute)
+        return getattr(self.resolve(), attribute)
+
+    def __repr__(self) -> str:
+        state = "created" if self.created else "not created"
+        return f"<LazyClient {self._name} ({state})>"
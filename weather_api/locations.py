@@ -0,0 +1,233 @@
+"""
+Resolve the locations clients ask for to the one their cache entry is
+stored under.
+
+"London", "london", " LONDON " and "London,UK" are the same city and
+share a cache entry, so do coordinates a few hundred meters apart.
+Names are looked up in an alias index built from a local gazetteer file,
+coordinates are snapped to the center of their geohash cell.
+"""
+import csv
+import logging
+import re
+import threading
+import unicodedata
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Small gazetteer of major cities shipped with the app, GAZETTEER_PATH
+# can point to a larger one (same csv columns, or a GeoNames cities dump)
+DEFAULT_GAZETTEER = Path(__file__).parent / "data" / "gazetteer.csv"
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+COORDINATES = re.compile(r"^\s*([-+]?\d{1,3}(?:\.\d+)?)\s*,\s*([-+]?\d{1,3}(?:\.\d+)?)\s*$")
+
+# Country names and codes people write after a city, by ISO 3166 code.
+# The code itself and the gazetteer country column are always accepted.
+COUNTRY_ALIASES = {
+    "uk": "GB", "united kingdom": "GB", "great britain": "GB", "england": "GB",
+    "scotland": "GB", "wales": "GB",
+    "usa": "US", "united states": "US", "america": "US",
+    "uae": "AE", "deutschland": "DE", "germany": "DE", "france": "FR",
+    "spain": "ES", "italy": "IT", "canada": "CA", "australia": "AU",
+    "romania": "RO", "norway": "NO", "japan": "JP", "netherlands": "NL",
+}
+
+
+class Place(NamedTuple):
+    """A city of the gazetteer."""
+    name: str
+    country: str
+    latitude: float
+    longitude: float
+    population: int = 0
+    aliases: tuple = ()
+
+
+class Location(NamedTuple):
+    """What a client asked for, resolved."""
+    # canonical location, the cache entry is stored under it and it is
+    # what the 3rd party API is asked for
+    name: str
+    # known coordinates, None for names missing from the gazetteer
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+
+    @property
+    def coordinates(self) -> Optional[tuple[float, float]]:
+        """(latitude, longitude) when known."""
+        if self.latitude is None:
+            return None
+        return self.latitude, self.longitude
+
+
+def fold(text: str) -> str:
+    """Lookup form of a name: no accents, case or repeated spaces."""
+    decomposed = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return ", ".join(" ".join(part.split()) for part in text.casefold().split(","))
+
+
+def tidy(text: str) -> str:
+    """Canonical spelling of a name missing from the gazetteer."""
+    return ",".join(" ".join(part.split()).title() for part in text.split(",")
+                    if part.strip())
+
+
+def geohash_encode(latitude: float, longitude: float, precision: int) -> str:
+    """Geohash of a point with `precision` characters."""
+    ranges = [[-90.0, 90.0], [-180.0, 180.0]]
+    value, bits, geohash = 0, 0, []
+    even = True
+    while len(geohash) < precision:
+        # bits alternate between longitude and latitude, longitude first
+        interval = ranges[1] if even else ranges[0]
+        point = longitude if even else latitude
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if point >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            geohash.append(GEOHASH_ALPHABET[value])
+            value, bits = 0, 0
+    return "".join(geohash)
+
+
+def geohash_bounds(geohash: str) -> tuple[tuple[float, float], tuple[float, float]]:
+    """((south, north), (west, east)) of a geohash cell."""
+    ranges = [[-90.0, 90.0], [-180.0, 180.0]]
+    even = True
+    for char in geohash:
+        value = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            interval = ranges[1] if even else ranges[0]
+            middle = (interval[0] + interval[1]) / 2
+            interval[0 if value >> shift & 1 else 1] = middle
+            even = not even
+    return tuple(ranges[0]), tuple(ranges[1])
+
+
+def snap(latitude: float, longitude: float, precision: int) -> tuple[float, float]:
+    """Center of the geohash cell of a point, rounded to the cell size."""
+    (south, north), (west, east) = geohash_bounds(
+        geohash_encode(latitude, longitude, precision))
+    # a precision 5 cell is ~5km wide, 3 decimals are already ~100m
+    decimals = max(1, min(6, precision - 2))
+    return round((south + north) / 2, decimals), round((west + east) / 2, decimals)
+
+
+def read_csv(path: Path) -> Iterator[Place]:
+    """Places of a gazetteer csv, aliases separated by |"""
+    with path.open(encoding="utf-8", newline="") as rows:
+        for row in csv.DictReader(rows):
+            yield Place(row["name"], row["country"].upper(), float(row["latitude"]),
+                        float(row["longitude"]), int(row.get("population") or 0),
+                        tuple(filter(None, (row.get("aliases") or "").split("|"))))
+
+
+def read_geonames(path: Path) -> Iterator[Place]:
+    """Places of a GeoNames cities dump (cities15000.txt and the like)."""
+    with path.open(encoding="utf-8") as rows:
+        for line in rows:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) < 15:
+                continue
+            yield Place(columns[1], columns[8].upper(), float(columns[4]),
+                        float(columns[5]), int(columns[14] or 0),
+                        (columns[2], *filter(None, columns[3].split(","))))
+
+
+class Gazetteer:
+    """
+    Alias index of a gazetteer and the resolution of client locations.
+    The file is read on first use, resolutions are kept in an LRU.
+    """
+
+    def __init__(self, path: Optional[str] = None, precision: int = 5,
+                 cache_size: int = 65536):
+        """
+        :param path: gazetteer file, csv or GeoNames txt, DEFAULT_GAZETTEER if None
+        :param precision: geohash characters coordinates are snapped to,
+            5 is a ~5km cell, 0 disables snapping
+        :param cache_size: resolutions kept in process
+        """
+        self.path = Path(path) if path else DEFAULT_GAZETTEER
+        self.precision = precision
+        # folded alias -> places called so, most populated first
+        self._index: Optional[dict[str, list[Place]]] = None
+        self._lock = threading.Lock()
+        self.resolve = lru_cache(maxsize=cache_size)(self._resolve)
+
+    def places(self) -> Iterator[Place]:
+        """Places of the gazetteer file, none if it cannot be read."""
+        reader = read_geonames if self.path.suffix in (".txt", ".tsv") else read_csv
+        try:
+            yield from reader(self.path)
+        except (OSError, ValueError, KeyError) as error:
+            logger.error("Gazetteer %s unusable: %s", self.path, error)
+
+    def index(self) -> dict[str, list[Place]]:
+        """Alias index, built once."""
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    index: dict[str, list[Place]] = {}
+                    for place in self.places():
+                        for alias in {fold(name) for name in (place.name, *place.aliases)}:
+                            index.setdefault(alias, []).append(place)
+                    for places in index.values():
+                        places.sort(key=lambda place: -place.population)
+                    logger.info("Gazetteer loaded", extra={
+                        "path": str(self.path), "aliases": len(index)})
+                    self._index = index
+        return self._index
+
+    def place_location(self, place: Place, qualified: bool) -> Location:
+        """
+        Location of a gazetteer place, named like the 3rd party API knows it.
+        :param qualified: name the country, the place is not the most
+            populated one of its name
+        """
+        name = f"{place.name},{place.country}" if qualified else place.name
+        return Location(name, place.latitude, place.longitude)
+
+    def lookup(self, folded: str) -> Optional[Location]:
+        """Location of a folded name, optionally followed by a country."""
+        index = self.index()
+        places = index.get(folded)
+        if places:
+            return self.place_location(places[0], False)
+        name, _, qualifier = folded.rpartition(",")
+        if not name:
+            return None
+        qualifier = qualifier.strip()
+        country = COUNTRY_ALIASES.get(qualifier, qualifier.upper())
+        for rank, place in enumerate(index.get(name.strip(), ())):
+            if place.country == country:
+                return self.place_location(place, rank > 0)
+        return None
+
+    def _resolve(self, text: str) -> Location:
+        """
+        Resolve a client location: coordinates, a known alias or a name
+        only tidied up, the 3rd party API being left to find it.
+        """
+        match = COORDINATES.match(text)
+        if match:
+            latitude, longitude = float(match[1]), float(match[2])
+            if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+                if self.precision:
+                    latitude, longitude = snap(latitude, longitude, self.precision)
+                return Location(f"{latitude},{longitude}", latitude, longitude)
+        location = self.lookup(fold(text))
+        if location is not None:
+            return location
+        return Location(tidy(text) or text)
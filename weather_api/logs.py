@@ -0,0 +1,66 @@
+"""
+Structured, level gated logging that never blocks request threads.
+
+Records are formatted as one JSON object per line, fields passed with
+`extra=` included. Request threads only put records on a queue, a
+listener thread does the writing.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+# Attributes every LogRecord has, anything else was passed with extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        document = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        document.update((key, value) for key, value in vars(record).items()
+                        if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+
+def configure_logging(loggers: tuple[str, ...] = ("weather_api",),
+                      level: Optional[str] = None) -> None:
+    """
+    Send records of `loggers` through a queue to stderr, once per process.
+    :param level: minimum level, LOG_LEVEL or INFO by default
+    LOG_FORMAT=text switches to plain text lines for local development.
+    """
+    global _listener  # pylint: disable=global-statement
+    if _listener is not None:
+        return
+    handler = logging.StreamHandler()
+    if os.getenv("LOG_FORMAT", "json").lower() == "text":
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    else:
+        handler.setFormatter(JsonFormatter())
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    _listener = QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    queue_handler = QueueHandler(records)
+    for name in loggers:
+        logger = logging.getLogger(name)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+        if logger.level == logging.NOTSET:
+            logger.setLevel(level or os.getenv("LOG_LEVEL", "INFO").upper())
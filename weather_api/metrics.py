@@ -0,0 +1,168 @@
+"""
+Prometheus metrics of the request hot path, served on /metrics.
+
+Run with PROMETHEUS_MULTIPROC_DIR set when the app is served by several
+worker processes, /metrics then aggregates the samples of all of them.
+"""
+import os
+import time
+
+from flask import Response, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+# Hot path operations take from microseconds (local tier) to seconds
+# (upstream), the default buckets start at 5ms
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_LATENCY = Histogram(
+    "weather_request_duration_seconds", "Time to answer a request.",
+    ["endpoint", "method"], buckets=BUCKETS)
+REQUESTS = Counter(
+    "weather_requests_total", "Requests answered, by status code.",
+    ["endpoint", "status"])
+CACHE_LATENCY = Histogram(
+    "weather_cache_duration_seconds", "Time of a cache operation, by tier.",
+    ["operation", "tier"], buckets=BUCKETS)
+CACHE_LOOKUPS = Counter(
+    "weather_cache_lookups_total",
+    "Cache lookups of the services, result is hit, stale, expired, miss, "
+    "shared or not_modified.",
+    ["endpoint", "result"])
+CACHE_TIER_LOOKUPS = Counter(
+    "weather_cache_tier_lookups_total",
+    "Reads of the cache backend by tier, the redis tier only sees L1 misses.",
+    ["tier", "result"])
+UPSTREAM_LATENCY = Histogram(
+    "weather_upstream_duration_seconds", "Time of a 3rd party API call.",
+    ["endpoint"], buckets=BUCKETS)
+UPSTREAM_ERRORS = Counter(
+    "weather_upstream_errors_total",
+    "Failed 3rd party API calls, by status code or exception.",
+    ["endpoint", "status"])
+SERIALIZATION_LATENCY = Histogram(
+    "weather_serialization_duration_seconds",
+    "Time to encode or decode JSON and cache values.",
+    ["operation"], buckets=BUCKETS)
+UPSTREAM_POOL_REQUESTS = Gauge(
+    "weather_upstream_pool_requests",
+    "Requests sent through the keep-alive pool of an upstream host.",
+    ["host"], multiprocess_mode="livesum")
+UPSTREAM_POOL_CONNECTIONS = Gauge(
+    "weather_upstream_pool_connections",
+    "Connections opened to an upstream host, requests not sent on a reused one.",
+    ["host"], multiprocess_mode="livesum")
+UPSTREAM_POOL_IDLE = Gauge(
+    "weather_upstream_pool_idle_connections",
+    "Keep-alive connections to an upstream host waiting in the pool.",
+    ["host"], multiprocess_mode="livesum")
+UPSTREAM_CALLS_SAVED = Counter(
+    "weather_upstream_calls_saved_total",
+    "Upstream calls not made, the answer being part of a cached timeline.",
+    ["endpoint"])
+UPSTREAM_RECORDS_SAVED = Counter(
+    "weather_upstream_records_saved_total",
+    "Upstream records the calls not made would have been billed.",
+    ["endpoint"])
+UPSTREAM_BUDGET_REMAINING = Gauge(
+    "weather_upstream_budget_remaining_records",
+    "Upstream records left in today's budget, as last seen.",
+    multiprocess_mode="mostrecent")
+PROVIDER_LATENCY = Histogram(
+    "weather_provider_duration_seconds",
+    "Time of a call to one weather provider, hedged calls included.",
+    ["provider", "endpoint"], buckets=BUCKETS)
+HEDGED_REQUESTS = Counter(
+    "weather_hedged_requests_total",
+    "Queries also sent to another provider, by the slow or failed primary.",
+    ["provider"])
+CIRCUIT_STATE = Gauge(
+    "weather_circuit_state",
+    "Upstream circuit breaker state: 0 closed, 1 open, 2 half open.",
+    ["circuit"], multiprocess_mode="mostrecent")
+CIRCUIT_REJECTIONS = Counter(
+    "weather_circuit_rejections_total",
+    "Upstream calls failed fast by an open circuit breaker.",
+    ["circuit"])
+STREAM_SUBSCRIBERS = Gauge(
+    "weather_stream_subscribers",
+    "Clients subscribed to forecast changes.",
+    multiprocess_mode="livesum")
+STREAM_EVENTS = Counter(
+    "weather_stream_events_total",
+    "Forecast events queued to stream subscribers, by event.",
+    ["event"])
+REFRESH_JOBS = Counter(
+    "weather_refresh_jobs_total",
+    "Background refresh jobs run, result is refreshed, skipped, failed or quota.",
+    ["result"])
+REFRESH_QUEUE_LAG = Histogram(
+    "weather_refresh_queue_lag_seconds",
+    "Time a refresh job waited in the queue before a worker took it.",
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0))
+REFRESH_QUEUE_DEPTH = Gauge(
+    "weather_refresh_queue_depth",
+    "Refresh jobs queued, as of the last scheduler pass.",
+    multiprocess_mode="mostrecent")
+STARTUP_SECONDS = Gauge(
+    "weather_startup_seconds",
+    "Time create_app took in this worker, connections excluded.",
+    multiprocess_mode="max")
+
+# Children of the hottest label combinations, resolved once
+CACHE_GET_L1 = CACHE_LATENCY.labels("get", "l1")
+CACHE_GET_REDIS = CACHE_LATENCY.labels("get", "redis")
+CACHE_GET_MANY = CACHE_LATENCY.labels("get_many", "redis")
+CACHE_SET = CACHE_LATENCY.labels("set", "redis")
+L1_HITS = CACHE_TIER_LOOKUPS.labels("l1", "hit")
+L1_MISSES = CACHE_TIER_LOOKUPS.labels("l1", "miss")
+REDIS_HITS = CACHE_TIER_LOOKUPS.labels("redis", "hit")
+REDIS_MISSES = CACHE_TIER_LOOKUPS.labels("redis", "miss")
+JSON_ENCODE = SERIALIZATION_LATENCY.labels("json_encode")
+JSON_DECODE = SERIALIZATION_LATENCY.labels("json_decode")
+CODEC_ENCODE = SERIALIZATION_LATENCY.labels("codec_encode")
+CODEC_DECODE = SERIALIZATION_LATENCY.labels("codec_decode")
+
+
+def registry() -> CollectorRegistry:
+    """Registry to expose, aggregating worker processes when configured."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        collected = CollectorRegistry()
+        multiprocess.MultiProcessCollector(collected)
+        return collected
+    return REGISTRY
+
+
+def render() -> tuple[bytes, str]:
+    """:returns: the exposition body and its content type"""
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def observe_request(endpoint: str, method: str, status: int, started: float) -> None:
+    """Record a request answered `started` perf_counter seconds ago."""
+    REQUEST_LATENCY.labels(endpoint, method).observe(time.perf_counter() - started)
+    REQUESTS.labels(endpoint, str(status)).inc()
+
+
+def init_app(app) -> None:
+    """Time every request and serve the metrics on /metrics."""
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop("request_started", None)
+        if started is not None:
+            observe_request(request.endpoint or "unknown", request.method,
+                            response.status_code, started)
+        return response
+
+    def metrics():
+        body, content_type = render()
+        return Response(body, content_type=content_type)
+
+    app.add_url_rule("/metrics", "metrics", metrics)
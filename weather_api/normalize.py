@@ -0,0 +1,217 @@
+"""
+Normalize timeline documents into a compact, provider independent,
+columnar format with unit conversion.
+
+Rows of the upstream document are turned into one column per element,
+numeric columns are kept in `array` buffers so conversions and derived
+fields run column by column with C level iteration instead of a Python
+loop per hour.
+"""
+import json
+import math
+import os
+from array import array
+from dataclasses import dataclass, field
+from itertools import repeat
+from operator import add, mul, sub
+from typing import Union
+
+from .payload import CachedPayload, derive_etag
+from .tiered_cache import LocalLRU
+
+Column = Union[array, list]
+
+# Location fields copied as they are
+LOCATION_FIELDS = ("address", "resolvedAddress", "latitude", "longitude",
+                   "timezone", "tzoffset")
+
+# dimension -> elements measured in it, upstream is always queried in metric
+DIMENSIONS = {
+    "temperature": ("temp", "tempmax", "tempmin", "feelslike", "feelslikemax",
+                    "feelslikemin", "dew"),
+    "speed": ("windspeed", "windgust", "windspeedmax", "windspeedmean",
+              "windspeedmin"),
+    "precipitation": ("precip",),
+    "snow": ("snow", "snowdepth"),
+    "distance": ("visibility",),
+}
+# dimension -> unit -> (factor, offset) applied to the metric value
+CONVERSIONS = {
+    "temperature": {"C": (1.0, 0.0), "F": (1.8, 32.0)},
+    "speed": {"km/h": (1.0, 0.0), "mph": (0.621371, 0.0)},
+    "precipitation": {"mm": (1.0, 0.0), "in": (1 / 25.4, 0.0)},
+    "snow": {"cm": (1.0, 0.0), "in": (1 / 2.54, 0.0)},
+    "distance": {"km": (1.0, 0.0), "mi": (0.621371, 0.0)},
+}
+# values of the `units` argument, named like the upstream unit groups
+UNIT_SYSTEMS = {
+    "metric": {"temperature": "C", "speed": "km/h", "precipitation": "mm",
+               "snow": "cm", "distance": "km"},
+    "us": {"temperature": "F", "speed": "mph", "precipitation": "in",
+           "snow": "in", "distance": "mi"},
+    "uk": {"temperature": "C", "speed": "mph", "precipitation": "mm",
+           "snow": "cm", "distance": "mi"},
+}
+# derived element -> (minuend, subtrahend), computed after conversion
+DERIVED = {
+    "temprange": ("tempmax", "tempmin"),
+    "dewspread": ("temp", "dew"),
+}
+# Decimals kept on converted and derived values
+PRECISION = 2
+
+# Columnar documents and their encoded conversions, only kept in process
+normalized = LocalLRU(
+    max_bytes=int(os.getenv("NORMALIZED_CACHE_BYTES", str(16 * 1024 * 1024))),
+    max_ttl=float(os.getenv("NORMALIZED_CACHE_TTL", "3600")))
+
+
+class UnknownUnitsError(ValueError):
+    """A `units` argument that is not one of UNIT_SYSTEMS."""
+
+
+@dataclass
+class ColumnarForecast:
+    """A timeline document as one set of columns per section."""
+    location: dict
+    # "current", "daily" and "hourly" -> element -> column
+    sections: dict[str, dict[str, Column]] = field(default_factory=dict)
+
+
+def check_units(units: str) -> str:
+    """
+    :returns: units, if they name one of UNIT_SYSTEMS
+    :raises UnknownUnitsError: otherwise
+    """
+    if units not in UNIT_SYSTEMS:
+        raise UnknownUnitsError(
+            f"Unknown units {units}, expected one of {', '.join(UNIT_SYSTEMS)}")
+    return units
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def to_columns(rows: list[dict]) -> dict[str, Column]:
+    """
+    Turn rows into columns, elements keep their first seen order.
+    Numeric elements become `array` columns, missing numbers are NaN.
+    """
+    names = dict.fromkeys(name for row in rows for name in row)
+    columns = {}
+    for name in names:
+        values = [row.get(name) for row in rows]
+        present = [value for value in values if value is not None]
+        if not present or not all(map(_is_number, present)):
+            columns[name] = values
+        elif len(present) == len(values) and all(isinstance(v, int) for v in present):
+            columns[name] = array("q", values)
+        else:
+            columns[name] = array("d", [math.nan if value is None else value
+                                        for value in values])
+    return columns
+
+
+def columnar(document: dict) -> ColumnarForecast:
+    """Build the columnar form of an upstream timeline document."""
+    forecast = ColumnarForecast(location={
+        name: document[name] for name in LOCATION_FIELDS if name in document})
+    current = document.get("currentConditions")
+    if current:
+        forecast.sections["current"] = to_columns([current])
+    days = document.get("days") or []
+    if days:
+        forecast.sections["daily"] = to_columns(
+            [{k: v for k, v in day.items() if k != "hours"} for day in days])
+    hours = [{"date": day.get("datetime"), **hour}
+             for day in days for hour in day.get("hours") or ()]
+    if hours:
+        forecast.sections["hourly"] = to_columns(hours)
+    return forecast
+
+
+def scale(column: array, factor: float, offset: float) -> array:
+    """`column * factor + offset`, rounded, as a new float column."""
+    values = column
+    if factor != 1.0:
+        values = map(mul, values, repeat(factor))
+    if offset:
+        values = map(add, values, repeat(offset))
+    return array("d", map(round, values, repeat(PRECISION)))
+
+
+def convert(forecast: ColumnarForecast, units: str) -> ColumnarForecast:
+    """
+    Convert a metric forecast to a unit system and add derived elements.
+    Unconverted columns are shared with the metric forecast.
+    """
+    system = UNIT_SYSTEMS[units]
+    converted = ColumnarForecast(location=forecast.location)
+    for section, columns in forecast.sections.items():
+        columns = dict(columns)
+        for dimension, names in DIMENSIONS.items():
+            factor, offset = CONVERSIONS[dimension][system[dimension]]
+            if factor == 1.0 and not offset:
+                continue
+            for name in names:
+                if isinstance(columns.get(name), array):
+                    columns[name] = scale(columns[name], factor, offset)
+        for name, (left, right) in DERIVED.items():
+            if isinstance(columns.get(left), array) and isinstance(columns.get(right), array):
+                columns[name] = array("d", map(
+                    round, map(sub, columns[left], columns[right]), repeat(PRECISION)))
+        converted.sections[section] = columns
+    return converted
+
+
+def _column_json(column: Column) -> list:
+    if not isinstance(column, array):
+        return column
+    values = column.tolist()
+    if column.typecode == "d" and any(map(math.isnan, column)):
+        return [None if math.isnan(value) else value for value in values]
+    return values
+
+
+def to_document(forecast: ColumnarForecast, units: str) -> dict:
+    """
+    JSON document of a converted forecast. The current section holds
+    single values, the other sections hold one list per element.
+    """
+    document = {"location": forecast.location, "units": UNIT_SYSTEMS[units]}
+    for section, columns in forecast.sections.items():
+        encoded = {name: _column_json(column) for name, column in columns.items()}
+        if section == "current":
+            encoded = {name: values[0] for name, values in encoded.items()}
+        document[section] = encoded
+    return document
+
+
+def normalized_etag(etag: str, units: str) -> str:
+    """ETag of the normalized form of a payload, without normalizing it."""
+    return derive_etag(etag, "normalized=" + units)
+
+
+def normalize_payload(payload: CachedPayload, units: str = "metric") -> CachedPayload:
+    """
+    Normalize a cached upstream payload to a unit system.
+    The columnar form is built once per payload and every conversion of
+    it is encoded once, for as long as the payload is the same.
+    :raises UnknownUnitsError: for units not in UNIT_SYSTEMS
+    """
+    check_units(units)
+    key = f"{payload.etag}|{units}"
+    encoded = normalized.get(key)
+    if encoded is None:
+        columns_key = f"{payload.etag}|columns"
+        forecast = normalized.get(columns_key)
+        if forecast is None:
+            forecast = columnar(json.loads(payload.body))
+            normalized.set(columns_key, forecast, payload.content_length,
+                           normalized.max_ttl)
+        encoded = CachedPayload.from_data(
+            to_document(convert(forecast, units), units),
+            created_at=payload.created_at, etag=normalized_etag(payload.etag, units))
+        normalized.set(key, encoded, encoded.content_length, normalized.max_ttl)
+    return encoded.as_stale() if payload.stale else encoded
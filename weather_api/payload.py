@@ -0,0 +1,243 @@
+"""
+Cached response bodies, encoded once when written to the cache.
+"""
+import gzip
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import brotli
+from werkzeug.http import http_date, parse_accept_header
+
+from . import metrics
+
+# Send payloads gzip compressed to clients accepting it
+PRECOMPRESS = os.getenv("PAYLOAD_GZIP", "true").lower() == "true"
+# Send them brotli compressed too, smaller than gzip for the same JSON and
+# the only body kept in Redis then
+PRECOMPRESS_BROTLI = os.getenv("PAYLOAD_BROTLI", "true").lower() == "true"
+# 11 is ~50 times slower than 5 for a few percent, the brotli body is
+# encoded on the upstream fetch path
+BROTLI_QUALITY = int(os.getenv("PAYLOAD_BROTLI_QUALITY", "5"))
+# Bodies smaller than this are not worth compressing
+PRECOMPRESS_MIN_SIZE = int(os.getenv("PAYLOAD_GZIP_MIN_SIZE", "1024"))
+# Content codings a payload may be sent with, besides identity
+CODINGS = ("br", "gzip")
+
+
+def derive_etag(etag: str, variant: str) -> str:
+    """
+    ETag of a representation computed from a cached payload, known from
+    the payload ETag alone.
+    :param variant: what was computed, like the projected elements
+    """
+    return hashlib.blake2b(f"{etag}|{variant}".encode(), digest_size=16).hexdigest()
+
+
+def coded_etag(etag: str, coding: Optional[str]) -> str:
+    """
+    ETag of the body of a payload in a content coding. Strong validators
+    have to differ between the bodies of different codings.
+    :param coding: content coding, None for the identity body
+    """
+    return f"{etag}-{coding}" if coding else etag
+
+
+def matching_etag(etags, etag: str) -> Optional[str]:
+    """
+    The ETag of a coding of a payload listed in an If-None-Match header.
+    :param etags: parsed If-None-Match header
+    :param etag: ETag of the payload
+    :returns: None if no coding of the payload is listed
+    """
+    for coding in (None, *CODINGS):
+        if etags.contains_weak(coded_etag(etag, coding)):
+            return coded_etag(etag, coding)
+    return None
+
+
+def cache_control(created_at: float, soft_ttl: int, hard_ttl: int,
+                  stale_if_error: int = 0) -> str:
+    """
+    Cache-Control of an entry fetched at `created_at`: fresh until its soft
+    TTL, then served stale while revalidating until its hard TTL.
+    """
+    age = max(0.0, time.time() - created_at)
+    max_age = max(0, int(soft_ttl - age))
+    revalidate = max(0, int(hard_ttl - max(age, soft_ttl)))
+    return (f"public, max-age={max_age}, stale-while-revalidate={revalidate}, "
+            f"stale-if-error={stale_if_error}")
+
+
+@dataclass(frozen=True, init=False)
+class CachedPayload:
+    """
+    Upstream JSON stored as compact bytes, ready to be sent as is.
+    The ETag and the codings worth compressing to are decided at write
+    time. Only the smallest body is kept in Redis, the identity and the
+    other coded bodies are rebuilt from it the first time they are sent,
+    and kept with the payload from then on.
+    """
+    etag: str
+    created_at: float
+    # served past its hard TTL because upstream is unavailable, never cached
+    stale: bool
+    # content codings the payload is sent with, preferred first
+    codings: tuple[str, ...]
+    _bodies: dict[Optional[str], bytes] = field(compare=False, repr=False)
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, body: Optional[bytes] = None, etag: str = "",
+                 gzip_body: Optional[bytes] = None, created_at: Optional[float] = None,
+                 stale: bool = False, br_body: Optional[bytes] = None,
+                 codings: Optional[tuple[str, ...]] = None):
+        """
+        :param body: identity body, rebuilt from a coded one when None
+        :param codings: codings offered, those of the given bodies by default
+        """
+        bodies = {coding: coded for coding, coded in
+                  ((None, body), ("br", br_body), ("gzip", gzip_body)) if coded is not None}
+        if not bodies:
+            raise ValueError("A payload needs at least one body")
+        if codings is None:
+            codings = tuple(coding for coding in CODINGS if coding in bodies)
+        object.__setattr__(self, "etag", etag)
+        object.__setattr__(self, "created_at", time.time() if created_at is None else created_at)
+        object.__setattr__(self, "stale", stale)
+        object.__setattr__(self, "codings", tuple(codings))
+        object.__setattr__(self, "_bodies", bodies)
+
+    @classmethod
+    def from_data(cls, data: Any, precompress: bool = PRECOMPRESS,
+                  created_at: Optional[float] = None, etag: Optional[str] = None,
+                  precompress_brotli: bool = PRECOMPRESS_BROTLI) -> "CachedPayload":
+        """
+        Encode a decoded JSON document.
+        :param data: JSON compatible upstream document
+        :param precompress: also send the body gzip compressed
+        :param created_at: when the data was fetched, defaults to now
+        :param etag: ETag of derived documents, the body hash by default
+        :param precompress_brotli: also send the body brotli compressed,
+            the body kept in Redis then
+        """
+        with metrics.JSON_ENCODE.time():
+            body = json.dumps(data, separators=(",", ":"),
+                              ensure_ascii=False).encode("utf-8")
+        codings = ()
+        if len(body) >= PRECOMPRESS_MIN_SIZE:
+            codings = tuple(coding for coding, enabled in
+                            (("br", precompress_brotli), ("gzip", precompress)) if enabled)
+        payload = cls(body=body, etag=etag or hashlib.blake2b(body, digest_size=16).hexdigest(),
+                      created_at=created_at, codings=codings)
+        if codings:
+            # the body Redis keeps is encoded on the write path
+            payload.coded_body(codings[0])
+        return payload
+
+    @property
+    def body(self) -> bytes:
+        """The identity body."""
+        return self.coded_body(None)
+
+    @property
+    def gzip_body(self) -> Optional[bytes]:
+        """The gzip body, None if the payload is not sent gzip compressed."""
+        return self.coded_body("gzip") if "gzip" in self.codings else None
+
+    @property
+    def br_body(self) -> Optional[bytes]:
+        """The brotli body, None if the payload is not sent brotli compressed."""
+        return self.coded_body("br") if "br" in self.codings else None
+
+    def stored_body(self) -> tuple[Optional[str], bytes]:
+        """The smallest body built so far and its coding, what Redis keeps."""
+        for coding in (*CODINGS, None):
+            if coding in self._bodies:
+                return coding, self._bodies[coding]
+        raise AssertionError("A payload has at least one body")
+
+    def coded_body(self, coding: Optional[str]) -> bytes:
+        """
+        The body in a content coding, built from another one once.
+        :param coding: one of CODINGS, None for the identity body
+        """
+        coded = self._bodies.get(coding)
+        if coded is not None:
+            return coded
+        if coding is None:
+            stored, coded = self.stored_body()
+            coded = brotli.decompress(coded) if stored == "br" else gzip.decompress(coded)
+        elif coding == "br":
+            coded = brotli.compress(self.body, mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+        else:
+            # a few ms for a 15 day forecast, once per payload read from
+            # Redis. mtime=0 keeps the body byte for byte reproducible
+            coded = gzip.compress(self.body, compresslevel=6, mtime=0)
+        # concurrent first uses build the same bytes
+        self._bodies[coding] = coded
+        return coded
+
+    @property
+    def content_length(self) -> int:
+        """Size of the identity body in bytes."""
+        return len(self.body)
+
+    def age(self) -> float:
+        """Seconds since the payload was fetched from upstream."""
+        return time.time() - self.created_at
+
+    def as_stale(self) -> "CachedPayload":
+        """The same payload, marked as served while upstream is unavailable."""
+        stale = object.__new__(CachedPayload)
+        # shares the bodies built so far, and those built later
+        stale.__dict__.update(self.__dict__, stale=True)
+        return stale
+
+    def __getstate__(self) -> dict:
+        """Pickle the stored body alone, like the cache codec does."""
+        return {**self.__dict__, "_bodies": dict([self.stored_body()])}
+
+    def json(self) -> Any:
+        """Decode the body, for the few callers that need the document."""
+        with metrics.JSON_DECODE.time():
+            return json.loads(self.body)
+
+    def variants(self) -> dict[str, bytes]:
+        """Compressed bodies by content coding, preferred first."""
+        return {coding: self.coded_body(coding) for coding in self.codings}
+
+    def representation(self, accept_encoding: Optional[str]) -> tuple[bytes, dict]:
+        """
+        Pick the coding matching an Accept-Encoding header.
+        :param accept_encoding: raw header value, None if absent
+        :returns: body to send and the headers describing it
+        """
+        coding = (parse_accept_header(accept_encoding).best_match(self.codings)
+                  if self.codings else None)
+        body = self.coded_body(coding)
+        headers = {"ETag": f'"{coded_etag(self.etag, coding)}"', "Vary": "Accept-Encoding",
+                   "Last-Modified": http_date(self.created_at)}
+        if coding is not None:
+            headers["Content-Encoding"] = coding
+        headers["Content-Length"] = str(len(body))
+        if self.stale:
+            headers["Age"] = str(int(self.age()))
+            headers["Warning"] = '110 - "Response is Stale"'
+        return body, headers
+
+
+def as_payload(cached_data: Any) -> Optional[CachedPayload]:
+    """
+    Turn a cache value into a payload.
+    :param cached_data: value read from cache, may be None
+    :returns: None for a miss, the payload otherwise
+    """
+    if not cached_data:
+        return None
+    if not isinstance(cached_data, CachedPayload):
+        # entry written before payloads were cached as bytes
+        cached_data = CachedPayload.from_data(cached_data)
+    return cached_data
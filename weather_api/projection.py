@@ -0,0 +1,131 @@
+"""
+Answer `elements` and today's weather requests by projecting fields out
+of a cached forecast.
+"""
+import os
+from typing import Optional
+
+from .payload import CachedPayload, derive_etag
+from .tiered_cache import LocalLRU
+
+# Elements the 3rd party API only returns when explicitly requested, a
+# full forecast cannot answer them so they need their own upstream call.
+ON_REQUEST_ELEMENTS = frozenset([
+    "aqius", "aqieur", "pm1", "pm2p5", "pm10", "o3", "no2", "so2", "co",
+    "degreedays", "accdegreedays", "windspeed50", "winddir50",
+    "windspeed80", "winddir80", "windspeed100", "winddir100",
+    "cape", "cin", "precipremote", "elevation",
+])
+# Always kept so projected rows can still be told apart
+KEY_ELEMENTS = ("datetime",)
+# Sections of the document holding per period rows
+ROW_SECTIONS = ("days", "hours", "currentConditions")
+
+# Projections are cheap to rebuild, only keep them in process memory
+projections = LocalLRU(
+    max_bytes=int(os.getenv("PROJECTION_CACHE_BYTES", str(16 * 1024 * 1024))),
+    max_ttl=float(os.getenv("PROJECTION_CACHE_TTL", "3600")))
+
+
+def needs_upstream(elements: list[str]) -> bool:
+    """Whether the elements cannot be projected out of a full forecast."""
+    return any(element in ON_REQUEST_ELEMENTS for element in elements)
+
+
+def project_rows(rows: list[dict], names: tuple[str, ...]) -> list[dict]:
+    """
+    Keep only some fields of a list of rows, one column at a time.
+    Fields a row does not have are left out of that row.
+    """
+    missing = object()
+    columns = [(name, [row.get(name, missing) for row in rows]) for name in names]
+    # drop columns no row has at all
+    columns = [(name, values) for name, values in columns
+               if any(value is not missing for value in values)]
+    projected = [{} for _ in rows]
+    for name, values in columns:
+        for row, value in zip(projected, values):
+            if value is not missing:
+                row[name] = value
+    return projected
+
+
+def project_document(document: dict, elements: list[str]) -> dict:
+    """
+    Restrict a timeline document to some elements, like the upstream
+    `elements` parameter does. Location fields are kept as they are.
+    """
+    names = tuple(dict.fromkeys((*KEY_ELEMENTS, *elements)))
+    projected = {key: value for key, value in document.items()
+                 if key not in ROW_SECTIONS}
+
+    days = document.get("days")
+    if days is not None:
+        projected["days"] = project_rows(days, names)
+        # every hour of every day projected as a single column set
+        hours = [hour for day in days for hour in day.get("hours", ())]
+        if hours:
+            hours = iter(project_rows(hours, names))
+            for day, projected_day in zip(days, projected["days"]):
+                if "hours" in day:
+                    projected_day["hours"] = [next(hours) for _ in day["hours"]]
+
+    current = document.get("currentConditions")
+    if current is not None:
+        projected["currentConditions"] = project_rows([current], names)[0]
+    return projected
+
+
+def projected_etag(etag: str, elements: list[str]) -> str:
+    """ETag of the projection of a forecast, without projecting it."""
+    return derive_etag(etag, "elements=" + ",".join(elements))
+
+
+def project_payload(payload: CachedPayload, elements: list[str]) -> CachedPayload:
+    """
+    Project elements out of a cached forecast payload.
+    Results are kept in process for as long as the forecast is the same.
+    """
+    key = f"{payload.etag}|{','.join(elements)}"
+    projected = projections.get(key)
+    if projected is None:
+        projected = CachedPayload.from_data(
+            project_document(payload.json(), elements),
+            created_at=payload.created_at, etag=projected_etag(payload.etag, elements))
+        projections.set(key, projected, len(projected.body), projections.max_ttl)
+    return projected.as_stale() if payload.stale else projected
+
+
+def today_document(document: dict) -> Optional[dict]:
+    """
+    Today's weather out of a timeline document, shaped like the upstream
+    answer of a `/today` call: the first day and the current conditions.
+    :returns: None when the document has no current conditions
+    """
+    if not isinstance(document, dict) or not document.get("currentConditions") \
+            or not document.get("days"):
+        return None
+    return {**document, "days": document["days"][:1]}
+
+
+def today_etag(etag: str) -> str:
+    """ETag of today's weather out of a timeline."""
+    return derive_etag(etag, "today")
+
+
+def today_payload(payload: CachedPayload) -> Optional[CachedPayload]:
+    """
+    Today's weather out of a cached timeline payload, kept in process for
+    as long as the timeline is the same. Timelines without current
+    conditions are remembered too, so they are only decoded once.
+    """
+    key = f"{payload.etag}|today"
+    today = projections.get(key)
+    if today is None:
+        document = today_document(payload.json())
+        today = False if document is None else CachedPayload.from_data(
+            document, created_at=payload.created_at, etag=today_etag(payload.etag))
+        projections.set(key, today, len(today.body) if today else 1, projections.max_ttl)
+    if not today:
+        return None
+    return today.as_stale() if payload.stale else today
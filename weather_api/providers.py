@@ -0,0 +1,681 @@
+"""
+Weather providers behind the upstream calls, and hedging between them.
+
+Every provider answers the same queries and its documents are normalized
+to the Visual Crossing timeline schema, the one cached and served, so
+providers can be swapped or combined without clients noticing.
+
+The provider with the best recent latency is asked first. When it has
+not answered within its own p95 latency, the same query is sent to the
+next one and whichever answers first successfully is used.
+"""
+import abc
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, timedelta
+from typing import NamedTuple, Optional
+
+import httpx
+import requests
+from requests.exceptions import RequestException
+
+from . import metrics
+from .breaker import CircuitOpenError, is_failure
+from .tiered_cache import LocalLRU
+
+logger = logging.getLogger(__name__)
+
+OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast"
+OPEN_METEO_GEOCODING_URL = "https://geocoding-api.open-meteo.com/v1/search"
+
+# Timeline elements and the Open-Meteo variables they are read from
+OPEN_METEO_DAILY = {
+    "tempmax": "temperature_2m_max",
+    "tempmin": "temperature_2m_min",
+    "temp": "temperature_2m_mean",
+    "feelslikemax": "apparent_temperature_max",
+    "feelslikemin": "apparent_temperature_min",
+    "precip": "precipitation_sum",
+    "precipprob": "precipitation_probability_max",
+    "snow": "snowfall_sum",
+    "windgust": "wind_gusts_10m_max",
+    "windspeed": "wind_speed_10m_max",
+    "winddir": "wind_direction_10m_dominant",
+    "uvindex": "uv_index_max",
+}
+OPEN_METEO_HOURLY = {
+    "temp": "temperature_2m",
+    "feelslike": "apparent_temperature",
+    "humidity": "relative_humidity_2m",
+    "dew": "dew_point_2m",
+    "precip": "precipitation",
+    "precipprob": "precipitation_probability",
+    "snow": "snowfall",
+    "windgust": "wind_gusts_10m",
+    "windspeed": "wind_speed_10m",
+    "winddir": "wind_direction_10m",
+    "pressure": "pressure_msl",
+    "cloudcover": "cloud_cover",
+    "uvindex": "uv_index",
+}
+OPEN_METEO_CURRENT = {
+    "temp": "temperature_2m",
+    "feelslike": "apparent_temperature",
+    "humidity": "relative_humidity_2m",
+    "precip": "precipitation",
+    "snow": "snowfall",
+    "windgust": "wind_gusts_10m",
+    "windspeed": "wind_speed_10m",
+    "winddir": "wind_direction_10m",
+    "pressure": "pressure_msl",
+    "cloudcover": "cloud_cover",
+}
+# WMO weather codes as timeline conditions and icons
+WMO_CONDITIONS = {
+    code: conditions
+    for codes, conditions in (
+        ((0,), ("Clear", "clear-day")),
+        ((1, 2), ("Partially cloudy", "partly-cloudy-day")),
+        ((3,), ("Overcast", "cloudy")),
+        ((45, 48), ("Fog", "fog")),
+        ((51, 53, 55, 56, 57), ("Drizzle", "rain")),
+        ((61, 63, 65, 66, 67, 80, 81, 82), ("Rain", "rain")),
+        ((71, 73, 75, 77, 85, 86), ("Snow", "snow")),
+        ((95, 96, 99), ("Thunderstorm", "thunder-rain")),
+    )
+    for code in codes
+}
+
+
+class ProviderError(RequestException):
+    """No configured provider can answer a query."""
+
+
+class Provider(abc.ABC):
+    """
+    A weather API answering upstream queries.
+    Subclasses fetch a query and normalize what they got to the timeline
+    schema, `billed` providers spend the upstream records budget.
+    """
+    name = "provider"
+    billed = False
+
+    def supports(self, query) -> bool:  # pylint: disable=unused-argument
+        """Whether the provider can answer a query at all."""
+        return True
+
+    @abc.abstractmethod
+    def fetch(self, client, query, timeout: float) -> requests.Response:
+        """Call the provider through the shared pooled client."""
+
+    @abc.abstractmethod
+    async def fetch_async(self, client, query, timeout: float) -> httpx.Response:
+        """Asyncio variant of fetch"""
+
+    def normalize(self, data, query):  # pylint: disable=unused-argument
+        """The decoded answer of the provider as a timeline document."""
+        return data
+
+
+class VisualCrossing(Provider):
+    """The timeline API the upstream queries are built for."""
+    name = "visualcrossing"
+    billed = True
+
+    def fetch(self, client, query, timeout: float) -> requests.Response:
+        return client.get(query.url, params=query.params, timeout=timeout)
+
+    async def fetch_async(self, client, query, timeout: float) -> httpx.Response:
+        return await client.get(query.url, params=query.params, timeout=timeout)
+
+
+class OpenMeteo(Provider):
+    """
+    Free Open-Meteo forecast API, located by coordinates. Cities missing
+    from the gazetteer are geocoded once and their coordinates kept in
+    process.
+    """
+    name = "openmeteo"
+
+    def __init__(self, url: str = OPEN_METEO_URL,
+                 geocoding_url: str = OPEN_METEO_GEOCODING_URL):
+        self.url = url
+        self.geocoding_url = geocoding_url
+        # coordinates barely change, unknown cities are kept as {}
+        self.locations = LocalLRU(max_bytes=4 * 1024 * 1024, max_ttl=86400)
+
+    def supports(self, query) -> bool:
+        # on request elements (air quality...) only exist upstream
+        return query.endpoint != "elements"
+
+    @staticmethod
+    def geocoding_params(city: str) -> dict:
+        """Parameters of the geocoding call of a city."""
+        return {"name": city, "count": 1, "language": "en", "format": "json"}
+
+    def remember_location(self, city: str, data: dict) -> dict:
+        """Keep the first geocoding result of a city."""
+        results = data.get("results") or [{}]
+        location = {key: results[0][key] for key in
+                    ("name", "country", "latitude", "longitude") if key in results[0]}
+        self.locations.set(city.lower(), location, 256, self.locations.max_ttl)
+        return location
+
+    def forecast_params(self, location: dict, query) -> dict:
+        """Parameters of the forecast call of a located query."""
+        params = {
+            "latitude": location["latitude"],
+            "longitude": location["longitude"],
+            "daily": ",".join(["weather_code", "sunrise", "sunset",
+                               *OPEN_METEO_DAILY.values()]),
+            "hourly": ",".join(["weather_code", "visibility", *OPEN_METEO_HOURLY.values()]),
+            "timezone": "auto",
+            "forecast_days": query.days,
+            # forecasts carry today's current conditions too, like timelines
+            "current": ",".join(["weather_code", *OPEN_METEO_CURRENT.values()]),
+        }
+        return params
+
+    @staticmethod
+    def unknown_location(city: str) -> requests.Response:
+        """Answer like the timeline API does for a city it cannot find."""
+        return stub_response(400, f"Bad API Request:Invalid location parameter value. {city}")
+
+    def known_location(self, query) -> Optional[dict]:
+        """Coordinates of a query, None until geocoded."""
+        if query.coordinates is not None:
+            return dict(zip(("latitude", "longitude"), query.coordinates))
+        return self.locations.get(query.city.lower())
+
+    def fetch(self, client, query, timeout: float) -> requests.Response:
+        location = self.known_location(query)
+        if location is None:
+            response = client.get(self.geocoding_url, params=self.geocoding_params(query.city),
+                                  timeout=timeout)
+            if not response.ok:
+                return response
+            location = self.remember_location(query.city, response.json())
+        if not location:
+            return self.unknown_location(query.city)
+        return client.get(self.url, params=self.forecast_params(location, query),
+                          timeout=timeout)
+
+    async def fetch_async(self, client, query, timeout: float) -> httpx.Response:
+        location = self.known_location(query)
+        if location is None:
+            response = await client.get(self.geocoding_url,
+                                        params=self.geocoding_params(query.city),
+                                        timeout=timeout)
+            if response.is_error:
+                return response
+            location = self.remember_location(query.city, response.json())
+        if not location:
+            response = self.unknown_location(query.city)
+            return httpx.Response(response.status_code, content=response.content)
+        return await client.get(self.url, params=self.forecast_params(location, query),
+                                timeout=timeout)
+
+    def normalize(self, data, query) -> dict:
+        location = self.known_location(query) or {}
+        daily = data.get("daily", {})
+        hours_by_day = open_meteo_hours(data.get("hourly", {}))
+        days = []
+        for index, day in enumerate(daily.get("time", [])):
+            row = {"datetime": day, **open_meteo_row(daily, OPEN_METEO_DAILY, index)}
+            for name in ("sunrise", "sunset"):
+                if daily.get(name):
+                    row[name] = daily[name][index][11:16] + ":00"
+            row["hours"] = hours_by_day.get(day, [])
+            days.append(row)
+        document = {
+            "latitude": data.get("latitude"),
+            "longitude": data.get("longitude"),
+            "resolvedAddress": ", ".join(
+                filter(None, (location.get("name"), location.get("country")))) or query.city,
+            "address": query.city,
+            "timezone": data.get("timezone"),
+            "tzoffset": data.get("utc_offset_seconds", 0) / 3600,
+            "days": days,
+        }
+        if "current" in data:
+            current = open_meteo_row(data["current"], OPEN_METEO_CURRENT, None)
+            current["datetime"] = data["current"].get("time", "")[11:16] + ":00"
+            document["currentConditions"] = current
+        return document
+
+
+def open_meteo_hours(hourly: dict) -> dict[str, list[dict]]:
+    """Timeline hours out of Open-Meteo hourly columns, by day."""
+    hours_by_day: dict = {}
+    for index, moment in enumerate(hourly.get("time", [])):
+        hour = open_meteo_row(hourly, OPEN_METEO_HOURLY, index)
+        hour["datetime"] = moment[11:16] + ":00"
+        if hourly.get("visibility") and hourly["visibility"][index] is not None:
+            # Open-Meteo reports meters, the timeline kilometers
+            hour["visibility"] = round(hourly["visibility"][index] / 1000, 1)
+        hours_by_day.setdefault(moment[:10], []).append(hour)
+    return hours_by_day
+
+
+def open_meteo_row(values: dict, names: dict, index: Optional[int]) -> dict:
+    """
+    Timeline elements of one period out of Open-Meteo columns.
+    :param index: position of the period, None for current conditions
+    """
+    row = {}
+    for name, source in names.items():
+        value = values.get(source)
+        if value is not None and index is not None:
+            value = value[index]
+        if value is not None:
+            row[name] = value
+    code = values.get("weather_code")
+    if code is not None and index is not None:
+        code = code[index]
+    if code in WMO_CONDITIONS:
+        row["conditions"], row["icon"] = WMO_CONDITIONS[code]
+    return row
+
+
+def stub_response(status: int, body) -> requests.Response:
+    """A response built in process, `body` is encoded as JSON unless it is text."""
+    response = requests.Response()
+    # pylint: disable=protected-access
+    response._content = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+    response.status_code = status
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+class StubProvider(Provider):
+    """
+    Synthetic documents built in process, for tests and offline
+    development. The same city always gets the same document.
+    """
+
+    def __init__(self, name: str = "stub", latency: float = 0.0, status: int = 200):
+        """
+        :param latency: seconds every call takes
+        :param status: status every call answers with
+        """
+        self.name = name
+        self.latency = latency
+        self.status = status
+
+    def document(self, query) -> dict:
+        """Timeline document of a query."""
+        rng = random.Random(zlib.crc32(query.city.lower().encode()))
+        base = rng.uniform(-5, 25)
+        today = date.today()
+        days = []
+        for offset in range(query.days):
+            temps = [round(base + rng.uniform(-6, 6), 1) for _ in range(24)]
+            days.append({
+                "datetime": (today + timedelta(days=offset)).isoformat(),
+                "tempmax": max(temps), "tempmin": min(temps),
+                "temp": round(sum(temps) / 24, 1),
+                "humidity": round(rng.uniform(40, 95), 1),
+                "conditions": "Partially cloudy",
+                "hours": [{"datetime": f"{hour:02d}:00:00", "temp": temp}
+                          for hour, temp in enumerate(temps)],
+            })
+        document = {"resolvedAddress": query.city, "address": query.city,
+                    "timezone": "UTC", "tzoffset": 0.0, "days": days}
+        if query.days == 1:
+            document["currentConditions"] = {"datetime": "12:00:00",
+                                             "temp": days[0]["temp"]}
+        return document
+
+    def answer(self, query):
+        """Document, or error message, answering a query."""
+        if self.status >= 400:
+            return f"Stub {self.name} failing with {self.status}"
+        return self.document(query)
+
+    def fetch(self, client, query, timeout: float) -> requests.Response:
+        time.sleep(self.latency)
+        return stub_response(self.status, self.answer(query))
+
+    async def fetch_async(self, client, query, timeout: float) -> httpx.Response:
+        await asyncio.sleep(self.latency)
+        return httpx.Response(self.status, content=stub_response(
+            self.status, self.answer(query)).content)
+
+
+# Providers selectable by name in UPSTREAM_PROVIDERS
+PROVIDERS = {
+    "visualcrossing": VisualCrossing,
+    "openmeteo": OpenMeteo,
+    "stub": StubProvider,
+}
+
+
+def providers_from_names(names: str) -> list[Provider]:
+    """
+    Providers of a comma separated list of names, preferred first.
+    :raises ValueError: for names not in PROVIDERS
+    """
+    unknown = [name for name in names.split(",") if name.strip() not in PROVIDERS]
+    if unknown:
+        raise ValueError(f"Unknown providers {unknown}, expected some of {list(PROVIDERS)}")
+    return [PROVIDERS[name.strip()]() for name in names.split(",")]
+
+
+class LatencyTracker:
+    """Recent call latencies and failures of each provider, in process."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        """
+        :param size: calls kept per provider
+        :param min_samples: calls needed before latencies are trusted
+        """
+        self.size = size
+        self.min_samples = min_samples
+        self._calls: dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float, failed: bool = False) -> None:
+        """Remember one call of a provider."""
+        with self._lock:
+            self._calls.setdefault(name, deque(maxlen=self.size)).append((seconds, failed))
+
+    def quantile(self, name: str, quantile: float) -> Optional[float]:
+        """Latency quantile of a provider, None until it has min_samples calls."""
+        with self._lock:
+            latencies = sorted(seconds for seconds, _ in self._calls.get(name, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+    def error_rate(self, name: str) -> float:
+        """Share of the recent calls of a provider that failed, 0 until min_samples."""
+        with self._lock:
+            calls = list(self._calls.get(name, ()))
+        if len(calls) < self.min_samples:
+            return 0.0
+        return sum(failed for _, failed in calls) / len(calls)
+
+    def stats(self) -> dict:
+        """p50, p95 and error rate of every provider seen."""
+        with self._lock:
+            names = list(self._calls)
+        return {name: {"p50": self.quantile(name, 0.5), "p95": self.quantile(name, 0.95),
+                       "error_rate": self.error_rate(name)} for name in names}
+
+
+def answered(call) -> bool:
+    """Whether a finished provider call, future or task, got a successful answer."""
+    if call.exception() is not None:
+        return False
+    response = call.result()
+    return response.is_success if isinstance(response, httpx.Response) else response.ok
+
+
+class ProviderAnswer(NamedTuple):
+    """The answer used for a query and who was asked for it."""
+    provider: Provider
+    response: object
+    # every provider called, the answering one included
+    called: tuple
+
+
+class RouterPolicy:  # pylint: disable=too-many-instance-attributes
+    """
+    Provider ranking and hedging settings shared by the sync and asyncio
+    routers.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, providers: list[Provider], breaker,
+                 tracker: Optional[LatencyTracker] = None, hedge_delay: float = 1.0,
+                 hedge_quantile: float = 0.95, min_hedge_delay: float = 0.05):
+        """
+        :param providers: providers in order of preference
+        :param breaker: circuit breaker of the upstream calls
+        :param hedge_delay: seconds before hedging while the primary has
+            too few calls for its latency to be known
+        :param hedge_quantile: latency quantile of the primary after which
+            the query is hedged
+        :param min_hedge_delay: never hedge sooner than this
+        """
+        self.providers = providers
+        self.breaker = breaker
+        self.tracker = tracker or LatencyTracker()
+        self.hedge_delay_default = hedge_delay
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+
+    @staticmethod
+    def circuit(provider: Provider, query) -> str:
+        """Breaker guarding the calls of a provider for a query."""
+        return f"{provider.name}:{query.circuit}"
+
+    def ranked(self, query) -> list[Provider]:
+        """
+        Providers able to answer a query, fastest first. Failing providers
+        come last, providers without enough calls keep their configured rank.
+        :raises ProviderError: when no provider supports the query
+        """
+        def rank(item):
+            index, provider = item
+            latency = self.tracker.quantile(provider.name, self.hedge_quantile)
+            return (self.tracker.error_rate(provider.name) >= 0.5,
+                    math.inf if latency is None else latency, index)
+
+        supported = [item for item in enumerate(self.providers) if item[1].supports(query)]
+        if not supported:
+            raise ProviderError(f"No provider answers {query.description}")
+        return [provider for _, provider in sorted(supported, key=rank)]
+
+    def hedge_delay(self, provider: Provider) -> float:
+        """Seconds to wait on a provider before asking the next one."""
+        latency = self.tracker.quantile(provider.name, self.hedge_quantile)
+        return max(latency if latency is not None else self.hedge_delay_default,
+                   self.min_hedge_delay)
+
+    def observe(self, provider: Provider, query, elapsed: float, failed: bool) -> bool:
+        """Count a provider call, :returns: whether the breaker was told it failed"""
+        self.tracker.observe(provider.name, elapsed, failed)
+        metrics.PROVIDER_LATENCY.labels(provider.name, query.endpoint).observe(elapsed)
+        return failed
+
+    def stats(self) -> dict:
+        """Providers in order of preference and their recent latencies."""
+        return {"providers": [provider.name for provider in self.providers],
+                "latency": self.tracker.stats()}
+
+
+class ProviderRouter(RouterPolicy):
+    """
+    Send upstream queries to the best provider, hedging with the next one
+    when it is slow. Losing calls run to completion in a small pool, their
+    latency still counts.
+    """
+
+    def __init__(self, *args, workers: int = 32, **kwargs):
+        """:param workers: max provider calls in flight while hedging"""
+        super().__init__(*args, **kwargs)
+        self.workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        """Pool of the hedged calls, one per (forked) process."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="hedge")
+                    self._pid = os.getpid()
+        return self._executor
+
+    def next_allowed(self, providers: list[Provider], query) -> Optional[Provider]:
+        """
+        Take providers off the front until one's breaker lets a call through.
+        :raises CircuitOpenError: when `providers` were all open
+        """
+        open_error = None
+        while providers:
+            provider = providers.pop(0)
+            try:
+                self.breaker.allow(self.circuit(provider, query))
+                return provider
+            except CircuitOpenError as error:
+                open_error = open_error or error
+        if open_error is not None:
+            raise open_error
+        return None
+
+    def call(self, client, provider: Provider, query, timeout: float) -> requests.Response:
+        """One provider call, counted and reported to the breaker."""
+        started = time.perf_counter()
+        try:
+            response = provider.fetch(client, query, timeout)
+        except RequestException:
+            elapsed = time.perf_counter() - started
+            self.breaker.record(self.circuit(provider, query),
+                                self.observe(provider, query, elapsed, True), elapsed)
+            raise
+        elapsed = time.perf_counter() - started
+        failed = not response.ok and is_failure(response.status_code)
+        self.breaker.record(self.circuit(provider, query),
+                            self.observe(provider, query, elapsed, failed), elapsed)
+        return response
+
+    def fetch(self, client, query, timeout: float) -> ProviderAnswer:
+        """
+        Answer a query from the fastest provider, hedged if there is another.
+        :param client: pooled http client the providers call through
+        :raises CircuitOpenError: when the breakers of all providers are open
+        :raises RequestException: when every provider called failed
+        """
+        candidates = self.ranked(query)
+        primary = self.next_allowed(candidates, query)
+        if not candidates:
+            return ProviderAnswer(primary, self.call(client, primary, query, timeout), (primary,))
+
+        pool = self._pool()
+        calls = {pool.submit(self.call, client, primary, query, timeout): primary}
+        done, _ = wait(calls, timeout=self.hedge_delay(primary))
+        # hedge a slow primary, fail over right away when it failed fast
+        if not done or not answered(done.pop()):
+            try:
+                secondary = self.next_allowed(candidates, query)
+            except CircuitOpenError:
+                secondary = None
+            if secondary is not None:
+                metrics.HEDGED_REQUESTS.labels(primary.name).inc()
+                calls[pool.submit(self.call, client, secondary, query, timeout)] = secondary
+        called = tuple(calls.values())
+
+        pending, last = set(calls), None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    last = ProviderAnswer(calls[future], future.result(), called)
+                except RequestException as error:
+                    last = error
+                    continue
+                if last.response.ok or not pending:
+                    return last
+        if isinstance(last, Exception):
+            raise last
+        return last
+
+
+class AsyncProviderRouter(RouterPolicy):
+    """
+    Asyncio counterpart of ProviderRouter. Losing calls are left to
+    complete in the background so their latency still counts.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._background: set[asyncio.Task] = set()
+
+    def _forget(self, task: asyncio.Task) -> None:
+        """Drop a finished losing call, its error was already counted."""
+        self._background.discard(task)
+        if not task.cancelled():
+            task.exception()
+
+    async def next_allowed(self, providers: list[Provider], query) -> Optional[Provider]:
+        """Asyncio variant of ProviderRouter.next_allowed"""
+        open_error = None
+        while providers:
+            provider = providers.pop(0)
+            try:
+                await self.breaker.allow(self.circuit(provider, query))
+                return provider
+            except CircuitOpenError as error:
+                open_error = open_error or error
+        if open_error is not None:
+            raise open_error
+        return None
+
+    async def call(self, client, provider: Provider, query, timeout: float) -> httpx.Response:
+        """Asyncio variant of ProviderRouter.call"""
+        started = time.perf_counter()
+        try:
+            response = await provider.fetch_async(client, query, timeout)
+        except httpx.HTTPError:
+            elapsed = time.perf_counter() - started
+            await self.breaker.record(self.circuit(provider, query),
+                                      self.observe(provider, query, elapsed, True), elapsed)
+            raise
+        elapsed = time.perf_counter() - started
+        failed = response.is_error and is_failure(response.status_code)
+        await self.breaker.record(self.circuit(provider, query),
+                                  self.observe(provider, query, elapsed, failed), elapsed)
+        return response
+
+    async def fetch(self, client, query, timeout: float) -> ProviderAnswer:
+        """Asyncio variant of ProviderRouter.fetch"""
+        candidates = self.ranked(query)
+        primary = await self.next_allowed(candidates, query)
+        if not candidates:
+            return ProviderAnswer(primary, await self.call(client, primary, query, timeout),
+                                  (primary,))
+
+        calls = {asyncio.create_task(self.call(client, primary, query, timeout)): primary}
+        done, _ = await asyncio.wait(calls, timeout=self.hedge_delay(primary))
+        if not done or not answered(done.pop()):
+            try:
+                secondary = await self.next_allowed(candidates, query)
+            except CircuitOpenError:
+                secondary = None
+            if secondary is not None:
+                metrics.HEDGED_REQUESTS.labels(primary.name).inc()
+                calls[asyncio.create_task(self.call(client, secondary, query, timeout))] = secondary
+        called = tuple(calls.values())
+
+        pending, last = set(calls), None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        last = ProviderAnswer(calls[task], task.result(), called)
+                    except httpx.HTTPError as error:
+                        last = error
+                        continue
+                    if not last.response.is_error or not pending:
+                        return last
+        finally:
+            for task in pending:
+                self._background.add(task)
+                task.add_done_callback(self._forget)
+        if isinstance(last, Exception):
+            raise last
+        return last
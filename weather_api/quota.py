@@ -0,0 +1,319 @@
+"""
+Budget of 3rd party API records, shared by every worker through Redis.
+
+The upstream bills per record and has a daily quota. Every upstream call
+takes its estimated records from a token bucket, which spreads the daily
+budget over the day so a spike cannot spend it all at once, and from a
+counter of the records spent today, which enforces the quota itself.
+Lower priority traffic has to leave a share of both untouched, so when
+the budget runs low only interactive requests still reach upstream.
+Calls answered out of a document fetched for another endpoint are counted
+as saved, next to what was spent.
+"""
+import asyncio
+import logging
+import time
+from enum import IntEnum
+from typing import Optional
+
+from redis.exceptions import RedisError
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Take `cost` records when the bucket and today's budget both keep
+# `reserve` records afterwards, or unconditionally when forced.
+# returns {status, tokens, spent}, status 0 taken, 1 bucket empty,
+# 2 daily budget spent
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket_reserve = tonumber(ARGV[5])
+local daily_budget = tonumber(ARGV[6])
+local daily_reserve = tonumber(ARGV[7])
+local force = ARGV[8] == '1'
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local spent = tonumber(redis.call('GET', KEYS[2])) or 0
+
+local status = 0
+if not force then
+    if spent + cost > daily_budget - daily_reserve then
+        status = 2
+    -- calls bigger than the bucket go through once it is full, in debt
+    elseif tokens - math.min(cost, capacity) < bucket_reserve then
+        status = 1
+    end
+end
+if status == 0 then
+    tokens = tokens - cost
+    spent = redis.call('INCRBY', KEYS[2], cost)
+    redis.call('EXPIRE', KEYS[2], 172800)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return {status, tostring(tokens), spent}
+"""
+TAKEN, BUCKET_EMPTY, BUDGET_SPENT = 0, 1, 2
+
+
+class Priority(IntEnum):
+    """Upstream traffic classes, most important first."""
+    INTERACTIVE = 0
+    BATCH = 1
+    BACKGROUND = 2
+
+
+# Share of the burst and of the daily budget a priority must leave for
+# more important traffic
+RESERVES = {
+    Priority.INTERACTIVE: 0.0,
+    Priority.BATCH: 0.1,
+    Priority.BACKGROUND: 0.25,
+}
+
+
+class QuotaExceededError(Exception):
+    """No upstream budget left for a call."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def seconds_to_midnight(now: float) -> int:
+    """Seconds until the daily budget resets, at midnight UTC."""
+    return int(86400 - now % 86400) + 1
+
+
+class BudgetPolicy:  # pylint: disable=too-many-instance-attributes
+    """
+    Settings and bookkeeping shared by the sync and asyncio budgets.
+    A daily budget of 0 or less disables the limit.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, redis_client, daily_records: int = 1000,
+                 burst: Optional[float] = None, wait_timeout: float = 2,
+                 key: str = "quota", reserves: Optional[dict] = None):
+        """
+        :param redis_client: client holding the shared bucket and counter
+        :param daily_records: records the upstream allows per day
+        :param burst: records that can be spent at once, an hour worth of
+            budget by default
+        :param wait_timeout: how long interactive calls wait for the bucket
+            to refill before giving up
+        :param key: prefix of the Redis keys
+        :param reserves: share kept for more important traffic, by priority
+        """
+        self.redis = redis_client
+        self.daily_records = daily_records
+        self.burst = burst if burst is not None else max(daily_records / 24, 1)
+        self.rate = daily_records / 86400
+        self.wait_timeout = wait_timeout
+        self.key = key
+        self.reserves = reserves if reserves is not None else RESERVES
+        self._last: dict = {}
+        self._saved: dict = {}
+
+    @property
+    def enabled(self) -> bool:
+        """Whether calls are limited at all."""
+        return self.daily_records > 0
+
+    def keys(self, now: float) -> list[str]:
+        """Redis keys of the bucket and of the counter of the day of `now`."""
+        day = time.strftime("%Y-%m-%d", time.gmtime(now))
+        return [f"{self.key}:bucket", f"{self.key}:spent:{day}"]
+
+    def saved_key(self, now: float) -> str:
+        """Redis hash of the calls and records saved on the day of `now`."""
+        return f"{self.key}:saved:{time.strftime('%Y-%m-%d', time.gmtime(now))}"
+
+    def record_saved_stats(self, saved: dict) -> None:
+        """Remember the saved hash read from Redis, for stats()."""
+        self._saved = {(key.decode() if isinstance(key, bytes) else key): int(value)
+                       for key, value in saved.items()}
+
+    def script_args(self, cost: int, priority: Priority, now: float,
+                    force: bool = False) -> list:
+        """Arguments of TAKE_SCRIPT for one call."""
+        reserve = self.reserves.get(priority, 0.0)
+        return [self.burst, self.rate, now, cost, reserve * self.burst,
+                self.daily_records, reserve * self.daily_records, int(force)]
+
+    def record(self, now: float, result) -> tuple[int, float]:
+        """Remember the state returned by TAKE_SCRIPT, for stats()."""
+        status, tokens, spent = int(result[0]), float(result[1]), int(result[2])
+        self._last = {"tokens": tokens, "spent": spent, "at": now}
+        metrics.UPSTREAM_BUDGET_REMAINING.set(max(self.daily_records - spent, 0))
+        return status, tokens
+
+    def retry_after(self, status: int, tokens: float, cost: int,
+                    priority: Priority, now: float) -> float:
+        """Seconds until a denied call could be taken."""
+        if status == BUDGET_SPENT:
+            return seconds_to_midnight(now)
+        needed = min(cost, self.burst) + self.reserves.get(priority, 0.0) * self.burst - tokens
+        return max(needed / self.rate, 0.0)
+
+    def stats(self) -> dict:
+        """Budget and what is left of it, as last seen by this process."""
+        tokens = self._last.get("tokens", self.burst)
+        spent = self._last.get("spent", 0)
+        return {
+            "daily_records": self.daily_records,
+            "spent": spent,
+            "remaining": max(self.daily_records - spent, 0),
+            "burst": self.burst,
+            "burst_remaining": max(tokens, 0.0),
+            "saved": {"calls": self._saved.get("calls", 0),
+                      "records": self._saved.get("records", 0)},
+        }
+
+
+class UpstreamBudget(BudgetPolicy):
+    """
+    Take records from the shared upstream budget before each call.
+    """
+
+    def take(self, cost: int, priority: Priority = Priority.INTERACTIVE) -> None:
+        """
+        Take `cost` records, waiting for the bucket to refill for up to
+        `wait_timeout` seconds for interactive calls.
+        :raises QuotaExceededError: when the records cannot be taken
+        """
+        if not self.enabled:
+            return
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            now = time.time()
+            try:
+                result = self.redis.eval(TAKE_SCRIPT, 2, *self.keys(now),
+                                         *self.script_args(cost, priority, now))
+            except RedisError as redis_error:
+                # an unreachable budget must not become an outage
+                logger.warning("Upstream budget unavailable: %s", redis_error)
+                return
+            status, tokens = self.record(now, result)
+            if status == TAKEN:
+                return
+            wait = self.retry_after(status, tokens, cost, priority, now)
+            if (status == BUDGET_SPENT or priority != Priority.INTERACTIVE
+                    or time.monotonic() + wait > deadline):
+                raise QuotaExceededError(
+                    f"Upstream budget exhausted for {priority.name.lower()} traffic",
+                    retry_after=int(wait) + 1)
+            time.sleep(wait)
+
+    def settle(self, records: int) -> None:
+        """
+        Account for records spent beyond the estimate of a call, negative
+        to give back what was not spent.
+        """
+        if not self.enabled or not records:
+            return
+        now = time.time()
+        try:
+            self.record(now, self.redis.eval(
+                TAKE_SCRIPT, 2, *self.keys(now),
+                *self.script_args(records, Priority.INTERACTIVE, now, force=True)))
+        except RedisError as redis_error:
+            logger.warning("Upstream budget unavailable: %s", redis_error)
+
+    def refresh_stats(self) -> dict:
+        """Read the shared budget state, then return stats()."""
+        now = time.time()
+        try:
+            if self.enabled:
+                self.record(now, self.redis.eval(
+                    TAKE_SCRIPT, 2, *self.keys(now),
+                    *self.script_args(0, Priority.INTERACTIVE, now)))
+            self.record_saved_stats(self.redis.hgetall(self.saved_key(now)))
+        except RedisError as redis_error:
+            logger.warning("Upstream budget unavailable: %s", redis_error)
+        return self.stats()
+
+    def record_saved(self, marker: str, records: int) -> bool:
+        """
+        Count an upstream call saved, once across workers for each `marker`.
+        :param marker: what was served instead of calling, like
+            "weather:<etag>"
+        :param records: records the call would have been billed
+        :returns: whether it was counted, False when already counted
+        """
+        now = time.time()
+        try:
+            if not self.redis.set(f"{self.key}:saved:{marker}", 1, nx=True, ex=86400):
+                return False
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hincrby(self.saved_key(now), "calls", 1)
+            pipe.hincrby(self.saved_key(now), "records", records)
+            pipe.expire(self.saved_key(now), 172800)
+            pipe.execute()
+        except RedisError as redis_error:
+            logger.warning("Upstream budget unavailable: %s", redis_error)
+            return False
+        return True
+
+
+class AsyncUpstreamBudget(BudgetPolicy):
+    """
+    Asyncio counterpart of UpstreamBudget, sharing the same Redis state.
+    """
+
+    async def take(self, cost: int, priority: Priority = Priority.INTERACTIVE) -> None:
+        """Asyncio variant of UpstreamBudget.take"""
+        if not self.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_timeout
+        while True:
+            now = time.time()
+            try:
+                result = await self.redis.eval(TAKE_SCRIPT, 2, *self.keys(now),
+                                               *self.script_args(cost, priority, now))
+            except RedisError as redis_error:
+                logger.warning("Upstream budget unavailable: %s", redis_error)
+                return
+            status, tokens = self.record(now, result)
+            if status == TAKEN:
+                return
+            wait = self.retry_after(status, tokens, cost, priority, now)
+            if (status == BUDGET_SPENT or priority != Priority.INTERACTIVE
+                    or loop.time() + wait > deadline):
+                raise QuotaExceededError(
+                    f"Upstream budget exhausted for {priority.name.lower()} traffic",
+                    retry_after=int(wait) + 1)
+            await asyncio.sleep(wait)
+
+    async def settle(self, records: int) -> None:
+        """Asyncio variant of UpstreamBudget.settle"""
+        if not self.enabled or not records:
+            return
+        now = time.time()
+        try:
+            self.record(now, await self.redis.eval(
+                TAKE_SCRIPT, 2, *self.keys(now),
+                *self.script_args(records, Priority.INTERACTIVE, now, force=True)))
+        except RedisError as redis_error:
+            logger.warning("Upstream budget unavailable: %s", redis_error)
+
+    async def refresh_stats(self) -> dict:
+        """Asyncio variant of UpstreamBudget.refresh_stats"""
+        now = time.time()
+        try:
+            if self.enabled:
+                self.record(now, await self.redis.eval(
+                    TAKE_SCRIPT, 2, *self.keys(now),
+                    *self.script_args(0, Priority.INTERACTIVE, now)))
+            self.record_saved_stats(await self.redis.hgetall(self.saved_key(now)))
+        except RedisError as redis_error:
+            logger.warning("Upstream budget unavailable: %s", redis_error)
+        return self.stats()
@@ -0,0 +1,78 @@
+"""
+Readiness of a worker and the time it took to start.
+
+Creating the app opens no connection, so cold starts only pay for
+imports. /ready opens the connections a worker needs and loads what it
+reads on every request, so that load balancers hold traffic back until
+it is done rather than the first requests paying for it.
+"""
+import logging
+import os
+import time
+from typing import Callable
+
+from flask import current_app, jsonify
+from redis.exceptions import RedisError
+
+from . import metrics
+from .extensions import cache, http_client, locations, redis
+
+logger = logging.getLogger(__name__)
+
+# Seconds create_app may take before it is logged as too slow
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "0.5"))
+
+
+def timed(action: Callable[[], object]) -> float:
+    """Seconds `action` took."""
+    started = time.perf_counter()
+    action()
+    return round(time.perf_counter() - started, 6)
+
+
+def warm() -> dict[str, float]:
+    """
+    Open the connections of the worker and load the gazetteer.
+    Needs an app context, for the cache backend.
+    :returns: seconds taken by each step
+    :raises RedisError: when Redis cannot be reached
+    """
+    return {
+        "redis": timed(redis.ping),
+        "cache": timed(cache.cache.ping),
+        "upstream": timed(lambda: http_client.session),
+        "gazetteer": timed(locations.index),
+    }
+
+
+def record_startup(app, started: float) -> float:
+    """
+    Record how long creating `app` took since `started` (perf_counter).
+    :returns: the startup seconds
+    """
+    seconds = time.perf_counter() - started
+    app.config["STARTUP_SECONDS"] = round(seconds, 6)
+    metrics.STARTUP_SECONDS.set(seconds)
+    if seconds > app.config["STARTUP_BUDGET"]:
+        logger.warning("Startup over budget", extra={
+            "seconds": round(seconds, 3), "budget": app.config["STARTUP_BUDGET"]})
+    return seconds
+
+
+def init_app(app) -> None:
+    """Serve the readiness probe on /ready."""
+    app.config.setdefault("STARTUP_BUDGET", STARTUP_BUDGET)
+
+    def ready():
+        try:
+            warmup = warm()
+        except RedisError as redis_error:
+            logger.warning("Not ready: %s", redis_error)
+            return jsonify({"status": "unavailable", "message": str(redis_error)}), 503
+        return jsonify({
+            "status": "ready",
+            "startup_seconds": current_app.config.get("STARTUP_SECONDS"),
+            "warmup_seconds": warmup,
+        })
+
+    app.add_url_rule("/ready", "ready", ready)
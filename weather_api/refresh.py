@@ -0,0 +1,160 @@
+"""
+Background refresh of stale cache entries and pre-warming of hot keys.
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Decayed request count under which a member is forgotten
+MIN_COUNT = 0.01
+
+
+class Refresher:  # pylint: disable=too-many-instance-attributes
+    """
+    Refresh cache entries off the request path.
+
+    Stale entries keep being served while `refresh` repopulates them on a
+    small thread pool. Requests are counted per key and a scheduler
+    periodically hands the most requested ones to a pre-warm callback so
+    they can be refreshed before they go stale. Counts halve every
+    `half_life` seconds, popularity follows what is requested lately.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, redis_client, workers: int = 4, interval: float = 60,
+                 top_n: int = 50, popular_key: str = "refresh:popular",
+                 half_life: float = 3600):
+        """
+        :param redis_client: client used to share request counts
+        :param workers: max concurrent background refreshes
+        :param interval: seconds between two scheduler passes
+        :param top_n: number of most requested keys pre-warmed per pass
+        :param popular_key: sorted set holding request counts
+        :param half_life: seconds for a request count to decay by half
+        """
+        self.redis = redis_client
+        self.workers = workers
+        self.interval = interval
+        self.top_n = top_n
+        self.popular_key = popular_key
+        self.half_life = half_life
+        self.app = None
+        self.prewarm: Optional[Callable[[list[str]], None]] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: set[str] = set()
+        self._counts: Counter = Counter()
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+
+    def init_app(self, app, prewarm: Optional[Callable[[list[str]], None]] = None):
+        """
+        Bind the app background work runs for.
+        :param prewarm: called by the scheduler with the most requested
+            members, most popular first
+        """
+        self.app = app
+        self.prewarm = prewarm
+
+    def refresh(self, key: str, fetch: Callable[[], object]) -> bool:
+        """
+        Run `fetch` in the background unless `key` is already refreshing.
+        :returns: True if a refresh was scheduled
+        """
+        self._ensure_started()
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+        self._executor.submit(self._run, key, fetch)
+        return True
+
+    def _run(self, key: str, fetch: Callable[[], object]) -> None:
+        try:
+            with self.app.app_context() if self.app else nullcontext():
+                fetch()
+        # a failed refresh leaves the stale value in place
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            logger.warning("Background refresh of %s failed: %s", key, error)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def record(self, member: str) -> None:
+        """Count a request, counts are flushed to Redis by the scheduler."""
+        self._ensure_started()
+        with self._lock:
+            self._counts[member] += 1
+
+    def flush_counts(self) -> None:
+        """Add the locally buffered request counts to the shared ones."""
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        if not counts:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for member, count in counts.items():
+            pipe.zincrby(self.popular_key, count, member)
+        # keep the set bounded, only the head matters
+        pipe.zremrangebyrank(self.popular_key, 0, -(self.top_n * 10) - 1)
+        pipe.execute()
+
+    def decay(self, now: Optional[float] = None) -> None:
+        """Decay the shared request counts by the time since the last decay."""
+        now = time.time() if now is None else now
+        last = self.redis.getset(f"{self.popular_key}:decayed_at", now)
+        if last is None:
+            return
+        factor = 0.5 ** (max(now - float(last), 0.0) / self.half_life)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zunionstore(self.popular_key, {self.popular_key: factor})
+        # members nobody asked for in a while
+        pipe.zremrangebyscore(self.popular_key, "-inf", MIN_COUNT)
+        pipe.execute()
+
+    def popular(self) -> list[str]:
+        """Most requested members, most popular first."""
+        members = self.redis.zrevrange(self.popular_key, 0, self.top_n - 1)
+        return [member.decode() for member in members]
+
+    def run_once(self) -> None:
+        """One scheduler pass: share counts, then decay them and pre-warm hot keys."""
+        self.flush_counts()
+        # a single process per interval does the pre-warm pass
+        leader = self.redis.set(f"{self.popular_key}:leader", os.getpid(),
+                                nx=True, px=int(self.interval * 1000))
+        if leader:
+            self.decay()
+        if leader and self.prewarm is not None:
+            with self.app.app_context() if self.app else nullcontext():
+                self.prewarm(self.popular())
+
+    def _schedule(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            # the scheduler must outlive any single failed pass
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                logger.warning("Refresh scheduler pass failed: %s", error)
+
+    def _ensure_started(self) -> None:
+        """Start the pool and scheduler once per (forked) process."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="refresh")
+            self._pending = set()
+            self._counts = Counter()
+            threading.Thread(target=self._schedule, name="refresh-scheduler",
+                             daemon=True).start()
+            self._pid = os.getpid()
@@ -0,0 +1,255 @@
+"""
+Priority queue of background refresh jobs, shared by every process
+through Redis.
+
+The refresh scheduler queues the popular entries about to go stale,
+ranked by their decayed request counts. Worker threads take the most
+popular job first. A web process starts REFRESH_QUEUE_WORKERS of them
+when it first queues jobs, and a lease lets a single web process per
+host take jobs at a time. They can also run in a process of their own,
+which takes jobs without a lease:
+
+    flask --app run refresh-worker --workers 4
+
+A member queued again before it is taken keeps its highest priority and
+the time it was first queued, so lag is measured from when it was due.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import nullcontext
+from typing import Callable, NamedTuple, Optional
+
+import click
+from redis.exceptions import RedisError
+
+from . import metrics
+from .quota import QuotaExceededError
+
+logger = logging.getLogger(__name__)
+
+# Queue members with their request count as priority, keeping the highest
+# one, and the time they were first queued.
+# returns the number of queued jobs
+PUSH_SCRIPT = """
+local now = ARGV[1]
+for i = 2, #ARGV do
+    local score = tonumber(redis.call('ZSCORE', KEYS[2], ARGV[i])) or 0
+    redis.call('ZADD', KEYS[1], 'GT', score, ARGV[i])
+    redis.call('HSETNX', KEYS[3], ARGV[i], now)
+end
+return redis.call('ZCARD', KEYS[1])
+"""
+# Take the job with the highest priority.
+# returns {member, priority, queued at} or nil when the queue is empty
+POP_SCRIPT = """
+local popped = redis.call('ZPOPMAX', KEYS[1])
+if #popped == 0 then
+    return false
+end
+local queued_at = redis.call('HGET', KEYS[2], popped[1]) or ''
+redis.call('HDEL', KEYS[2], popped[1])
+return {popped[1], popped[2], queued_at}
+"""
+# Take or extend the lease of a holder.
+# returns 1 when the holder has it
+LEASE_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+class RefreshJob(NamedTuple):
+    """A queued refresh."""
+    member: str
+    priority: float
+    queued_at: float
+
+
+class RefreshQueue:  # pylint: disable=too-many-instance-attributes
+    """
+    Refresh jobs in a Redis sorted set, run by a pool of worker threads.
+    Jobs the upstream budget has no room for are queued back and the
+    workers of the process pause until it refills.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, redis_client, workers: int = 0, poll_interval: float = 1,
+                 max_pause: float = 60, key: str = "refresh:queue",
+                 popular_key: str = "refresh:popular", lease: float = 30):
+        """
+        :param redis_client: client holding the queue
+        :param workers: worker threads a web process starts when it first
+            queues jobs, 0 leaves the queue to `flask refresh-worker`
+            processes
+        :param poll_interval: seconds an idle worker waits before looking again
+        :param max_pause: longest pause when the budget is spent
+        :param key: sorted set of the queued members
+        :param popular_key: sorted set of the request counts of the members
+        :param lease: seconds the workers of a web process keep taking the
+            jobs of its host after they last renewed their lease
+        """
+        self.redis = redis_client
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_pause = max_pause
+        self.key = key
+        self.popular_key = popular_key
+        self.lease = lease
+        self.app = None
+        self.run: Optional[Callable[[str], bool]] = None
+        self._resume_at = 0.0
+        self._leased_until = 0.0
+        self._stopping = threading.Event()
+        self._threads: list[threading.Thread] = []
+        # held by _ensure_started while start takes it again
+        self._lock = threading.RLock()
+        self._pid: Optional[int] = None
+
+    def init_app(self, app, run: Callable[[str], bool]) -> None:
+        """
+        Bind the app jobs run for and add the refresh-worker command.
+        :param run: refreshes the entry of a member, returns False when
+            there was nothing to refresh
+        """
+        self.app = app
+        self.run = run
+
+        @app.cli.command("refresh-worker")
+        @click.option("--workers", default=4, help="Concurrent refreshes.")
+        def refresh_worker(workers):
+            """Run refresh jobs until interrupted."""
+            click.echo(f"Running refresh jobs with {workers} workers")
+            try:
+                for thread in self.start(workers, leased=False):
+                    thread.join()
+            finally:
+                self.stop()
+
+    def push(self, members: list[str], now: Optional[float] = None) -> int:
+        """
+        Queue refreshes of `members`, prioritized by their request counts.
+        :returns: number of queued jobs
+        """
+        if not members:
+            return 0
+        if self.workers > 0 and self.run is not None:
+            self._ensure_started()
+        depth = int(self.redis.eval(PUSH_SCRIPT, 3, self.key, self.popular_key,
+                                    f"{self.key}:queued_at",
+                                    time.time() if now is None else now, *members))
+        metrics.REFRESH_QUEUE_DEPTH.set(depth)
+        return depth
+
+    def requeue(self, job: RefreshJob) -> None:
+        """Queue a job back as it was."""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(self.key, {job.member: job.priority}, gt=True)
+        pipe.hsetnx(f"{self.key}:queued_at", job.member, job.queued_at)
+        pipe.execute()
+
+    def pop(self) -> Optional[RefreshJob]:
+        """The most popular job, None when the queue is empty."""
+        popped = self.redis.eval(POP_SCRIPT, 2, self.key, f"{self.key}:queued_at")
+        if not popped:
+            return None
+        member, priority, queued_at = (
+            value.decode() if isinstance(value, bytes) else value for value in popped)
+        return RefreshJob(member, float(priority), float(queued_at or time.time()))
+
+    def work_once(self) -> bool:
+        """
+        Run the most popular job.
+        :returns: False when the queue was empty
+        """
+        job = self.pop()
+        if job is None:
+            return False
+        metrics.REFRESH_QUEUE_LAG.observe(max(time.time() - job.queued_at, 0.0))
+        try:
+            with self.app.app_context() if self.app else nullcontext():
+                result = "refreshed" if self.run(job.member) else "skipped"
+        except QuotaExceededError as quota_error:
+            self.requeue(job)
+            with self._lock:
+                self._resume_at = time.monotonic() + min(quota_error.retry_after,
+                                                         self.max_pause)
+            result = "quota"
+        # a failed job is dropped, the scheduler queues it again if still due
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            logger.warning("Refresh of %s failed: %s", job.member, error)
+            result = "failed"
+        metrics.REFRESH_JOBS.labels(result).inc()
+        return True
+
+    def holds_lease(self) -> bool:
+        """
+        Whether this process takes the jobs of its host, renewing its lease
+        once half of it is gone.
+        """
+        now = time.monotonic()
+        if now < self._leased_until - self.lease / 2:
+            return True
+        held = self.redis.eval(LEASE_SCRIPT, 1,
+                               f"{self.key}:lease:{socket.gethostname()}",
+                               os.getpid(), int(self.lease * 1000))
+        self._leased_until = now + self.lease if held else 0.0
+        return bool(held)
+
+    def _work(self, stopping: threading.Event, leased: bool) -> None:
+        while not stopping.is_set():
+            pause = self._resume_at - time.monotonic()
+            if pause > 0:
+                stopping.wait(pause)
+                continue
+            try:
+                if (not leased or self.holds_lease()) and self.work_once():
+                    continue
+            except RedisError as redis_error:
+                logger.warning("Refresh queue unavailable: %s", redis_error)
+            stopping.wait(self.poll_interval)
+
+    def start(self, workers: int, leased: bool = True) -> list[threading.Thread]:
+        """
+        Start `workers` worker threads.
+        :param leased: only take jobs while holding the lease of the host
+        """
+        threads = [threading.Thread(target=self._work, args=(self._stopping, leased),
+                                    name=f"refresh-worker-{index}", daemon=True)
+                   for index in range(workers)]
+        for thread in threads:
+            thread.start()
+        with self._lock:
+            self._threads.extend(threads)
+        return threads
+
+    def stop(self, timeout: float = 5) -> None:
+        """Stop the worker threads once their current job is done."""
+        self._stopping.set()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout)
+        with self._lock:
+            self._stopping = threading.Event()
+            self._pid = None
+            self._leased_until = 0.0
+
+    def _ensure_started(self) -> None:
+        """Start the workers once per (forked) process."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # a forked process does not hold the lease of its parent
+                self._leased_until = 0.0
+                self.start(self.workers)
+                self._pid = os.getpid()
@@ -2,15 +2,46 @@
 Define wheater API routes and View Functions
 """
 import json
+import logging
+import os
+import queue
 from functools import wraps
+from typing import Iterator, Optional, Union
 
-from flask import Blueprint, jsonify, request
-from requests.exceptions import HTTPError
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from requests.exceptions import HTTPError, RequestException
 
-from weather_api.services import get_forecast, get_weather, get_forecast_elements
+from weather_api.breaker import CircuitOpenError
+from weather_api.normalize import UnknownUnitsError
+from weather_api.extensions import stream_hub, upstream_budget, upstream_router
+from weather_api.history import HistoryQueryError
+from weather_api.payload import CachedPayload, cache_control, matching_etag
+from weather_api.quota import QuotaExceededError
+from weather_api.services import (STALE_IF_ERROR, UpstreamQuery, Validators,
+                                  elements_validators, forecast_validators,
+                                  get_forecast, get_forecast_elements,
+                                  get_fresh_validator, get_history,
+                                  get_normalized_forecast,
+                                  get_normalized_weather, get_weather,
+                                  get_weather_many,
+                                  normalized_forecast_validators,
+                                  normalized_weather_validators,
+                                  parse_elements, record_not_modified,
+                                  weather_validators)
+from weather_api.stream import (Event, SubscribersExceededError, Subscription,
+                                error_event)
+
+logger = logging.getLogger(__name__)
 
 weather_bp = Blueprint('weather', __name__)
 
+# Max number of cities accepted by one batch request
+BATCH_MAX_CITIES = int(os.getenv("BATCH_MAX_CITIES", "500"))
+# Max number of cities one stream subscribes to
+STREAM_MAX_CITIES = int(os.getenv("STREAM_MAX_CITIES", "50"))
+# Seconds between two keepalives of an idle stream, below proxy timeouts
+STREAM_KEEPALIVE = float(os.getenv("STREAM_KEEPALIVE", "15"))
+
 
 def handle_client_errors(func):
     """Decorator to handle errors and display usefull messages to clients."""
@@ -25,42 +56,297 @@ def handle_client_errors(func):
                 "message": f"External service error: \
 {http_error.response.status_code} - {http_error.response.text}"
             }), http_error.response.status_code
+        except (QuotaExceededError, CircuitOpenError) as unavailable:
+            return jsonify({
+                "status": "error",
+                "message": str(unavailable)
+            }), 503, {"Retry-After": str(unavailable.retry_after)}
 
     return wrapper
 
 
+def send_payload(weather_data, query: UpstreamQuery) -> Response:
+    """
+    Send the cached bytes of a service response as they are.
+    Clients accepting brotli or gzip get the variant compressed at write
+    time, clients holding the same ETag get a 304.
+    :param weather_data: response returned by a service
+    :param query: cache entry the response was served from, for its TTLs
+    :returns: flask response with precomputed length and ETag
+    """
+    payload = weather_data.payload
+    body, headers = payload.representation(request.headers.get("Accept-Encoding"))
+    headers["Cache-Control"] = cache_control(
+        payload.created_at, query.soft_ttl, query.cache_timeout, STALE_IF_ERROR)
+    response = Response(body, mimetype="application/json", headers=headers,
+                        direct_passthrough=True)
+    return response.make_conditional(request)
+
+
+def not_modified(validators: Validators) -> Optional[Response]:
+    """
+    Answer a conditional request from the validator of a fresh cache
+    entry, without reading the entry itself.
+    :param validators: entries tried in order, with the ETag of the
+        representation out of theirs for representations computed from them
+    :returns: a 304, None when the request has to be served
+    """
+    if not request.if_none_match:
+        return None
+    for query, derive in validators:
+        validator = get_fresh_validator(query)
+        if validator is None:
+            continue
+        # the client holds the body of one of the codings
+        etag = matching_etag(request.if_none_match,
+                             derive(validator.etag) if derive else validator.etag)
+        if etag is None:
+            continue
+        record_not_modified(query)
+        return Response(status=304, headers={
+            "ETag": f'"{etag}"',
+            "Vary": "Accept-Encoding",
+            "Cache-Control": cache_control(validator.created_at, query.soft_ttl,
+                                           query.cache_timeout, STALE_IF_ERROR),
+        })
+    return None
+
+
 @weather_bp.route('/weather/<city>', methods=['GET'])
 @handle_client_errors
-def city_weather(city: str) -> json:
+def city_weather(city: str) -> Response:
     """
     Call 3rd party api for given city name.
     :param city: name of the city to get weather data for
     :returns: json object with weather data
     """
-    weather_data = get_weather(city)
-    return weather_data.json()
+    validators = weather_validators(city, request.args)
+    return not_modified(validators) or send_payload(get_weather(city), validators[0][0])
 
 
 @weather_bp.route('/forecast/<city>', methods=['GET'])
 @handle_client_errors
-def city_forecast(city: str) -> json:
+def city_forecast(city: str) -> Response:
     """
     Call 3rd paty api to get the 15 days forecast for given city
     :param city: name of the city to get wheather data for
     :returns: json object with weather data
     """
-    weather_data = get_forecast(city)
-    return weather_data.json()
+    validators = forecast_validators(city, request.args)
+    return not_modified(validators) or send_payload(get_forecast(city), validators[0][0])
 
 
 @weather_bp.route('/forecast-elements/<city>', methods=['GET'])
 @handle_client_errors
-def forecast_elements(city: str) -> json:
+def forecast_elements(city: str) -> Response:
     """
     Call 3rd party api to get forecast for specific elements
     :param city: name of the city to get wheather data for
     :returns: json object with weather data
     """
-    elements_list = request.args.getlist('elements')
-    weather_data = get_forecast_elements(city, elements_list)
-    return weather_data.json()
+    # projected out of the forecast, or fetched on their own
+    validators = elements_validators(city, request.args)
+    return (not_modified(validators)
+            or send_payload(get_forecast_elements(city, request.args.getlist('elements')),
+                            validators[0][0]))
+
+
+def handle_unknown_units(func):
+    """Decorator answering unsupported `units` arguments with a 400."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except UnknownUnitsError as units_error:
+            return jsonify({"status": "error", "message": str(units_error)}), 400
+
+    return wrapper
+
+
+@weather_bp.route('/weather/<city>/normalized', methods=['GET'])
+@handle_client_errors
+@handle_unknown_units
+def normalized_weather(city: str) -> Response:
+    """
+    Today's weather in a provider independent columnar format
+    :param city: name of the city to get weather data for
+    :returns: json object with location, units and one list per element
+    """
+    validators = normalized_weather_validators(city, request.args)
+    return (not_modified(validators)
+            or send_payload(get_normalized_weather(city, request.args.get('units', 'metric')),
+                            validators[0][0]))
+
+
+@weather_bp.route('/forecast/<city>/normalized', methods=['GET'])
+@handle_client_errors
+@handle_unknown_units
+def normalized_forecast(city: str) -> Response:
+    """
+    15 days forecast in a provider independent columnar format
+    :param city: name of the city to get weather data for
+    :returns: json object with location, units and one list per element
+    """
+    validators = normalized_forecast_validators(city, request.args)
+    return (not_modified(validators)
+            or send_payload(get_normalized_forecast(city, request.args.get('units', 'metric')),
+                            validators[0][0]))
+
+
+@weather_bp.route('/history/<city>', methods=['GET'])
+def city_history(city: str) -> Response:
+    """
+    Hours of the past days kept from the fetched forecasts, answered
+    from local data only, e.g. /history/Oslo?from=2024-06-01&to=2024-06-07
+    :param city: name of the city to get the history of
+    :returns: json object with one list per element, or with the daily
+        min, max and mean of each element when aggregate=day
+    """
+    aggregate = request.args.get('aggregate', 'hour')
+    if aggregate not in ('hour', 'day'):
+        return jsonify({"status": "error",
+                        "message": "aggregate is expected to be hour or day"}), 400
+    try:
+        document = get_history(city, request.args.get('from'), request.args.get('to'),
+                               parse_elements(request.args.getlist('elements')),
+                               daily=aggregate == 'day')
+    except HistoryQueryError as query_error:
+        return jsonify({"status": "error", "message": str(query_error)}), 400
+    return jsonify(document)
+
+
+def batch_line(city: str, result: Union[CachedPayload, Exception]) -> bytes:
+    """
+    Encode one batch result as a line of NDJSON.
+    Cached payload bytes are embedded as they are.
+    """
+    city_json = json.dumps(city).encode()
+    if isinstance(result, CachedPayload):
+        status = b'"stale":true,' if result.stale else b''
+        return b'{"city":%s,"status":"ok",%s"data":%s}\n' % (city_json, status, result.body)
+    if isinstance(result, HTTPError) and result.response is not None:
+        code = result.response.status_code
+        message = f"External service error: {code} - {result.response.text}"
+    elif isinstance(result, (QuotaExceededError, CircuitOpenError)):
+        code, message = 503, str(result)
+    elif isinstance(result, RequestException):
+        code, message = 502, "External service unavailable"
+    else:
+        code, message = 500, "Internal error"
+    error = {"city": city, "status": "error", "code": code, "message": message}
+    return json.dumps(error).encode() + b"\n"
+
+
+def stream_batch(cities: list[str]) -> Iterator[bytes]:
+    """Stream batch results in the order they complete."""
+    for city, result in get_weather_many(cities):
+        yield batch_line(city, result)
+
+
+@weather_bp.route('/weather/batch', methods=['POST'])
+def weather_batch() -> Response:
+    """
+    Get weather data for many cities at once.
+    Expects a json body like {"cities": ["London", "Paris"]}
+    :returns: one NDJSON line per city, streamed as results complete
+    """
+    body = request.get_json(silent=True)
+    cities = body.get("cities") if isinstance(body, dict) else None
+    if (not isinstance(cities, list) or not cities
+            or not all(isinstance(city, str) and city.strip() for city in cities)):
+        return jsonify({
+            "status": "error",
+            "message": 'Expected a json body like {"cities": ["London", "Paris"]}'
+        }), 400
+    if len(cities) > BATCH_MAX_CITIES:
+        return jsonify({
+            "status": "error",
+            "message": f"At most {BATCH_MAX_CITIES} cities per batch"
+        }), 400
+    return Response(stream_with_context(stream_batch(cities)),
+                    mimetype="application/x-ndjson")
+
+
+def stream_arguments(args) -> Optional[tuple[list[str], bool]]:
+    """
+    Cities and format of a stream request.
+    :param args: query arguments
+    :returns: the cities and whether events are sent as SSE, None if invalid
+    """
+    cities = [city for city in args.getlist('city') if city.strip()]
+    stream_format = args.get('format', 'sse')
+    if not cities or len(cities) > STREAM_MAX_CITIES or stream_format not in ('sse', 'ndjson'):
+        return None
+    return cities, stream_format == 'sse'
+
+
+STREAM_ARGUMENTS_ERROR = (f"Expected 1 to {STREAM_MAX_CITIES} city arguments "
+                          "and format sse or ndjson")
+# Headers of a stream, proxies must neither cache nor buffer it
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def stream_events(subscription: Subscription, snapshots: list[Event],
+                  sse: bool) -> Iterator[bytes]:
+    """Stream the snapshots, then patches as they are published."""
+    keepalive = b": keepalive\n\n" if sse else b"\n"
+    try:
+        for event in snapshots:
+            yield event.sse() if sse else event.ndjson()
+        while True:
+            try:
+                event = subscription.get(STREAM_KEEPALIVE)
+            except queue.Empty:
+                yield keepalive
+                continue
+            if event is None:
+                return
+            yield event.sse() if sse else event.ndjson()
+    # the response has started, the stream ends with an error event instead
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        logger.error("Stream error: %s", error, exc_info=True)
+        event = error_event("Stream interrupted")
+        yield event.sse() if sse else event.ndjson()
+    finally:
+        stream_hub.unsubscribe(subscription)
+
+
+@weather_bp.route('/stream', methods=['GET'])
+@handle_client_errors
+def forecast_stream() -> Response:
+    """
+    Subscribe to the forecast of cities, e.g. /stream?city=London&city=Paris
+    Each forecast is sent once, then only what changed as a JSON patch.
+    :returns: Server-Sent Events, or NDJSON lines with format=ndjson
+    """
+    arguments = stream_arguments(request.args)
+    if arguments is None:
+        return jsonify({"status": "error", "message": STREAM_ARGUMENTS_ERROR}), 400
+    cities, sse = arguments
+    try:
+        subscription, snapshots = stream_hub.subscribe(cities)
+    except SubscribersExceededError as exceeded:
+        return jsonify({"status": "error", "message": str(exceeded)}), 503, {
+            "Retry-After": str(exceeded.retry_after)}
+    return Response(
+        stream_events(subscription, snapshots, sse),
+        mimetype="text/event-stream" if sse else "application/x-ndjson",
+        headers=STREAM_HEADERS)
+
+
+@weather_bp.route('/quota', methods=['GET'])
+def upstream_quota() -> Response:
+    """
+    Upstream records budget of the day and what is left of it
+    :returns: json object with the budget counters
+    """
+    return jsonify(upstream_budget.refresh_stats())
+
+
+@weather_bp.route('/providers', methods=['GET'])
+def upstream_providers() -> Response:
+    """
+    Weather providers in order of preference and their recent latencies
+    :returns: json object with the providers and their p50/p95 and error rate
+    """
+    return jsonify(upstream_router.stats())
@@ -1,22 +1,107 @@
 """
 Define services that are connecting to 3rd party API.
 """
-import json
+import functools
 import logging
+import math
 import os
-from datetime import datetime
-from typing import Optional
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from typing import Callable, Iterator, NamedTuple, Optional, Sequence, Union
 
 import requests
+from flask import current_app
+from redis.exceptions import RedisError
 from requests.exceptions import HTTPError, RequestException, Timeout
 
-from .extensions import cache
+from . import metrics
+from .breaker import CircuitOpenError, is_failure
+from .extensions import (cache, history, http_client, locations, refresh_queue,
+                         refresher, single_flight, upstream_budget,
+                         upstream_router)
+from .history import HistoryQueryError, format_epoch, parse_range
+from .normalize import check_units, normalize_payload, normalized_etag
+from .payload import CachedPayload, as_payload
+from .projection import (needs_upstream, project_payload, projected_etag,
+                         today_etag, today_payload)
+from .providers import ProviderAnswer
+from .quota import Priority, QuotaExceededError
 
 error_logger = logging.getLogger("Flask Error Logger")
 error_logger.setLevel(logging.ERROR)
+logger = logging.getLogger(__name__)
 
-API_KEY = os.getenv("WEATHER_API_KEY")
 BASE_URL = "https://weather.visualcrossing.com/VisualCrossingWebServices/rest/services/timeline/"
+# Seconds to wait on the 3rd party API
+UPSTREAM_TIMEOUT = 10
+# Upstream records billed per day of data, a forecast covers 15 days
+FORECAST_DAYS = 15
+# Max concurrent upstream calls made for one batch request
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "16"))
+# Per endpoint soft TTL: seconds an entry is served as fresh, past it the
+# stale entry is still served while it is refreshed in the background.
+# Hard TTL: seconds before the entry is dropped from cache.
+WEATHER_SOFT_TTL = int(os.getenv("WEATHER_SOFT_TTL", "900"))
+WEATHER_HARD_TTL = int(os.getenv("WEATHER_HARD_TTL", "21600"))
+FORECAST_SOFT_TTL = int(os.getenv("FORECAST_SOFT_TTL", "3600"))
+FORECAST_HARD_TTL = int(os.getenv("FORECAST_HARD_TTL", "86400"))
+# Seconds entries are kept past their hard TTL, only served (marked as
+# stale) when upstream cannot be reached to replace them
+STALE_IF_ERROR = int(os.getenv("STALE_IF_ERROR", "86400"))
+# Endpoints whose documents hold the full hours of a day, kept in history
+HISTORY_ENDPOINTS = ("weather", "forecast", "batch")
+# Max number of days of one history query
+HISTORY_MAX_DAYS = int(os.getenv("HISTORY_MAX_DAYS", "366"))
+
+
+class UpstreamQuery(NamedTuple):
+    """One upstream document and the cache entry it is stored under."""
+    redis_key: str
+    url: str
+    params: dict
+    cache_timeout: int
+    description: str
+    soft_ttl: int
+    # counted for pre-warming, None for queries that are not pre-warmed
+    member: Optional[str] = None
+    # upstream records the query is expected to be billed
+    cost: int = 1
+    # who is waiting on the upstream call, when the budget runs low
+    priority: Priority = Priority.INTERACTIVE
+    # label of the query in metrics
+    endpoint: str = "timeline"
+    # what providers other than the timeline API are asked for
+    city: str = ""
+    days: int = 1
+    coordinates: Optional[tuple[float, float]] = None
+
+    @property
+    def circuit(self) -> str:
+        """Upstream endpoint whose breaker guards the query."""
+        # batch misses are calls for today's weather
+        return "weather" if self.endpoint == "batch" else self.endpoint
+
+
+class Validator(NamedTuple):
+    """ETag and fetch time of a cached payload, cached next to it."""
+    etag: str
+    created_at: float
+
+
+def api_key() -> Optional[str]:
+    """
+    Key of the 3rd party API, read when a query is built so importing the
+    module neither needs it set nor freezes it.
+    """
+    return os.getenv("WEATHER_API_KEY")
+
+
+def __getattr__(name: str):
+    """`API_KEY` is still importable, read on access."""
+    if name == "API_KEY":
+        return api_key()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def handle_request_errors(func):
@@ -35,6 +120,12 @@ def handle_request_errors(func):
         except Timeout as timeout_error:
             error_logger.error("Timeout error: %s", timeout_error)
             raise timeout_error
+        except QuotaExceededError as quota_error:
+            error_logger.error("Quota error: %s", quota_error)
+            raise quota_error
+        except CircuitOpenError as circuit_error:
+            error_logger.error("Circuit open: %s", circuit_error)
+            raise circuit_error
         except RequestException as request_error:
             error_logger.error("Request error: %s", request_error)
             raise request_error
@@ -44,120 +135,650 @@ def handle_request_errors(func):
     return wrapper
 
 
+class PayloadResponse(requests.Response):
+    """
+    Response carrying a cached payload. Its content is the identity body,
+    decoded on first read only: routes send the payload itself.
+    """
+
+    def __init__(self, payload: CachedPayload):
+        super().__init__()
+        self.payload = payload
+        self.status_code = 200
+        self.headers["Content-Type"] = "application/json"
+
+    @property
+    def content(self):
+        """The identity body of the payload."""
+        if self._content is False:
+            self._content = self.payload.body
+            self._content_consumed = True
+        return self._content
+
+
+def payload_response(payload: CachedPayload) -> requests.Response:
+    """
+    Wrap a cached payload in a response object without re-encoding it.
+    param: payload: cached body
+    return: response carrying the payload bytes
+    """
+    return PayloadResponse(payload)
+
+
+def cache_payload(redis_key: str, response: requests.Response,
+                  timeout: int, data=None) -> CachedPayload:
+    """
+    Encode an upstream response once and store it in cache.
+    param: redis_key: str key name
+    param: data: decoded response body, decoded here when not given
+    return: the cached payload, also attached to the response
+    """
+    payload = CachedPayload.from_data(response.json() if data is None else data)
+    cache.set(redis_key, payload, timeout=timeout)
+    response.payload = payload
+    return payload
+
+
 def get_data_from_cache(redis_key: str) -> Optional[requests.Response]:
     """
     Try to get cache data for a specific key.
     param: redis_key: str key name
     return: None if key is not in cache, value of key otherwise
     """
-    cached_data = cache.get(redis_key)
+    cached_data = as_payload(cache.get(redis_key))
     if cached_data:
-        print(f"Returning from cache {cached_data}")
-        # Reconstruct a fake response object
-        response = requests.Response()
-        # pylint: disable=protected-access
-        response._content = json.dumps(cached_data).encode('utf-8')
-        response.status_code = 200
-        return response
+        logger.debug("Cache hit", extra={"key": redis_key})
+        return payload_response(cached_data)
     return None
 
 
-@handle_request_errors
-def get_weather(city):
-    """Fetch weather data from weather.visualcrossing.com"""
-    redis_key = f"{city}_{datetime.today().date()}"
+def records_billed(data, query: UpstreamQuery) -> int:
+    """Records upstream billed for a response, as it reports them."""
+    if isinstance(data, dict) and isinstance(data.get("queryCost"), int):
+        return data["queryCost"]
+    return query.cost
+
+
+def answer_records(answer: ProviderAnswer, data, query: UpstreamQuery) -> int:
+    """Records billed for a provider answer, hedged calls included."""
+    if answer.provider.billed:
+        return records_billed(data, query)
+    # a billed provider that lost the race is assumed to bill its estimate
+    return query.cost if any(provider.billed for provider in answer.called) else 0
 
-    cached_data = get_data_from_cache(redis_key)
-    if cached_data:
-        return cached_data
 
-    city_url = BASE_URL + f"/{city}/today"
-    params = {
-        "include": "current",
-        "key": API_KEY,
-        "unitGroup": "metric"
+def record_upstream_failure(query: UpstreamQuery, status_code: int, text: str) -> None:
+    """Count and log an unsuccessful upstream response."""
+    metrics.UPSTREAM_ERRORS.labels(query.endpoint, str(status_code)).inc()
+    # the request URL is left out, its parameters hold the API key
+    logger.warning("Upstream call failed", extra={
+        "query": query.description,
+        "status": status_code,
+        "response": text[:500],
+    })
 
-    }
-    response = requests.get(city_url, params=params, timeout=10)
+
+def fetch_query(query: UpstreamQuery) -> requests.Response:
+    """
+    Call the 3rd party API for a query and cache a successful response.
+    param: query: what to fetch and where to cache it
+    return: upstream response
+    raise: CircuitOpenError: when upstream is failing and calls fail fast
+    raise: QuotaExceededError: when the upstream budget has no room for it
+    """
+    upstream_budget.take(query.cost, query.priority)
+    started = time.perf_counter()
+    try:
+        answer = upstream_router.fetch(http_client, query, UPSTREAM_TIMEOUT)
+    except CircuitOpenError:
+        upstream_budget.settle(-query.cost)
+        raise
+    except RequestException as request_error:
+        metrics.UPSTREAM_ERRORS.labels(query.endpoint, type(request_error).__name__).inc()
+        upstream_budget.settle(-query.cost)
+        raise
+    finally:
+        metrics.UPSTREAM_LATENCY.labels(query.endpoint).observe(
+            time.perf_counter() - started)
+    response = answer.response
     if response.ok:
+        with metrics.JSON_DECODE.time():
+            data = response.json()
+        data = answer.provider.normalize(data, query)
+        upstream_budget.settle(answer_records(answer, data, query) - query.cost)
         # set cache data if no Exception
-        # since this is todays weather, it makes sense to cache for 24h
-        cache.set(redis_key, response.json(), timeout=86400)
-        print(f"Cached data for {city}")
+        payload = cache_payload(query.redis_key, response,
+                                timeout=query.cache_timeout + STALE_IF_ERROR, data=data)
+        record_history(query, data, payload.created_at)
+        logger.info("Cached upstream response", extra={
+            "query": query.description, "provider": answer.provider.name})
     else:
-        # In case of failure, log useful details
-        print(f"Failed to fetch weather for {city}.")
-        print(f"Status Code: {response.status_code}")
-        # This is the error message from the API (if any)
-        print(f"Response Text: {response.text}")
-        # The actual URL that was requested
-        print(f"Request URL: {response.url}")
+        # failed calls are not billed
+        upstream_budget.settle(-query.cost)
+        record_upstream_failure(query, response.status_code, response.text)
+    return response
+
+
+def record_history(query: UpstreamQuery, data, fetched_at: float) -> None:
+    """
+    Keep the hours of a fetched document that are over in the history store.
+    Failing to do so does not fail the request, and nothing is kept
+    before the store is bound to an app.
+    """
+    if query.endpoint not in HISTORY_ENDPOINTS or history.root is None:
+        return
+    try:
+        history.record(query.city, data, fetched_at)
+    except OSError as os_error:
+        logger.warning("History of %s not recorded: %s", query.city, os_error)
 
+
+def cached_fetch(query: UpstreamQuery,
+                 shared: Optional[Callable[[], Optional[requests.Response]]] = None
+                 ) -> requests.Response:
+    """
+    Serve a query from cache, concurrent misses share a single fetch.
+    param: query: what to fetch and where to cache it
+    param: shared: answer out of a document cached for another query,
+        tried before refreshing or fetching the entry of this one
+    return: cached or upstream response
+    """
+    if query.member:
+        refresher.record(query.member)
+    cached_data = get_data_from_cache(query.redis_key)
+    if shared is not None and (cached_data is None
+                               or cached_data.payload.age() > query.soft_ttl):
+        response = shared()
+        if response is not None:
+            metrics.CACHE_LOOKUPS.labels(query.endpoint, "shared").inc()
+            return response
+    if cached_data and cached_data.payload.age() <= query.cache_timeout:
+        if cached_data.payload.age() > query.soft_ttl:
+            metrics.CACHE_LOOKUPS.labels(query.endpoint, "stale").inc()
+            refresh_query(query)
+        else:
+            metrics.CACHE_LOOKUPS.labels(query.endpoint, "hit").inc()
+        return cached_data
+    metrics.CACHE_LOOKUPS.labels(
+        query.endpoint, "expired" if cached_data else "miss").inc()
+    try:
+        response = single_flight.do(
+            query.redis_key, lambda: fetch_query(query),
+            lambda: get_fresh_data_from_cache(query, query.cache_timeout))
+    except (CircuitOpenError, QuotaExceededError, RequestException):
+        if cached_data is None:
+            raise
+        return serve_stale(query, cached_data)
+    if cached_data is not None and not response.ok and is_failure(response.status_code):
+        return serve_stale(query, cached_data)
     return response
 
 
-@handle_request_errors
-def get_forecast(city):
-    """Get forecast for the next 15 days for a specific city"""
-    redis_key = f"forecast_{city}_{datetime.today().date()}"
+def timeline_query(query: UpstreamQuery) -> UpstreamQuery:
+    """
+    Today's weather query read from the cache entry of the forecast
+    timeline of its city, which carries today and the current conditions.
+    """
+    return query._replace(redis_key=forecast_query(query.city).redis_key)
 
-    cached_data = get_data_from_cache(redis_key)
-    if cached_data:
+
+def timeline_weather(query: UpstreamQuery) -> Optional[requests.Response]:
+    """
+    Today's weather out of the cached forecast timeline of the city.
+    Only timelines as fresh as a weather entry has to be are used, an
+    older one is not worth the call it saves.
+    param: query: today's weather query
+    return: None when there is no such timeline
+    """
+    timeline = get_fresh_data_from_cache(timeline_query(query))
+    if timeline is None:
+        return None
+    today = today_payload(timeline.payload)
+    if today is None:
+        return None
+    count_saved("weather", today.etag, query.cost)
+    return payload_response(today)
+
+
+def served_from_timeline(query: UpstreamQuery, margin: float = 0) -> bool:
+    """
+    Whether today's weather of a query is answered out of the forecast
+    timeline, and still will be `margin` seconds from now. Such weather
+    entries are not refreshed, the timeline stands in for them.
+    """
+    if query.endpoint != "weather":
+        return False
+    timeline = get_fresh_data_from_cache(timeline_query(query),
+                                         max(query.soft_ttl - margin, 1))
+    return timeline is not None and today_payload(timeline.payload) is not None
+
+
+@functools.lru_cache(maxsize=4096)
+def count_saved(endpoint: str, etag: str, records: int) -> bool:
+    """
+    Count the upstream call an answer out of a shared document saved.
+    Each document version saves one call per endpoint, counted once by
+    the first worker serving it; this process remembers it was counted.
+    param: etag: ETag of the answer, which changes with the document
+    return: whether this call counted it
+    """
+    if not upstream_budget.record_saved(f"{endpoint}:{etag}", records):
+        return False
+    metrics.UPSTREAM_CALLS_SAVED.labels(endpoint).inc()
+    metrics.UPSTREAM_RECORDS_SAVED.labels(endpoint).inc(records)
+    return True
+
+
+def serve_stale(query: UpstreamQuery, cached_data: requests.Response) -> requests.Response:
+    """
+    Last known value of an expired entry, while upstream is unavailable.
+    return: response marked as stale
+    """
+    logger.warning("Serving expired entry, upstream unavailable",
+                   extra={"query": query.description,
+                          "age": int(cached_data.payload.age())})
+    return payload_response(cached_data.payload.as_stale())
+
+
+def get_fresh_validator(query: UpstreamQuery) -> Optional[Validator]:
+    """
+    Validator of the cached payload of a query, read without the payload.
+    return: None if the entry is missing or past its soft TTL
+    """
+    try:
+        cached = cache.cache.get_validator(query.redis_key)
+    except RedisError as redis_error:
+        logger.warning("Validator read failed for %s: %s", query.redis_key, redis_error)
+        return None
+    return fresh_validator(cached, query)
+
+
+def fresh_validator(cached: Optional[tuple], query: UpstreamQuery) -> Optional[Validator]:
+    """
+    Validator out of a cached (etag, created_at) pair.
+    return: None if there is none or it is past the soft TTL of the query
+    """
+    if cached is None:
+        return None
+    validator = Validator(*cached)
+    if time.time() - validator.created_at > query.soft_ttl:
+        # served the regular way, which refreshes it
+        return None
+    return validator
+
+
+def record_not_modified(query: UpstreamQuery) -> None:
+    """Count a conditional request answered from the validator of a query."""
+    if query.member:
+        refresher.record(query.member)
+    metrics.CACHE_LOOKUPS.labels(query.endpoint, "not_modified").inc()
+
+
+# Cache entries whose validator may answer a conditional request, tried in
+# order, each with the ETag of the representation out of the entry one
+# (None when the entry is sent as is). The first one is the entry whose
+# TTLs the response is sent with.
+Validators = list[tuple[UpstreamQuery, Optional[Callable[[str], str]]]]
+
+
+def weather_validators(city: str, args) -> Validators:  # pylint: disable=unused-argument
+    """
+    Today's weather, or the forecast timeline it is taken out of.
+    param: args: query arguments of the request, a MultiDict
+    """
+    query = weather_query(city)
+    return [(query, None), (timeline_query(query), today_etag)]
+
+
+def forecast_validators(city: str, args) -> Validators:  # pylint: disable=unused-argument
+    """The 15 days forecast."""
+    return [(forecast_query(city), None)]
+
+
+def elements_validators(city: str, args) -> Validators:
+    """Elements fetched on their own, or projected out of the forecast."""
+    elements = parse_elements(args.getlist("elements"))
+    if needs_upstream(elements):
+        return [(elements_query(city, elements), None)]
+    return [(forecast_query(city),
+             (lambda etag: projected_etag(etag, elements)) if elements else None)]
+
+
+def normalized_weather_validators(city: str, args) -> Validators:
+    """
+    Today's weather in the requested units.
+    raise: UnknownUnitsError: for units not in normalize.UNIT_SYSTEMS
+    """
+    units = check_units(args.get("units", "metric"))
+    return [(weather_query(city), lambda etag: normalized_etag(etag, units))]
+
+
+def normalized_forecast_validators(city: str, args) -> Validators:
+    """
+    The forecast in the requested units.
+    raise: UnknownUnitsError: for units not in normalize.UNIT_SYSTEMS
+    """
+    units = check_units(args.get("units", "metric"))
+    return [(forecast_query(city), lambda etag: normalized_etag(etag, units))]
+
+
+def get_fresh_data_from_cache(query: UpstreamQuery,
+                              max_age: Optional[int] = None) -> Optional[requests.Response]:
+    """
+    Like get_data_from_cache, but entries past their soft TTL are a miss.
+    param: max_age: seconds after which an entry is a miss, soft TTL by default
+    """
+    cached_data = get_data_from_cache(query.redis_key)
+    if cached_data and cached_data.payload.age() <= (max_age or query.soft_ttl):
         return cached_data
+    return None
 
-    forecast_url = BASE_URL + f"/{city}"
-    params = {
-        "unitGroup": "metric",
-        "include": "fcst",
-        "key": API_KEY
-    }
-    response = requests.get(forecast_url, params=params, timeout=10)
-    if response.ok:
-        # set cache data if no Exception
-        cache.set(redis_key, response.json(), timeout=86400)
-        print(f"Cached forecast data for {city}")
-    else:
-        # In case of failure, log useful details
-        print(f"Failed to fetch weather for {city}.")
-        print(f"Status Code: {response.status_code}")
-        # This is the error message from the API (if any)
-        print(f"Response Text: {response.text}")
-        # The actual URL that was requested
-        print(f"Request URL: {response.url}")
-    return response
 
+def refresh_query(query: UpstreamQuery) -> bool:
+    """
+    Repopulate the cache entry of a query in the background.
+    Background calls are the first ones left out when the budget runs
+    low, the stale entry keeps being served meanwhile.
+    return: False if a refresh was already running
+    """
+    query = query._replace(priority=Priority.BACKGROUND)
+    return refresher.refresh(query.redis_key, lambda: single_flight.do(
+        query.redis_key, lambda: fetch_query(query),
+        lambda: get_fresh_data_from_cache(query)))
 
-@handle_request_errors
-def get_forecast_elements(city, elements_list):
-    """Get forecast for specific elements"""
+
+def prewarm_popular(members: list[str]) -> None:
+    """
+    Queue refreshes of the most requested entries before they go stale,
+    the refresh workers take the most popular ones first.
+    param: members: popular query members like "forecast:London"
+    """
+    queries = []
+    for member in members:
+        kind, _, city = member.partition(":")
+        if kind in PREWARM_QUERIES:
+            queries.append(PREWARM_QUERIES[kind](city))
+    cached = cache.get_many(*(query.redis_key for query in queries))
+    due = []
+    for query, cached_data in zip(queries, cached):
+        payload = as_payload(cached_data)
+        # missing, or going stale before the next scheduler pass
+        if ((payload is None or payload.age() + refresher.interval > query.soft_ttl)
+                and not served_from_timeline(query, refresher.interval)):
+            due.append(query.member)
+    refresh_queue.push(due)
+
+
+def refresh_popular(member: str) -> bool:
+    """
+    Refresh job of the refresh queue: fetch the entry of a popular member
+    unless it was refreshed since it was queued.
+    param: member: query member like "forecast:London"
+    return: whether upstream was called
+    raise: QuotaExceededError: when the background share of the budget is spent
+    """
+    kind, _, city = member.partition(":")
+    if kind not in PREWARM_QUERIES:
+        return False
+    query = PREWARM_QUERIES[kind](city)._replace(priority=Priority.BACKGROUND)
+    if (get_fresh_data_from_cache(query, max(query.soft_ttl - refresher.interval, 1))
+            or served_from_timeline(query, refresher.interval)):
+        return False
+    single_flight.do(query.redis_key, lambda: fetch_query(query),
+                     lambda: get_fresh_data_from_cache(query))
+    return True
+
+
+def locate(city: str) -> tuple[str, Optional[tuple[float, float]]]:
+    """
+    Canonical location of a client supplied city, shared by its aliases
+    and nearby coordinates, and its coordinates when known.
+    """
+    location = locations.resolve(city)
+    return location.name, location.coordinates
+
+
+def weather_query(city: str) -> UpstreamQuery:
+    """Today's weather, including current conditions"""
+    city, coordinates = locate(city)
+    return UpstreamQuery(
+        # no date in the key, freshness is handled by the soft TTL so keys
+        # do not all roll over at midnight
+        redis_key=f"weather_{city}",
+        url=BASE_URL + f"/{city}/today",
+        params={
+            "include": "current",
+            "key": api_key(),
+            "unitGroup": "metric"
+        },
+        cache_timeout=WEATHER_HARD_TTL,
+        description=f"weather for {city}",
+        soft_ttl=WEATHER_SOFT_TTL,
+        member=f"weather:{city}",
+        endpoint="weather",
+        city=city,
+        coordinates=coordinates,
+    )
+
+
+def forecast_query(city: str) -> UpstreamQuery:
+    """
+    Forecast for the next 15 days, today's current conditions and the
+    hours already observed included
+    """
+    city, coordinates = locate(city)
+    return UpstreamQuery(
+        redis_key=f"forecast_{city}",
+        url=BASE_URL + f"/{city}",
+        params={
+            "unitGroup": "metric",
+            # current conditions make it a superset of today's weather, and
+            # observations one of the elements queries it is projected for
+            "include": "obs,fcst,current",
+            "key": api_key()
+        },
+        cache_timeout=FORECAST_HARD_TTL,
+        description=f"forecast for {city}",
+        soft_ttl=FORECAST_SOFT_TTL,
+        member=f"forecast:{city}",
+        cost=FORECAST_DAYS,
+        endpoint="forecast",
+        city=city,
+        days=FORECAST_DAYS,
+        coordinates=coordinates,
+    )
+
+
+def parse_elements(elements_list: list[str]) -> list[str]:
+    """Flatten repeated and comma separated `elements` arguments"""
     elements = []
 
     for item in elements_list:
         parts = item.split(',')
         cleaned = [part.strip() for part in parts if part.strip()]
         elements.extend(cleaned)
+    return elements
 
-    elements_str = ','.join(elements)
-    redis_key = f"{city}+{elements_str}"
-    cached_data = get_data_from_cache(redis_key)
-    if cached_data:
-        return cached_data
-    forecast_url = BASE_URL + f"/{city}"
-    params = {
-        "unitGroup": "metric",
-        "include": "obs,fcst",
-        "key": API_KEY,
-        "elements": elements_str
-    }
-
-    response = requests.get(forecast_url, params=params, timeout=10)
-    if response.ok:
-        # set cache data if no Exception
-        cache.set(redis_key, response.json(), timeout=86400)
-        print(f"Cached elements:{elements_str} for {city}")
+
+def elements_query(city: str, elements_list: list[str]) -> UpstreamQuery:
+    """
+    Observations and forecast restricted to some elements, only used for
+    elements a full forecast does not have
+    """
+    elements_str = ','.join(parse_elements(elements_list))
+    city, coordinates = locate(city)
+    return UpstreamQuery(
+        redis_key=f"{city}+{elements_str}",
+        url=BASE_URL + f"/{city}",
+        params={
+            "unitGroup": "metric",
+            "include": "obs,fcst",
+            "key": api_key(),
+            "elements": elements_str
+        },
+        cache_timeout=FORECAST_HARD_TTL,
+        description=f"elements {elements_str} for {city}",
+        soft_ttl=FORECAST_SOFT_TTL,
+        cost=FORECAST_DAYS,
+        endpoint="elements",
+        city=city,
+        days=FORECAST_DAYS,
+        coordinates=coordinates,
+    )
+
+
+# Queries the scheduler pre-warms, by the kind prefix of their member
+PREWARM_QUERIES = {
+    "weather": weather_query,
+    "forecast": forecast_query,
+}
+
+
+@handle_request_errors
+def get_weather(city):
+    """
+    Fetch weather data from weather.visualcrossing.com, or take it out of
+    the fresh forecast timeline of the city
+    """
+    query = weather_query(city)
+    return cached_fetch(query, lambda: timeline_weather(query))
+
+
+@handle_request_errors
+def get_forecast(city):
+    """Get forecast for the next 15 days for a specific city"""
+    return cached_fetch(forecast_query(city))
+
+
+def load_forecast(city: str) -> tuple[str, CachedPayload]:
+    """
+    Cached forecast of a city, for the stream hub.
+    return: the redis key it is cached under and the payload
+    """
+    query = forecast_query(city)
+    return query.redis_key, get_forecast(city).payload
+
+
+@handle_request_errors
+def get_forecast_elements(city, elements_list):
+    """
+    Get forecast for specific elements.
+    Elements are projected out of the cached full forecast of the city,
+    the upstream is only asked for elements a full forecast does not have.
+    """
+    elements = parse_elements(elements_list)
+    if needs_upstream(elements):
+        return cached_fetch(elements_query(city, elements))
+    forecast = get_forecast(city)
+    if not elements:
+        return forecast
+    projected = project_payload(forecast.payload, elements)
+    count_saved("elements", projected.etag, FORECAST_DAYS)
+    return payload_response(projected)
+
+
+@handle_request_errors
+def get_normalized_weather(city, units="metric"):
+    """Today's weather in the normalized columnar format"""
+    return payload_response(normalize_payload(get_weather(city).payload, units))
+
+
+@handle_request_errors
+def get_normalized_forecast(city, units="metric"):
+    """Forecast for the next 15 days in the normalized columnar format"""
+    return payload_response(normalize_payload(get_forecast(city).payload, units))
+
+
+def get_history(city: str, start: Optional[str] = None, end: Optional[str] = None,
+                elements: Sequence[str] = (), daily: bool = False) -> dict:
+    """
+    Stored hours of a city, or their daily min, max and mean, in the
+    columnar layout of the normalized documents. Upstream is not called.
+    param: start: first day, YYYY-MM-DD, a week before `end` by default
+    param: end: last day included, today by default
+    param: elements: hourly elements, all the stored ones by default
+    param: daily: aggregate the hours of each day
+    raise: HistoryQueryError: for unknown elements or unusable ranges
+    """
+    unknown = [element for element in elements if element not in history.elements]
+    if unknown:
+        raise HistoryQueryError(f"Unknown history elements: {', '.join(unknown)}")
+    first, last = parse_range(start, end, datetime.now(timezone.utc).date(),
+                              HISTORY_MAX_DAYS)
+    city, _ = locate(city)
+    elements = list(dict.fromkeys(elements)) or list(history.elements)
+    document = {"location": city, "from": first.isoformat(), "to": last.isoformat()}
+    if daily:
+        epochs, summaries = history.days(city, first, last, elements)
+        document["datetime"] = [format_epoch(epoch)[:10] for epoch in epochs]
+        document.update(summaries)
     else:
-        print(f"Failed to fetch elements {elements_str} for {city}.")
-        print(f"Status Code: {response.status_code}")
-        print(f"Response Text: {response.text}")
-        print(f"Request URL: {response.url}")
-    return response
+        epochs, values = history.hours(city, first, last, elements)
+        document["datetime"] = [format_epoch(epoch) for epoch in epochs]
+        for element in elements:
+            document[element] = [None if math.isnan(value) else value
+                                 for value in values[element]]
+    return document
+
+
+@handle_request_errors
+def get_batch_query(query):
+    """Cached fetch of a batch miss, leaving part of the budget to others"""
+    query = query._replace(priority=Priority.BATCH, endpoint="batch")
+    return cached_fetch(query, lambda: timeline_weather(query))
+
+
+def get_weather_many(cities: list[str], concurrency: int = BATCH_CONCURRENCY
+                     ) -> Iterator[tuple[str, Union[CachedPayload, Exception]]]:
+    """
+    Weather for many cities, yielded as soon as each one is available.
+    Cache hits are read in a single round trip, misses are fetched
+    concurrently with at most `concurrency` upstream calls at a time.
+    param: cities: city names, duplicates are only served once and
+        aliases of the same location only fetched once
+    return: (city, payload) pairs, or (city, error) when fetching failed
+    """
+    queries = {city: weather_query(city) for city in dict.fromkeys(cities)}
+    cached = cache.get_many(*(query.redis_key for query in queries.values()))
+    # redis key -> cities waiting on its fetch
+    misses: dict[str, list[str]] = {}
+    for (city, query), cached_data in zip(queries.items(), cached):
+        refresher.record(query.member)
+        payload = as_payload(cached_data)
+        if payload and payload.age() <= query.cache_timeout:
+            if payload.age() > query.soft_ttl:
+                metrics.CACHE_LOOKUPS.labels("batch", "stale").inc()
+                refresh_query(query)
+            else:
+                metrics.CACHE_LOOKUPS.labels("batch", "hit").inc()
+            yield city, payload
+        else:
+            # counted by cached_fetch when fetched, which also serves
+            # expired entries while upstream is unavailable
+            misses.setdefault(query.redis_key, []).append(city)
+    if not misses:
+        return
+
+    # worker threads need the app to reach the cache
+    app = current_app._get_current_object()  # pylint: disable=protected-access
+
+    def fetch(city):
+        with app.app_context():
+            return get_batch_query(queries[city]).payload
+
+    executor = ThreadPoolExecutor(max_workers=min(concurrency, len(misses)),
+                                  thread_name_prefix="batch")
+    try:
+        futures = {executor.submit(fetch, waiting[0]): waiting
+                   for waiting in misses.values()}
+        for future in as_completed(futures):
+            try:
+                payload = future.result()
+            # one city failing must not fail the whole batch
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                payload = error
+            for city in futures[future]:
+                yield city, payload
+    finally:
+        # the client may go away before the batch is complete
+        executor.shutdown(wait=False, cancel_futures=True)
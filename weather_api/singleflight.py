@@ -0,0 +1,235 @@
+"""
+Single-flight coalescing of concurrent cache misses.
+
+Inside one process callers of the same key wait on the first caller.
+Across workers and nodes a short Redis lease makes sure only one of them
+calls the 3rd party API, the others wait for the cache to be populated.
+"""
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# Only delete the lease if we still own it
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+@dataclass
+class _Call:
+    """An in-flight fetch other threads can wait on."""
+    done: threading.Event = field(default_factory=threading.Event)
+    result: Any = None
+    error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Make sure exactly one fetch per key runs at a time.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, redis_client, lease_seconds: float = 15,
+                 wait_timeout: float = 15, poll_interval: float = 0.025,
+                 max_poll_interval: float = 0.2):
+        """
+        :param redis_client: client used for the cross process lease
+        :param lease_seconds: how long a lease is held before it expires
+        :param wait_timeout: how long to wait for another process fetch
+        :param poll_interval: first delay between cache polls
+        :param max_poll_interval: cap for the backed off poll delay
+        """
+        self.redis = redis_client
+        self.lease_seconds = lease_seconds
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._calls: dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def lease_key(key: str) -> str:
+        """Redis key of the lease guarding `key`."""
+        return f"singleflight:{key}"
+
+    def do(self, key: str, fetch: Callable[[], Any],
+           load: Callable[[], Any]) -> Any:
+        """
+        Run `fetch` once for `key` and share its result.
+        :param key: cache key the fetch populates
+        :param fetch: does the upstream call and populates the cache
+        :param load: reads the cache, returns None on a miss
+        :returns: result of fetch, or of load if another process fetched
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._fetch_with_lease(key, fetch, load)
+            return call.result
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _fetch_with_lease(self, key: str, fetch: Callable[[], Any],
+                          load: Callable[[], Any]) -> Any:
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait_timeout
+        delay = self.poll_interval
+        while True:
+            try:
+                acquired = self.redis.set(
+                    self.lease_key(key), token, nx=True,
+                    px=int(self.lease_seconds * 1000))
+            except RedisError as redis_error:
+                # never let a lease problem turn into an outage
+                logger.warning("Single-flight lease unavailable for %s: %s",
+                               key, redis_error)
+                return fetch()
+
+            if acquired:
+                try:
+                    # another node may have filled the cache meanwhile
+                    result = load()
+                    return result if result is not None else fetch()
+                finally:
+                    self._release(key, token)
+
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+            result = load()
+            if result is not None:
+                return result
+            if time.monotonic() >= deadline:
+                logger.warning("Timed out waiting on fetch for %s", key)
+                return fetch()
+
+    def _release(self, key: str, token: str) -> None:
+        try:
+            self.redis.eval(RELEASE_SCRIPT, 1, self.lease_key(key), token)
+        except RedisError as redis_error:
+            # the lease expires on its own
+            logger.warning("Could not release lease for %s: %s",
+                           key, redis_error)
+
+    def in_flight(self) -> int:
+        """Number of keys currently being fetched by this process."""
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """
+    Asyncio counterpart of SingleFlight, waiters are tasks of one loop.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, redis_client, lease_seconds: float = 15,
+                 wait_timeout: float = 15, poll_interval: float = 0.025,
+                 max_poll_interval: float = 0.2):
+        """
+        :param redis_client: asyncio client used for the cross process lease
+        Other parameters are the same as SingleFlight ones.
+        """
+        self.redis = redis_client
+        self.lease_seconds = lease_seconds
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._calls: dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fetch: Callable[[], Awaitable[Any]],
+                 load: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Await `fetch` once for `key` and share its result.
+        :param fetch: coroutine function doing the upstream call
+        :param load: coroutine function reading the cache
+        """
+        call = self._calls.get(key)
+        if call is not None:
+            # shield so one cancelled waiter does not cancel the others
+            return await asyncio.shield(call)
+
+        call = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._fetch_with_lease(key, fetch, load)
+            call.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except BaseException as error:
+            call.set_exception(error)
+            # mark retrieved, waiters are optional
+            call.exception()
+            raise
+        finally:
+            del self._calls[key]
+
+    async def _fetch_with_lease(self, key: str,
+                                fetch: Callable[[], Awaitable[Any]],
+                                load: Callable[[], Awaitable[Any]]) -> Any:
+        token = uuid.uuid4().hex
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_timeout
+        delay = self.poll_interval
+        while True:
+            try:
+                acquired = await self.redis.set(
+                    SingleFlight.lease_key(key), token, nx=True,
+                    px=int(self.lease_seconds * 1000))
+            except RedisError as redis_error:
+                logger.warning("Single-flight lease unavailable for %s: %s",
+                               key, redis_error)
+                return await fetch()
+
+            if acquired:
+                try:
+                    result = await load()
+                    return result if result is not None else await fetch()
+                finally:
+                    await self._release(key, token)
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+            result = await load()
+            if result is not None:
+                return result
+            if loop.time() >= deadline:
+                logger.warning("Timed out waiting on fetch for %s", key)
+                return await fetch()
+
+    async def _release(self, key: str, token: str) -> None:
+        try:
+            await self.redis.eval(RELEASE_SCRIPT, 1, SingleFlight.lease_key(key), token)
+        except RedisError as redis_error:
+            logger.warning("Could not release lease for %s: %s",
+                           key, redis_error)
+
+    def in_flight(self) -> int:
+        """Number of keys currently being fetched by this process."""
+        return len(self._calls)
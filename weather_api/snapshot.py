@@ -0,0 +1,173 @@
+"""
+Snapshots of the cache, to warm up a new or flushed Redis without
+fetching every city from the 3rd party API again.
+
+    flask --app run cache-snapshot export cache.snap
+    flask --app run cache-snapshot import cache.snap
+
+Entries are copied in the Redis DUMP format along with their remaining
+TTL, as a zstd compressed stream of msgpack records. Both ways stream in
+batches, memory stays bounded whatever the size of the cache.
+"""
+import os
+import time
+from typing import BinaryIO, Optional
+
+import click
+import msgpack
+import zstandard
+from flask.cli import AppGroup
+
+FORMAT = "weather-cache-snapshot"
+VERSION = 1
+# Keys read or written per pipeline round trip
+BATCH_SIZE = int(os.getenv("SNAPSHOT_BATCH_SIZE", "500"))
+# zstd level of the snapshot stream
+COMPRESSION_LEVEL = int(os.getenv("SNAPSHOT_COMPRESSION_LEVEL", "6"))
+
+
+class SnapshotError(ValueError):
+    """A file that is not a cache snapshot this version can read."""
+
+
+def export_snapshot(redis_client, target: BinaryIO, match: str,
+                    batch_size: int = BATCH_SIZE,
+                    level: int = COMPRESSION_LEVEL) -> int:
+    """
+    Write every key matching `match` to `target`.
+    :param match: SCAN pattern of the keys, like "flask_cache_*"
+    :returns: number of entries written
+    """
+    written = 0
+    writer = zstandard.ZstdCompressor(level=level).stream_writer(target, closefd=False)
+    packer = msgpack.Packer(use_bin_type=True)
+    with writer:
+        writer.write(packer.pack({"format": FORMAT, "version": VERSION,
+                                  "created_at": time.time(), "match": match}))
+        keys = []
+        for key in redis_client.scan_iter(match=match, count=batch_size):
+            keys.append(key)
+            if len(keys) == batch_size:
+                written += _export_batch(redis_client, keys, writer, packer)
+                keys = []
+        if keys:
+            written += _export_batch(redis_client, keys, writer, packer)
+    return written
+
+
+def _export_batch(redis_client, keys: list[bytes], writer, packer) -> int:
+    """Dump a batch of keys in one round trip, keys gone meanwhile are skipped."""
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.dump(key)
+        pipe.pttl(key)
+    results = pipe.execute()
+    written = 0
+    for key, dumped, pttl in zip(keys, results[::2], results[1::2]):
+        if dumped is None or pttl == -2:
+            continue
+        # -1, no expiry, is kept as is
+        writer.write(packer.pack((key, pttl, dumped)))
+        written += 1
+    return written
+
+
+def read_header(unpacker: msgpack.Unpacker) -> dict:
+    """
+    First record of a snapshot.
+    :raises SnapshotError: when it is not the header of a snapshot we can read
+    """
+    try:
+        header = next(unpacker)
+    except (StopIteration, ValueError, zstandard.ZstdError) as error:
+        raise SnapshotError(f"Not a cache snapshot: {error}") from error
+    if not isinstance(header, dict) or header.get("format") != FORMAT:
+        raise SnapshotError("Not a cache snapshot")
+    if header.get("version") != VERSION:
+        raise SnapshotError(f"Unsupported snapshot version {header.get('version')}")
+    return header
+
+
+def import_snapshot(redis_client, source: BinaryIO, replace: bool = False,
+                    batch_size: int = BATCH_SIZE,
+                    now: Optional[float] = None) -> tuple[int, int]:
+    """
+    Restore the entries of a snapshot. TTLs run from when the snapshot
+    was taken, entries which have expired since are skipped.
+    :param replace: overwrite existing keys, they are kept by default
+    :returns: entries restored and entries skipped
+    :raises SnapshotError: when `source` is not a snapshot
+    """
+    unpacker = msgpack.Unpacker(
+        zstandard.ZstdDecompressor().stream_reader(source, closefd=False), raw=False)
+    elapsed_ms = int(((now or time.time()) - read_header(unpacker)["created_at"]) * 1000)
+    restored = skipped = 0
+    pending = []
+    for key, pttl, dumped in unpacker:
+        if pttl >= 0:
+            pttl -= elapsed_ms
+            if pttl <= 0:
+                skipped += 1
+                continue
+        pending.append((key, max(pttl, 0), dumped))
+        if len(pending) == batch_size:
+            done = _import_batch(redis_client, pending, replace)
+            restored, skipped = restored + done, skipped + len(pending) - done
+            pending = []
+    if pending:
+        done = _import_batch(redis_client, pending, replace)
+        restored, skipped = restored + done, skipped + len(pending) - done
+    return restored, skipped
+
+
+def _import_batch(redis_client, entries: list[tuple], replace: bool) -> int:
+    """RESTORE a batch in one round trip, existing keys fail unless replaced."""
+    pipe = redis_client.pipeline(transaction=False)
+    for key, pttl, dumped in entries:
+        pipe.restore(key, pttl, dumped, replace=replace)
+    results = pipe.execute(raise_on_error=False)
+    return sum(1 for result in results if not isinstance(result, Exception))
+
+
+def init_app(app, redis_client, match: str, invalidate) -> None:
+    """
+    Add the cache-snapshot commands to the app cli.
+    :param redis_client: client of the Redis holding the cache
+    :param match: SCAN pattern of the cache keys
+    :param invalidate: drops the local tier copies of every worker
+    """
+    snapshot_cli = AppGroup("cache-snapshot", help="Export and import cache snapshots.")
+
+    @snapshot_cli.command("export")
+    @click.argument("path", type=click.Path(dir_okay=False, writable=True))
+    @click.option("--batch-size", default=BATCH_SIZE, help="Keys per round trip.")
+    @click.option("--level", default=COMPRESSION_LEVEL, help="zstd compression level.")
+    def export_command(path, batch_size, level):
+        """Write every cache entry to PATH."""
+        started = time.perf_counter()
+        # written next to PATH first, a failed export leaves PATH as it was
+        partial = f"{path}.partial"
+        with open(partial, "wb") as target:
+            written = export_snapshot(redis_client, target, match, batch_size, level)
+        os.replace(partial, path)
+        click.echo(f"Exported {written} entries to {path} "
+                   f"({os.path.getsize(path)} bytes, {time.perf_counter() - started:.1f}s)")
+
+    @snapshot_cli.command("import")
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--batch-size", default=BATCH_SIZE, help="Keys per round trip.")
+    @click.option("--replace", is_flag=True, help="Overwrite entries already cached.")
+    def import_command(path, batch_size, replace):
+        """Load the cache entries of the snapshot at PATH."""
+        started = time.perf_counter()
+        with open(path, "rb") as source:
+            try:
+                restored, skipped = import_snapshot(redis_client, source, replace,
+                                                    batch_size)
+            except SnapshotError as snapshot_error:
+                raise click.ClickException(str(snapshot_error)) from snapshot_error
+        invalidate()
+        click.echo(f"Imported {restored} entries from {path}, skipped {skipped} "
+                   f"expired or already cached ({time.perf_counter() - started:.1f}s)")
+
+    app.cli.add_command(snapshot_cli)
@@ -0,0 +1,390 @@
+"""
+Push forecast changes to subscribed clients instead of having them poll.
+
+Every cache write is already broadcast to all workers on the L1
+invalidation channel, the hub of each worker listens to it for the
+forecasts its clients watch. When one changes, the new forecast is
+diffed once against the one clients were last sent and the JSON patch
+(RFC 6902) is queued to every subscriber of the city.
+
+Watched forecasts are loaded through the cache like any other request
+once per interval, so each city is refreshed upstream once however many
+clients watch it, by whichever worker notices it going stale first.
+
+Subscribers per process are capped: a stream served by the Flask app
+holds a worker thread for as long as the client stays connected, the
+ASGI app waits for events without one.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Callable, NamedTuple, Optional
+
+from . import metrics
+from .payload import CachedPayload
+
+logger = logging.getLogger(__name__)
+
+# List items holding this key are days or hours, matched by it when diffed
+ITEM_KEY = "datetime"
+
+
+def pointer(key: Any) -> str:
+    """JSON pointer token of an object key or list index."""
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def keyed(items: list) -> bool:
+    """Whether list items can be matched by ITEM_KEY rather than position."""
+    return bool(items) and all(isinstance(item, dict) and ITEM_KEY in item
+                               for item in items)
+
+
+def diff_keyed(old: list, new: list, path: str) -> Optional[list[dict]]:
+    """
+    Diff lists of days or hours by their datetime, a forecast moving on by
+    a day drops the first day and adds a last one instead of shifting them all.
+    :returns: None when the items cannot be matched this way
+    """
+    new_keys = [item[ITEM_KEY] for item in new]
+    wanted = set(new_keys)
+    old_keys = [item[ITEM_KEY] for item in old]
+    kept = [item for item in old if item[ITEM_KEY] in wanted]
+    if (len(set(old_keys)) != len(old_keys) or len(wanted) != len(new_keys)
+            or [item[ITEM_KEY] for item in kept]
+            != [key for key in new_keys if key in set(old_keys)]):
+        return None
+    # removed from the end first, so the indices left to remove hold
+    ops = [{"op": "remove", "path": f"{path}/{index}"}
+           for index in range(len(old) - 1, -1, -1) if old_keys[index] not in wanted]
+    position = 0
+    for index, item in enumerate(new):
+        if position < len(kept) and kept[position][ITEM_KEY] == item[ITEM_KEY]:
+            ops.extend(json_diff(kept[position], item, f"{path}/{index}"))
+            position += 1
+        else:
+            ops.append({"op": "add", "path": f"{path}/{index}", "value": item})
+    return ops
+
+
+def diff_list(old: list, new: list, path: str) -> list[dict]:
+    """Diff lists item by item, then trim or extend the tail."""
+    if keyed(old) and keyed(new):
+        ops = diff_keyed(old, new, path)
+        if ops is not None:
+            return ops
+    ops = []
+    for index, (old_item, new_item) in enumerate(zip(old, new)):
+        ops.extend(json_diff(old_item, new_item, f"{path}/{index}"))
+    ops.extend({"op": "remove", "path": f"{path}/{index}"}
+               for index in range(len(old) - 1, len(new) - 1, -1))
+    ops.extend({"op": "add", "path": f"{path}/-", "value": item}
+               for item in new[len(old):])
+    return ops
+
+
+def json_diff(old: Any, new: Any, path: str = "") -> list[dict]:
+    """
+    JSON patch (RFC 6902) turning `old` into `new`.
+    Only changed values are sent, objects and lists are diffed member by member.
+    """
+    if old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = [{"op": "remove", "path": f"{path}/{pointer(key)}"}
+               for key in old if key not in new]
+        for key, value in new.items():
+            if key in old:
+                ops.extend(json_diff(old[key], value, f"{path}/{pointer(key)}"))
+            else:
+                ops.append({"op": "add", "path": f"{path}/{pointer(key)}", "value": value})
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        return diff_list(old, new, path)
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+class Event(NamedTuple):
+    """An event, encoded once for all of its subscribers."""
+    name: str
+    # etag of the forecast the event leaves the client with
+    etag: str
+    # json object, with the event name in it
+    data: bytes
+
+    def sse(self) -> bytes:
+        """Server-Sent Events framing."""
+        return b"event: %s\nid: %s\ndata: %s\n\n" % (
+            self.name.encode(), self.etag.encode(), self.data)
+
+    def ndjson(self) -> bytes:
+        """One line of NDJSON."""
+        return self.data + b"\n"
+
+
+def snapshot_event(city: str, payload: CachedPayload) -> Event:
+    """Whole forecast a subscriber starts from, cached bytes embedded as they are."""
+    head = json.dumps({"event": "snapshot", "city": city, "etag": payload.etag})
+    return Event("snapshot", payload.etag,
+                 head[:-1].encode() + b', "data": ' + payload.body + b"}")
+
+
+def error_event(message: str) -> Event:
+    """Last event of a stream ended by an error, clients resubscribe."""
+    return Event("error", "", json.dumps({"event": "error", "message": message}).encode())
+
+
+def patch_event(city: str, base: str, etag: str, patch: list[dict]) -> Event:
+    """Changes turning the `base` forecast into the `etag` one."""
+    return Event("patch", etag, json.dumps({
+        "event": "patch", "city": city, "base": base, "etag": etag, "patch": patch
+    }).encode())
+
+
+class SubscribersExceededError(Exception):
+    """The process streams to as many subscribers as it may."""
+
+    def __init__(self, limit: int, retry_after: int = 30):
+        super().__init__(f"Stream subscribers limit of {limit} reached")
+        self.retry_after = retry_after
+
+
+class Subscription:
+    """Events queued for one client, closed when it does not keep up."""
+
+    def __init__(self, size: int):
+        self.events: queue.Queue = queue.Queue(maxsize=size)
+        # redis keys of the forecasts watched
+        self.keys: set[str] = set()
+        self.closed = False
+        # counted in the subscribers gauge, until unsubscribed
+        self.active = False
+        # called from the hub thread once an event is queued, to wake up
+        # streams not blocked in get
+        self.wakeup: Optional[Callable[[], None]] = None
+
+    def send(self, event: Event) -> bool:
+        """Queue an event, a full queue closes the subscription."""
+        if self.closed:
+            return False
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.close()
+            return False
+        metrics.STREAM_EVENTS.labels(event.name).inc()
+        self._wake()
+        return True
+
+    def close(self) -> None:
+        """Drop what is queued and end the stream, clients reconnect from a snapshot."""
+        self.closed = True
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                break
+        self.events.put_nowait(None)
+        self._wake()
+
+    def _wake(self) -> None:
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def get(self, timeout: float) -> Optional[Event]:
+        """
+        Next event, waiting at most `timeout` seconds.
+        :raises queue.Empty: when nothing came meanwhile
+        """
+        return self.events.get(timeout=timeout)
+
+    def get_nowait(self) -> Optional[Event]:
+        """
+        Next event, None once the stream is closed.
+        :raises queue.Empty: when none is queued
+        """
+        return self.events.get_nowait()
+
+
+class Watch:  # pylint: disable=too-few-public-methods
+    """A forecast clients watch, as they were last sent it."""
+
+    def __init__(self, city: str, payload: CachedPayload):
+        self.city = city
+        self.payload = payload
+        self.document = json.loads(payload.body)
+        self.subscribers: set[Subscription] = set()
+
+
+class StreamHub:  # pylint: disable=too-many-instance-attributes
+    """
+    Per process fan-out of forecast changes to subscribed clients.
+
+    `notify` is called for every cache key written by any worker, changes
+    of watched forecasts are diffed on the hub thread, which also reloads
+    every watched forecast once per interval so they are refreshed before
+    they go stale.
+    """
+
+    def __init__(self, interval: float = 60, queue_size: int = 64,
+                 max_subscribers: int = 0):
+        """
+        :param interval: seconds between two reloads of the watched forecasts
+        :param queue_size: events queued per subscriber before it is dropped
+        :param max_subscribers: subscribers streamed to at once, 0 for no limit
+        """
+        self.interval = interval
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.subscribers = 0
+        self.app = None
+        # city -> (redis key, cached forecast)
+        self.load: Optional[Callable[[str], tuple[str, CachedPayload]]] = None
+        self._watched: dict[str, Watch] = {}
+        self._changes: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+
+    def init_app(self, app, load: Callable[[str], tuple[str, CachedPayload]]):
+        """
+        Bind the app forecasts are loaded for.
+        :param load: returns the redis key and cached forecast of a city,
+            fetching it when missing or stale like a request would
+        """
+        self.app = app
+        self.load = load
+
+    def subscribe(self, cities: list[str], load: Optional[Callable[[str], tuple[
+            str, CachedPayload]]] = None) -> tuple[Subscription, list[Event]]:
+        """
+        Watch the forecasts of `cities`.
+        :param load: loads the forecasts instead of the hub, already
+            loaded ones for callers that must not block
+        :returns: the subscription and a snapshot event per city to send first
+        :raises SubscribersExceededError: when max_subscribers are streamed to
+        :raises: what loading a forecast raises, nothing is watched then
+        """
+        self._ensure_started()
+        subscription = Subscription(self.queue_size)
+        with self._lock:
+            if self.max_subscribers and self.subscribers >= self.max_subscribers:
+                raise SubscribersExceededError(self.max_subscribers)
+            # the slot is taken before loading, concurrent subscribers do not overshoot
+            self.subscribers += 1
+            subscription.active = True
+        metrics.STREAM_SUBSCRIBERS.inc()
+        snapshots = []
+        try:
+            for city in dict.fromkeys(cities):
+                key, payload = (load or self.load)(city)
+                with self._lock:
+                    watch = self._watched.get(key)
+                    if watch is None:
+                        watch = self._watched[key] = Watch(city, payload)
+                    watch.subscribers.add(subscription)
+                    subscription.keys.add(key)
+                    # patches are diffed against what the hub holds
+                    snapshots.append(snapshot_event(city, watch.payload))
+        except Exception:
+            self.unsubscribe(subscription)
+            raise
+        return subscription, snapshots
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """Stop watching forecasts nobody else watches."""
+        with self._lock:
+            for key in subscription.keys:
+                watch = self._watched.get(key)
+                if watch is None:
+                    continue
+                watch.subscribers.discard(subscription)
+                if not watch.subscribers:
+                    del self._watched[key]
+            subscription.keys = set()
+            # dropped slow subscribers are unsubscribed again when their stream ends
+            active, subscription.active = subscription.active, False
+            if active:
+                self.subscribers -= 1
+        subscription.closed = True
+        if active:
+            metrics.STREAM_SUBSCRIBERS.dec()
+
+    def notify(self, key: str) -> None:
+        """Cache change hook, runs on the invalidation listener and must not block."""
+        if key in self._watched:
+            self._changes.put_nowait(key)
+
+    def update(self, key: str) -> None:
+        """Reload a watched forecast and send subscribers what changed."""
+        with self._lock:
+            watch = self._watched.get(key)
+        if watch is None:
+            return
+        try:
+            with self.app.app_context() if self.app else nullcontext():
+                _, payload = self.load(watch.city)
+        # subscribers keep the last forecast until the next reload
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            logger.warning("Stream reload of %s failed: %s", watch.city, error)
+            return
+        self.publish(key, payload)
+
+    def publish(self, key: str, payload: CachedPayload) -> None:
+        """Diff a watched forecast against what subscribers have, queue the patch."""
+        with self._lock:
+            watch = self._watched.get(key)
+            if watch is None or payload.etag == watch.payload.etag:
+                return
+            document = json.loads(payload.body)
+            event = patch_event(watch.city, watch.payload.etag, payload.etag,
+                                json_diff(watch.document, document))
+            watch.payload, watch.document = payload, document
+            dropped = [subscription for subscription in watch.subscribers
+                       if not subscription.send(event)]
+        for subscription in dropped:
+            logger.info("Dropping slow stream subscriber", extra={"city": watch.city})
+            self.unsubscribe(subscription)
+
+    def run_once(self) -> None:
+        """Reload every watched forecast, stale ones get refreshed."""
+        with self._lock:
+            keys = list(self._watched)
+        for key in keys:
+            self.update(key)
+
+    def _run(self) -> None:
+        next_pass = time.monotonic() + self.interval
+        while True:
+            pending = set()
+            try:
+                pending.add(self._changes.get(
+                    timeout=max(0.0, next_pass - time.monotonic())))
+                # a burst of writes is handled once per key
+                while True:
+                    pending.add(self._changes.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                for key in pending:
+                    self.update(key)
+                if time.monotonic() >= next_pass:
+                    next_pass = time.monotonic() + self.interval
+                    self.run_once()
+            # the hub must outlive any single failed pass
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                logger.warning("Stream hub pass failed: %s", error)
+
+    def _ensure_started(self) -> None:
+        """Start the hub thread once per (forked) process."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._watched = {}
+                self.subscribers = 0
+                self._changes = queue.Queue()
+                threading.Thread(target=self._run, name="stream-hub",
+                                 daemon=True).start()
+                self._pid = os.getpid()
@@ -0,0 +1,333 @@
+"""Unit tests for the asyncio services and the ASGI app."""
+import asyncio
+import json
+import time
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import fakeredis
+import httpx
+
+from weather_api.asgi import create_asgi_app
+from weather_api.async_services import (get_forecast_async,
+                                        get_forecast_elements_async,
+                                        get_weather_async, serializer)
+from weather_api.extensions import stream_hub
+from weather_api.normalize import normalized_etag
+from weather_api.payload import CachedPayload
+from weather_api.projection import today_payload
+from weather_api.quota import QuotaExceededError
+from weather_api.services import (BASE_URL, FORECAST_HARD_TTL, WEATHER_SOFT_TTL,
+                                  forecast_query, weather_query)
+from weather_api.tiered_cache import validator_key
+
+
+def upstream_response(status_code: int, json_body=None) -> httpx.Response:
+    """Build an upstream response as returned by httpx."""
+    return httpx.Response(status_code, json=json_body,
+                          request=httpx.Request("GET", BASE_URL))
+
+
+class TestAsyncServices(unittest.IsolatedAsyncioTestCase):
+    """Test the asyncio services share the sync cache layout."""
+
+    async def asyncSetUp(self):
+        """Fake redis and upstream for every test."""
+        self.redis = fakeredis.FakeAsyncRedis()
+        patch('weather_api.async_services.async_redis', self.redis).start()
+        patch('weather_api.async_services.async_single_flight.redis',
+              self.redis).start()
+        self.mock_get = patch(
+            'weather_api.async_services.async_http_client.get',
+            new_callable=AsyncMock).start()
+
+    async def asyncTearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    async def test_miss_fetches_and_caches(self):
+        """A miss calls upstream once and caches the payload."""
+        self.mock_get.return_value = upstream_response(200, {"days": []})
+
+        payload = await get_forecast_async("Madrid")
+
+        query = forecast_query("Madrid")
+        self.mock_get.assert_awaited_once_with(
+            query.url, params=query.params, timeout=10)
+        self.assertEqual(payload.json(), {"days": []})
+        cached = serializer.loads(
+            await self.redis.get("flask_cache_" + query.redis_key))
+        self.assertEqual(cached, payload)
+
+    async def test_hit_skips_upstream(self):
+        """Entries written by the sync services are served."""
+        query = forecast_query("Madrid")
+        await self.redis.set("flask_cache_" + query.redis_key,
+                             serializer.dumps({"address": "Madrid"}))
+
+        payload = await get_forecast_async("Madrid")
+
+        self.assertEqual(payload.json(), {"address": "Madrid"})
+        self.mock_get.assert_not_awaited()
+
+    async def test_concurrent_misses_share_one_fetch(self):
+        """Concurrent tasks missing the same key await a single fetch."""
+        async def slow_get(*_args, **_kwargs):
+            await asyncio.sleep(0.01)
+            return upstream_response(200, {"address": "London"})
+        self.mock_get.side_effect = slow_get
+
+        results = await asyncio.gather(
+            *(get_weather_async("London") for _ in range(20)))
+
+        self.mock_get.assert_awaited_once()
+        self.assertEqual(len({payload.etag for payload in results}), 1)
+
+    async def test_upstream_error_is_raised(self):
+        """Unsuccessful responses raise and are not cached."""
+        self.mock_get.return_value = upstream_response(500)
+        with self.assertRaises(httpx.HTTPStatusError):
+            await get_forecast_elements_async("Madrid", ["wind"])
+        self.assertEqual(await self.redis.dbsize(), 0)
+
+
+    async def test_exhausted_budget_serves_expired_entry(self):
+        """An entry kept past its hard TTL is served, marked as stale."""
+        query = forecast_query("Madrid")
+        expired = CachedPayload.from_data(
+            {"address": "Madrid"}, created_at=time.time() - FORECAST_HARD_TTL - 60)
+        await self.redis.set("flask_cache_" + query.redis_key, serializer.dumps(expired))
+
+        with patch('weather_api.async_services.async_upstream_budget.take',
+                   new_callable=AsyncMock,
+                   side_effect=QuotaExceededError("spent", retry_after=30)):
+            payload = await get_forecast_async("Madrid")
+
+        self.assertTrue(payload.stale)
+        self.assertEqual(payload.json(), {"address": "Madrid"})
+        self.mock_get.assert_not_awaited()
+
+
+    @patch('weather_api.async_services.refresher.record')
+    async def test_requests_are_counted(self, mock_record):
+        """Served queries count towards popularity, like in the sync services."""
+        await self.redis.set("flask_cache_" + forecast_query("Madrid").redis_key,
+                             serializer.dumps({"address": "Madrid"}))
+        await get_forecast_async("Madrid")
+        mock_record.assert_called_once_with(forecast_query("Madrid").member)
+
+    @patch('weather_api.async_services.count_saved')
+    async def test_projection_counts_saved_call(self, mock_count_saved):
+        """Elements projected out of the forecast count the call they saved."""
+        forecast = CachedPayload.from_data(
+            {"days": [{"datetime": "2025-06-01", "temp": 20.0, "humidity": 50.0}]})
+        await self.redis.set("flask_cache_" + forecast_query("Madrid").redis_key,
+                             serializer.dumps(forecast))
+
+        payload = await get_forecast_elements_async("Madrid", ["temp"])
+
+        mock_count_saved.assert_called_once_with("elements", payload.etag, 15)
+        self.mock_get.assert_not_awaited()
+
+    @patch('weather_api.async_services.count_saved')
+    async def test_weather_from_timeline(self, mock_count_saved):
+        """Today's weather is the one the sync services derive from the timeline."""
+        timeline = CachedPayload.from_data(
+            {"address": "Madrid", "currentConditions": {"temp": 19.0},
+             "days": [{"datetime": "2025-06-01"}, {"datetime": "2025-06-02"}]},
+            created_at=time.time() - 60)
+        await self.redis.set("flask_cache_forecast_Madrid", serializer.dumps(timeline))
+
+        payload = await get_weather_async("Madrid")
+
+        self.assertEqual(payload.etag, today_payload(timeline).etag)
+        self.assertEqual(payload.json()["days"], [{"datetime": "2025-06-01"}])
+        self.mock_get.assert_not_awaited()
+        mock_count_saved.assert_called_once_with("weather", payload.etag, 1)
+
+    async def test_older_timeline_is_not_shared(self):
+        """Past the weather soft TTL, today's weather is fetched."""
+        timeline = CachedPayload.from_data(
+            {"currentConditions": {"temp": 19.0}, "days": [{"datetime": "2025-06-01"}]},
+            created_at=time.time() - WEATHER_SOFT_TTL - 60)
+        await self.redis.set("flask_cache_forecast_Madrid", serializer.dumps(timeline))
+        self.mock_get.return_value = upstream_response(200, {"days": [{"temp": 20.0}]})
+
+        payload = await get_weather_async("Madrid")
+
+        self.assertEqual(payload.json(), {"days": [{"temp": 20.0}]})
+        self.mock_get.assert_awaited_once()
+
+
+class TestAsgiApp(unittest.IsolatedAsyncioTestCase):
+    """Test the ASGI routes."""
+
+    async def asyncSetUp(self):
+        """Route requests to the ASGI app in process."""
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=create_asgi_app(auth=False)),
+            base_url="http://testserver")
+        self.payload = CachedPayload.from_data({"days": [{"temp": 1}] * 200})
+
+    async def asyncTearDown(self):
+        """Close the client."""
+        await self.client.aclose()
+
+    @patch('weather_api.asgi.get_forecast_async', new_callable=AsyncMock)
+    async def test_forecast_route(self, mock_forecast):
+        """Payload bytes and headers are sent as cached."""
+        mock_forecast.return_value = self.payload
+        response = await self.client.get("/api/forecast/Madrid",
+                                         headers={"Accept-Encoding": "identity"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.payload.body)
+        self.assertEqual(response.headers["etag"], f'"{self.payload.etag}"')
+        mock_forecast.assert_awaited_once_with("Madrid")
+
+    @patch('weather_api.asgi.get_forecast_elements_async', new_callable=AsyncMock)
+    async def test_elements_route(self, mock_elements):
+        """Repeated elements arguments are passed through."""
+        mock_elements.return_value = self.payload
+        await self.client.get("/api/forecast-elements/Madrid?elements=wind&elements=temp")
+        mock_elements.assert_awaited_once_with("Madrid", ["wind", "temp"])
+
+    @patch('weather_api.asgi.get_weather_async', new_callable=AsyncMock)
+    async def test_upstream_error(self, mock_weather):
+        """Upstream errors are reported like the Flask routes do."""
+        mock_weather.side_effect = httpx.HTTPStatusError(
+            "boom", request=httpx.Request("GET", BASE_URL),
+            response=upstream_response(400, {"bad": "city"}))
+        response = await self.client.get("/api/weather/Nowhere")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["status"], "error")
+
+    @patch('weather_api.async_services.get_forecast_async', new_callable=AsyncMock)
+    async def test_normalized_route(self, mock_forecast):
+        """Units are checked before the forecast is fetched."""
+        mock_forecast.return_value = self.payload
+        response = await self.client.get("/api/forecast/Madrid/normalized?units=us")
+        self.assertEqual(response.json()["daily"]["temp"], [33.8] * 200)
+
+        response = await self.client.get("/api/forecast/Madrid/normalized?units=si")
+        self.assertEqual(response.status_code, 400)
+        mock_forecast.assert_awaited_once_with("Madrid")
+
+    @patch('weather_api.asgi.get_weather_async', new_callable=AsyncMock)
+    async def test_not_modified_from_validator(self, mock_weather):
+        """A matching ETag is answered from the validator, the payload is not loaded."""
+        redis = fakeredis.FakeAsyncRedis()
+        patch('weather_api.async_services.async_redis', redis).start()
+        self.addCleanup(patch.stopall)
+        await redis.set("flask_cache_" + validator_key(weather_query("Madrid").redis_key),
+                        serializer.dumps((self.payload.etag, self.payload.created_at)))
+
+        response = await self.client.get(
+            "/api/weather/Madrid", headers={"If-None-Match": f'"{self.payload.etag}"'})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["etag"], f'"{self.payload.etag}"')
+
+        response = await self.client.get(
+            "/api/weather/Madrid", headers={"If-None-Match": f'"{self.payload.etag}-gzip"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["etag"], f'"{self.payload.etag}-gzip"')
+        mock_weather.assert_not_awaited()
+
+    @patch('weather_api.asgi.get_normalized_forecast_async', new_callable=AsyncMock)
+    async def test_not_modified_derived_etag(self, mock_normalized):
+        """Representations computed from an entry are validated by their own ETag."""
+        redis = fakeredis.FakeAsyncRedis()
+        patch('weather_api.async_services.async_redis', redis).start()
+        self.addCleanup(patch.stopall)
+        await redis.set("flask_cache_" + validator_key(forecast_query("Madrid").redis_key),
+                        serializer.dumps((self.payload.etag, self.payload.created_at)))
+        mock_normalized.return_value = self.payload
+
+        response = await self.client.get(
+            "/api/forecast/Madrid/normalized?units=us",
+            headers={"If-None-Match": f'"{normalized_etag(self.payload.etag, "us")}"'})
+        self.assertEqual(response.status_code, 304)
+        mock_normalized.assert_not_awaited()
+
+        response = await self.client.get(
+            "/api/forecast/Madrid/normalized?units=metric",
+            headers={"If-None-Match": f'"{normalized_etag(self.payload.etag, "us")}"'})
+        self.assertEqual(response.status_code, 200)
+        mock_normalized.assert_awaited_once_with("Madrid", "metric")
+
+        response = await self.client.get(
+            "/api/forecast/Madrid/normalized?units=si",
+            headers={"If-None-Match": f'"{normalized_etag(self.payload.etag, "us")}"'})
+        self.assertEqual(response.status_code, 400)
+
+    @patch('weather_api.asgi.get_forecast_async', new_callable=AsyncMock)
+    async def test_unexpected_error(self, mock_forecast):
+        """Errors the views do not expect are answered with a 500."""
+        mock_forecast.side_effect = ValueError("boom")
+        response = await self.client.get("/api/forecast/Madrid")
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()["status"], "error")
+
+    async def test_other_routes_are_served_by_flask(self):
+        """Routes without a coroutine are answered by the Flask views."""
+        response = await self.client.post("/api/weather/batch", json={"cities": []})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("cities", response.json()["message"])
+
+        with patch('weather_api.routes.get_weather_many',
+                   return_value=iter([("Oslo", self.payload)])):
+            response = await self.client.post("/api/weather/batch", json={"cities": ["Oslo"]})
+        self.assertEqual(response.headers["content-type"], "application/x-ndjson")
+        self.assertEqual(json.loads(response.text)["data"], self.payload.json())
+
+        with patch('weather_api.routes.upstream_router.stats',
+                   return_value={"providers": []}):
+            response = await self.client.get("/api/providers")
+        self.assertEqual(response.json(), {"providers": []})
+
+    @patch('weather_api.asgi.get_forecast_async', new_callable=AsyncMock)
+    async def test_stream_route(self, mock_forecast):
+        """Streams are served without a worker thread, woken up by the hub."""
+        mock_forecast.return_value = self.payload
+        app = create_asgi_app(auth=False)
+        sent: asyncio.Queue = asyncio.Queue()
+        disconnect = asyncio.Event()
+
+        async def receive():
+            if not disconnect.is_set():
+                await disconnect.wait()
+            return {"type": "http.disconnect"}
+
+        scope = {"type": "http", "method": "GET", "path": "/api/stream",
+                 "query_string": b"city=Oslo&format=ndjson", "headers": []}
+        with patch('weather_api.asgi.serve_wsgi') as mock_wsgi:
+            task = asyncio.create_task(app(scope, receive, sent.put))
+            start = await sent.get()
+            self.assertEqual(start["status"], 200)
+            snapshot = json.loads((await sent.get())["body"])
+            self.assertEqual(snapshot["etag"], self.payload.etag)
+
+            changed = CachedPayload.from_data({"days": [{"temp": 2}] * 200})
+            await asyncio.to_thread(stream_hub.publish,
+                                    forecast_query("Oslo").redis_key, changed)
+            change = json.loads((await asyncio.wait_for(sent.get(), 1))["body"])
+            self.assertEqual((change["event"], change["etag"]), ("patch", changed.etag))
+
+            disconnect.set()
+            await asyncio.wait_for(task, 1)
+        mock_wsgi.assert_not_called()
+        self.assertEqual(stream_hub.subscribers, 0)
+
+    async def test_stream_arguments(self):
+        """Invalid streams are refused like the Flask route does."""
+        response = await self.client.get("/api/stream?format=xml")
+        self.assertEqual(response.status_code, 400)
+
+    async def test_unknown_route(self):
+        """Unknown paths are a 404."""
+        response = await self.client.get("/api/unknown")
+        self.assertEqual(response.status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
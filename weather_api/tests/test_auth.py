@@ -0,0 +1,134 @@
+"""Unit tests for API keys and rate limits."""
+import unittest
+from unittest.mock import patch
+
+import fakeredis
+import httpx
+
+from weather_api import create_app
+from weather_api.asgi import create_asgi_app
+from weather_api.auth import (ApiClient, ApiKeyAuth, AsyncApiKeyAuth,
+                              KeyPolicy)
+from weather_api.payload import CachedPayload
+
+
+class TestRateLimit(unittest.TestCase):
+    """Test the sliding window arithmetic."""
+
+    def setUp(self):
+        """Keys and counters in a fake redis."""
+        self.auth = ApiKeyAuth(fakeredis.FakeRedis())
+        self.client = ApiClient(name="acme", limit=10, window=60)
+
+    def test_previous_window_is_weighted(self):
+        """Requests of the previous window count for what is left of it."""
+        now = 600 + 15
+        rate_limit = KeyPolicy.rate_limit(self.client, now, [1, 2, 8])
+
+        # 8 * 0.75 + 2 = 8 used
+        self.assertEqual(rate_limit.remaining, 2)
+        self.assertEqual(rate_limit.reset, 45)
+
+    def test_denied_request_retry_after(self):
+        """Retry-After is when enough of the previous window faded."""
+        rate_limit = KeyPolicy.rate_limit(self.client, 600 + 15, [0, 4, 8])
+
+        # 8 * 0.75 + 4 = 10, one request more needs 1/8 of the window
+        self.assertFalse(rate_limit.allowed)
+        self.assertEqual(rate_limit.headers()["Retry-After"], "8")
+
+    def test_limit_is_enforced(self):
+        """Requests beyond the limit in one window are denied."""
+        allowed = [self.auth.hit(self.client).allowed for _ in range(12)]
+        self.assertEqual(allowed, [True] * 10 + [False] * 2)
+
+    def test_keys_are_cached(self):
+        """Known and unknown keys are only looked up once."""
+        api_key = self.auth.create_key("acme", limit=5)
+        with patch.object(self.auth.redis, 'hget', wraps=self.auth.redis.hget) as hget:
+            for _ in range(3):
+                self.assertEqual(self.auth.authenticate(api_key).limit, 5)
+                self.assertIsNone(self.auth.authenticate("unknown"))
+        self.assertEqual(hget.call_count, 2)
+
+    def test_revoked_key(self):
+        """Revoked keys stop working in the revoking process at once."""
+        api_key = self.auth.create_key("acme")
+        self.assertTrue(self.auth.revoke_key(api_key))
+        self.assertIsNone(self.auth.authenticate(api_key))
+
+
+class TestAuthRoutes(unittest.TestCase):
+    """Test API keys are required on the api routes."""
+
+    def setUp(self):
+        """App with a key allowed 2 requests a minute."""
+        self.redis = fakeredis.FakeRedis()
+        patch('weather_api.extensions.api_keys.redis', self.redis).start()
+        patch('weather_api.services.cache.get',
+              return_value=CachedPayload.from_data({"address": "Oslo"})).start()
+        self.app = create_app()
+        self.app.config['API_AUTH_ENABLED'] = True
+        self.client = self.app.test_client()
+        self.api_key = ApiKeyAuth(self.redis).create_key("acme", limit=2)
+
+    def tearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    def test_missing_or_invalid_key(self):
+        """Requests without a valid key are a 401."""
+        self.assertEqual(self.client.get('/api/weather/Oslo').status_code, 401)
+        response = self.client.get('/api/weather/Oslo', headers={'X-API-Key': 'nope'})
+        self.assertEqual(response.status_code, 401)
+
+    def test_rate_limit_headers_and_429(self):
+        """Responses carry the limit, requests past it are a 429."""
+        headers = {'X-API-Key': self.api_key}
+        first = self.client.get('/api/weather/Oslo', headers=headers)
+        self.client.get('/api/weather/Oslo', headers=headers)
+        denied = self.client.get('/api/weather/Oslo', headers=headers)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.headers['X-RateLimit-Limit'], '2')
+        self.assertEqual(first.headers['X-RateLimit-Remaining'], '1')
+        self.assertEqual(denied.status_code, 429)
+        self.assertEqual(denied.headers['X-RateLimit-Remaining'], '0')
+        self.assertIn('Retry-After', denied.headers)
+
+
+class TestAsgiAuth(unittest.IsolatedAsyncioTestCase):
+    """Test the ASGI app requires keys the same way."""
+
+    async def asyncSetUp(self):
+        """ASGI app with keys in a fake redis."""
+        server = fakeredis.FakeServer()
+        self.auth = AsyncApiKeyAuth(fakeredis.FakeAsyncRedis(server=server))
+        # keys are created from a sync client, like the CLI does
+        self.keys = ApiKeyAuth(fakeredis.FakeRedis(server=server))
+        patch('weather_api.asgi.async_api_keys', self.auth).start()
+        patch('weather_api.asgi.get_weather_async',
+              return_value=CachedPayload.from_data({"address": "Oslo"})).start()
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=create_asgi_app(auth=True)),
+            base_url="http://testserver")
+
+    async def asyncTearDown(self):
+        """Close the client and stop mocks."""
+        await self.client.aclose()
+        patch.stopall()
+
+    async def test_keys_and_limits(self):
+        """Known keys get through with rate limit headers."""
+        api_key = self.keys.create_key("acme", limit=1)
+
+        self.assertEqual((await self.client.get("/api/weather/Oslo")).status_code, 401)
+        response = await self.client.get("/api/weather/Oslo", headers={"X-API-Key": api_key})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["x-ratelimit-remaining"], "0")
+        response = await self.client.get("/api/weather/Oslo", headers={"X-API-Key": api_key})
+        self.assertEqual(response.status_code, 429)
+
+
+if __name__ == '__main__':
+    unittest.main()
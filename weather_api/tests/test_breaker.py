@@ -0,0 +1,123 @@
+"""Unit tests for the upstream circuit breakers."""
+import time
+import unittest
+from unittest.mock import patch
+
+import fakeredis
+
+from weather_api import create_app
+from weather_api.breaker import CircuitBreaker, CircuitOpenError
+from weather_api.payload import CachedPayload
+from weather_api.services import WEATHER_HARD_TTL, get_weather
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Test breaker state transitions, shared through redis."""
+
+    def setUp(self):
+        """Two workers sharing one fake redis."""
+        self.redis = fakeredis.FakeRedis()
+        self.breaker = CircuitBreaker(self.redis, min_calls=4, open_seconds=0.2,
+                                      slow_call_seconds=1)
+        self.other = CircuitBreaker(self.redis, min_calls=4, open_seconds=0.2,
+                                    slow_call_seconds=1)
+
+    def open_breaker(self):
+        """Fail enough calls to open the weather breaker."""
+        for failed in (False, True, True, False):
+            self.breaker.allow("weather")
+            self.breaker.record("weather", failed, 0.1)
+
+    def test_error_rate_opens_for_every_worker(self):
+        """Once half of the calls failed, all workers fail fast."""
+        self.open_breaker()
+
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.other.allow("weather")
+        self.assertEqual(raised.exception.retry_after, 1)
+        # other endpoints are not affected
+        self.other.allow("forecast")
+
+    def test_slow_calls_open(self):
+        """Calls past slow_call_seconds count like failures."""
+        for _ in range(4):
+            self.breaker.record("forecast", False, 2.5)
+        with self.assertRaises(CircuitOpenError):
+            self.other.allow("forecast")
+
+    def test_below_min_calls_stays_closed(self):
+        """A few failures alone do not open the breaker."""
+        for _ in range(3):
+            self.breaker.record("weather", True, 0.1)
+        self.other.allow("weather")
+
+    def test_half_open_single_probe(self):
+        """After the open period one probe goes through, its success closes."""
+        self.open_breaker()
+        time.sleep(0.25)
+
+        self.other.allow("weather")
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.allow("weather")
+        self.other.record("weather", False, 0.1)
+
+        self.breaker._open_until.clear()  # pylint: disable=protected-access
+        self.breaker.allow("weather")
+
+    def test_failed_probe_reopens(self):
+        """A failed probe opens the breaker for another period."""
+        self.open_breaker()
+        time.sleep(0.25)
+
+        self.other.allow("weather")
+        self.other.record("weather", True, 0.1)
+
+        with self.assertRaises(CircuitOpenError):
+            self.other.allow("weather")
+
+
+class TestStaleIfError(unittest.TestCase):
+    """Test expired entries are served while the breaker is open."""
+
+    def setUp(self):
+        """Open breaker, upstream never called."""
+        self.app = create_app()
+        self.app.config['API_AUTH_ENABLED'] = False
+        self.client = self.app.test_client()
+        self.mock_cache_get = patch('weather_api.services.cache.get').start()
+        patch('weather_api.services.refresher.record').start()
+        patch('weather_api.extensions.upstream_breaker.allow',
+              side_effect=CircuitOpenError("Upstream weather is unavailable", 30)).start()
+        self.mock_upstream = patch('weather_api.services.http_client.get').start()
+
+    def tearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    def test_expired_entry_is_served_as_stale(self):
+        """The last known value is marked as stale."""
+        self.mock_cache_get.return_value = CachedPayload.from_data(
+            {"address": "Oslo"}, created_at=time.time() - WEATHER_HARD_TTL - 60)
+
+        with self.app.app_context():
+            self.assertTrue(get_weather("Oslo").payload.stale)
+        response = self.client.get('/api/weather/Oslo')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Warning'], '110 - "Response is Stale"')
+        self.assertGreaterEqual(int(response.headers['Age']), WEATHER_HARD_TTL)
+        self.mock_upstream.assert_not_called()
+
+    def test_miss_fails_fast(self):
+        """Without a cached value clients are told when to come back."""
+        self.mock_cache_get.return_value = None
+
+        response = self.client.get('/api/weather/Oslo')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '30')
+        self.mock_upstream.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""Unit tests for the cache codec."""
+import pickle
+import unittest
+
+import msgpack
+
+from weather_api.codec import FORMAT_VERSION, PAYLOAD_EXT, CacheCodec
+from weather_api.payload import CachedPayload
+
+FORECAST = {"address": "Rome",
+            "days": [{"datetime": f"2025-01-{day:02d}", "temp": 10.5 + day,
+                      "conditions": "Partially cloudy"} for day in range(1, 31)]}
+
+
+class TestCacheCodec(unittest.TestCase):
+    """Test values survive a round trip through the codec."""
+
+    def setUp(self):
+        """Default codec."""
+        self.codec = CacheCodec()
+
+    def test_dict_round_trip(self):
+        """Plain documents are encoded with msgpack."""
+        encoded = self.codec.dumps(FORECAST)
+        self.assertEqual(encoded[0], FORMAT_VERSION)
+        self.assertEqual(self.codec.loads(encoded), FORECAST)
+
+    def test_payload_round_trip(self):
+        """Payloads come back equal, with and without a gzip variant."""
+        for precompress in (True, False):
+            payload = CachedPayload.from_data(FORECAST, precompress=precompress)
+            self.assertEqual(self.codec.loads(self.codec.dumps(payload)), payload)
+
+    def test_payload_stores_one_body(self):
+        """Only the smallest body is stored, the others are rebuilt when used."""
+        payload = CachedPayload.from_data(FORECAST)
+        encoded = self.codec.dumps(payload)
+        self.assertLess(len(encoded), len(payload.br_body) + 128)
+
+        loaded = self.codec.loads(encoded)
+        self.assertEqual(loaded.stored_body(), ("br", payload.br_body))
+        self.assertEqual(loaded.codings, ("br", "gzip"))
+        self.assertEqual(loaded.body, payload.body)
+        self.assertEqual(loaded.gzip_body, payload.gzip_body)
+
+    def test_payload_decoded_lazily(self):
+        """Reading a payload does not decompress its body."""
+        encoded = self.codec.dumps(CachedPayload.from_data(FORECAST))
+        loaded = self.codec.loads(encoded)
+        # pylint: disable=protected-access
+        self.assertEqual(list(loaded._bodies), ["br"])
+        body, headers = loaded.representation("br")
+        self.assertEqual(headers["Content-Encoding"], "br")
+        self.assertEqual(list(loaded._bodies), ["br"])
+        self.assertEqual(body, loaded.br_body)
+
+    def test_pickled_payload_stores_one_body(self):
+        """The pickle serializer keeps the smallest body alone too."""
+        payload = CachedPayload.from_data(FORECAST)
+        loaded = CacheCodec(serializer="pickle").loads(
+            CacheCodec(serializer="pickle").dumps(payload))
+        self.assertEqual(loaded.stored_body(), ("br", payload.br_body))
+        self.assertEqual(loaded.body, payload.body)
+
+    def test_large_values_are_compressed(self):
+        """Values above the threshold are stored compressed."""
+        for compression in ("zstd", "zlib"):
+            codec = CacheCodec(compression=compression, threshold=64)
+            encoded = codec.dumps(FORECAST)
+            self.assertLess(len(encoded), len(CacheCodec(compression="none").dumps(FORECAST)))
+            self.assertEqual(codec.loads(encoded), FORECAST)
+
+    def test_small_values_are_not_compressed(self):
+        """Values below the threshold are stored as serialized."""
+        encoded = self.codec.dumps({"temp": 1})
+        self.assertEqual(encoded[1] >> 4, 0)
+
+    def test_unsupported_types_fall_back_to_pickle(self):
+        """Anything msgpack cannot represent is still cached."""
+        value = {"cities": {"Rome", "Oslo"}}
+        self.assertEqual(self.codec.loads(self.codec.dumps(value)), value)
+
+    def test_legacy_values_are_read(self):
+        """Values written by the previous pickle serializer still load."""
+        legacy = b"!" + pickle.dumps(FORECAST)
+        self.assertEqual(self.codec.loads(legacy), FORECAST)
+        self.assertIsNone(self.codec.loads(None))
+
+    def test_payloads_without_brotli_variant(self):
+        """Payloads cached before brotli variants existed still load."""
+        payload = CachedPayload.from_data(FORECAST, precompress_brotli=False)
+        fields = msgpack.packb((None, payload.etag, payload.gzip_body, payload.created_at))
+        encoded = bytes((FORMAT_VERSION, 1)) + msgpack.packb(
+            msgpack.ExtType(PAYLOAD_EXT, fields))
+
+        loaded = self.codec.loads(encoded)
+        self.assertEqual(loaded, payload)
+        self.assertEqual(loaded.body, payload.body)
+        self.assertEqual(loaded.gzip_body, payload.gzip_body)
+        self.assertIsNone(loaded.br_body)
+
+    def test_unknown_settings(self):
+        """Misconfigured codecs fail early."""
+        with self.assertRaises(ValueError):
+            CacheCodec(compression="lz4")
+
+
+if __name__ == '__main__':
+    unittest.main()
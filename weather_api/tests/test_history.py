@@ -0,0 +1,172 @@
+"""Unit tests for the history store and its endpoint."""
+import math
+import os
+import tempfile
+import unittest
+from datetime import date, datetime, timezone
+from pathlib import Path
+from unittest.mock import patch
+
+from flask import Flask
+
+from weather_api import create_app
+from weather_api.extensions import history
+from weather_api.history import HistoryStore, HistoryQueryError, parse_range
+from weather_api.services import elements_query, forecast_query, record_history
+
+
+def document(day: str, temps: list, tzoffset: float = 2.0) -> dict:
+    """Timeline document of one day, an hour per temperature."""
+    return {"address": "Oslo", "tzoffset": tzoffset, "days": [{
+        "datetime": day,
+        "hours": [{"datetime": f"{hour:02d}:00:00", "temp": temp, "humidity": 80}
+                  for hour, temp in enumerate(temps)]}]}
+
+
+def utc(text: str) -> float:
+    """Unix time of a UTC date and time."""
+    return datetime.fromisoformat(text).replace(tzinfo=timezone.utc).timestamp()
+
+
+class TestHistoryStore(unittest.TestCase):
+    """Test completed hours are appended once and read back by range."""
+
+    def setUp(self):
+        """Store in a temporary directory."""
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.store = HistoryStore(self.directory.name, elements=("temp", "humidity"))
+
+    def test_only_completed_hours_are_appended_once(self):
+        """Hours still to come are left out, hours already stored too."""
+        temps = [float(hour) for hour in range(24)]
+        # 10:30 local time
+        appended = self.store.record("Oslo", document("2024-06-01", temps),
+                                     utc("2024-06-01T08:30:00"))
+        self.assertEqual(appended, 10)
+        self.assertEqual(self.store.record("Oslo", document("2024-06-01", temps),
+                                           utc("2024-06-01T09:30:00")), 1)
+
+        epochs, values = self.store.hours("Oslo", date(2024, 6, 1), date(2024, 6, 1),
+                                          ["temp"])
+        self.assertEqual(len(epochs), 11)
+        self.assertEqual(values["temp"], temps[:11])
+
+    def test_range_and_daily_aggregates(self):
+        """Days outside the range are not read, missing values are left out."""
+        self.store.record("Oslo", document("2024-06-01", [10.0, None, 14.0]),
+                          utc("2024-06-02T00:00:00"))
+        self.store.record("Oslo", document("2024-06-02", [5.0, 7.0]),
+                          utc("2024-06-03T00:00:00"))
+        self.store.record("Oslo", document("2024-06-03", [1.0]),
+                          utc("2024-06-04T00:00:00"))
+
+        epochs, summaries = self.store.days("Oslo", date(2024, 6, 1), date(2024, 6, 2),
+                                            ["temp"])
+
+        self.assertEqual(len(epochs), 2)
+        self.assertEqual(summaries["temp"], {"min": [10.0, 5.0], "max": [14.0, 7.0],
+                                             "mean": [12.0, 6.0]})
+
+    def test_columns_stay_aligned(self):
+        """New elements and unfinished appends do not shift the rows."""
+        self.store.record("Oslo", document("2024-06-01", [10.0]), utc("2024-06-02T00:00:00"))
+        # an append that died before its timestamps were written
+        with (self.store.directory("Oslo") / "temp").open("ab") as column:
+            column.write(b"\0" * 8)
+        store = HistoryStore(self.store.root, elements=("temp", "humidity", "dew"))
+
+        store.record("Oslo", document("2024-06-02", [12.0]), utc("2024-06-03T00:00:00"))
+
+        _, values = store.hours("Oslo", date(2024, 6, 1), date(2024, 6, 2), ["temp", "dew"])
+        self.assertEqual(values["temp"], [10.0, 12.0])
+        self.assertTrue(all(math.isnan(value) for value in values["dew"]))
+
+    def test_unknown_offset_is_not_recorded(self):
+        """Without a timezone offset nothing tells which hours are over."""
+        data = document("2024-06-01", [10.0])
+        del data["tzoffset"]
+        self.assertEqual(self.store.record("Oslo", data, utc("2024-06-02T00:00:00")), 0)
+        self.assertEqual(self.store.hours("Oslo", date(2024, 6, 1), date(2024, 6, 1),
+                                          ["temp"]), ([], {"temp": []}))
+
+    def test_default_root(self):
+        """Without HISTORY_DIR, history goes to the app instance folder."""
+        app = Flask(__name__)
+        store = HistoryStore()
+        with patch.dict(os.environ, {"HISTORY_DIR": ""}):
+            store.init_app(app)
+        self.assertEqual(store.root, Path(app.instance_path) / "history")
+
+    def test_parse_range(self):
+        """The last week by default, reversed and long ranges are refused."""
+        today = date(2024, 6, 10)
+        self.assertEqual(parse_range(None, None, today, 366),
+                         (date(2024, 6, 4), today))
+        for start, end in (("2024-06-05", "2024-06-01"), ("2023-01-01", None),
+                           ("June", None)):
+            with self.subTest(start=start, end=end), self.assertRaises(HistoryQueryError):
+                parse_range(start, end, today, 366)
+
+
+class TestHistoryRoute(unittest.TestCase):
+    """Test the history endpoint answers from local data."""
+
+    def setUp(self):
+        """History of Oslo in a temporary store."""
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.store = HistoryStore(self.directory.name, elements=("temp", "humidity"))
+        self.store.record("Oslo", document("2024-06-01", [10.0, None, 14.0]),
+                          utc("2024-06-02T00:00:00"))
+        patch.object(history, "root", self.store.root).start()
+        patch.object(history, "elements", self.store.elements).start()
+        self.mock_upstream = patch('weather_api.services.http_client.get').start()
+        self.app = create_app({"HISTORY_DIR": self.directory.name})
+        self.app.config['API_AUTH_ENABLED'] = False
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        """Stop all mocks and remove the store after each test."""
+        patch.stopall()
+        self.directory.cleanup()
+
+    def test_hours(self):
+        """Stored hours of the range, aliases share the history."""
+        response = self.client.get(
+            '/api/history/oslo?from=2024-06-01&to=2024-06-01&elements=temp')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {
+            "location": "Oslo", "from": "2024-06-01", "to": "2024-06-01",
+            "datetime": ["2024-06-01T00:00:00", "2024-06-01T01:00:00",
+                         "2024-06-01T02:00:00"],
+            "temp": [10.0, None, 14.0]})
+        self.mock_upstream.assert_not_called()
+
+    def test_daily(self):
+        """aggregate=day answers the min, max and mean of each day."""
+        response = self.client.get(
+            '/api/history/Oslo?from=2024-06-01&to=2024-06-02&aggregate=day')
+
+        self.assertEqual(response.json["datetime"], ["2024-06-01"])
+        self.assertEqual(response.json["humidity"], {"min": [80], "max": [80],
+                                                     "mean": [80]})
+
+    def test_fetched_forecasts_are_recorded(self):
+        """Full documents are kept, element restricted ones are not."""
+        data = document("2024-06-02", [11.0])
+        record_history(elements_query("Oslo", ["aqius"]), data, utc("2024-06-03T00:00:00"))
+        record_history(forecast_query("Oslo"), data, utc("2024-06-03T00:00:00"))
+
+        epochs, _ = self.store.hours("Oslo", date(2024, 6, 1), date(2024, 6, 2), ["temp"])
+        self.assertEqual(len(epochs), 4)
+
+    def test_bad_queries(self):
+        """Unknown elements, aggregates and dates are a 400."""
+        for query in ("elements=aqius", "aggregate=week", "from=yesterday"):
+            with self.subTest(query=query):
+                response = self.client.get(f'/api/history/Oslo?{query}')
+                self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""Unit tests for the resolution of client locations."""
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from weather_api.locations import Gazetteer, geohash_bounds, geohash_encode
+from weather_api.services import forecast_query, weather_query
+
+
+class TestGazetteer(unittest.TestCase):
+    """Test aliases and nearby coordinates share one location."""
+
+    def setUp(self):
+        """Bundled gazetteer, ~5km cells."""
+        self.gazetteer = Gazetteer(precision=5)
+
+    def test_aliases_share_a_location(self):
+        """Case, spacing, accents, translations and country all resolve alike."""
+        for text in ("London", "london", "  LONDON ", "London,UK", "london, gb",
+                     "Londres", "London, United Kingdom"):
+            with self.subTest(text=text):
+                self.assertEqual(self.gazetteer.resolve(text).name, "London")
+        self.assertEqual(self.gazetteer.resolve("Bucuresti").name, "Bucharest")
+
+    def test_less_populated_namesake_is_qualified(self):
+        """The country is kept when it is not the most populated city of its name."""
+        location = self.gazetteer.resolve("london,ca")
+        self.assertEqual(location.name, "London,CA")
+        self.assertEqual(self.gazetteer.resolve(location.name), location)
+
+    def test_unknown_names_are_tidied(self):
+        """Names missing from the gazetteer still share an entry across spellings."""
+        self.assertEqual(self.gazetteer.resolve("  sibiu ").name, "Sibiu")
+        self.assertEqual(self.gazetteer.resolve("SIBIU").name, "Sibiu")
+        self.assertIsNone(self.gazetteer.resolve("Sibiu").coordinates)
+
+    def test_coordinates_snap_to_their_cell(self):
+        """Points a few hundred meters apart share the center of their cell."""
+        near = self.gazetteer.resolve("51.5072,-0.1276")
+        other = self.gazetteer.resolve(" 51.509, -0.125 ")
+        far = self.gazetteer.resolve("51.6,-0.12")
+
+        self.assertEqual(near, other)
+        self.assertNotEqual(near, far)
+        self.assertEqual(self.gazetteer.resolve(near.name), near)
+        (south, north), (west, east) = geohash_bounds(geohash_encode(51.5072, -0.1276, 5))
+        self.assertTrue(south <= near.latitude <= north and west <= near.longitude <= east)
+
+    def test_geohash(self):
+        """Known geohash of a point."""
+        self.assertEqual(geohash_encode(57.64911, 10.40744, 11), "u4pruydqqvj")
+
+    def test_resolutions_are_cached(self):
+        """The index is built once and a name only resolved once."""
+        self.gazetteer.resolve("Paris")
+        with patch.object(self.gazetteer, "lookup") as mock_lookup:
+            self.gazetteer.resolve("Paris")
+        mock_lookup.assert_not_called()
+
+    def test_geonames_dump(self):
+        """A GeoNames cities dump can replace the bundled gazetteer."""
+        columns = ["2643743", "London", "London", "Londres,Lundúnir", "51.50853",
+                   "-0.12574", "P", "PPLC", "GB", "", "ENG", "", "", "", "8961989",
+                   "", "25", "Europe/London", "2019-09-18"]
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False,
+                                         encoding="utf-8") as dump:
+            dump.write("\t".join(columns) + "\n")
+        self.addCleanup(os.remove, dump.name)
+
+        gazetteer = Gazetteer(dump.name)
+
+        self.assertEqual(gazetteer.resolve("lundunir").coordinates, (51.50853, -0.12574))
+        self.assertIsNone(gazetteer.resolve("Paris").coordinates)
+
+
+class TestQueryKeys(unittest.TestCase):
+    """Test upstream queries are built from the resolved location."""
+
+    def test_aliases_share_cache_key(self):
+        """One cache entry and upstream call for every spelling."""
+        keys = {weather_query(city).redis_key for city in ("London", "london", "London,UK")}
+        self.assertEqual(keys, {"weather_London"})
+        self.assertEqual(forecast_query("londres").url, forecast_query("London").url)
+
+    def test_coordinates_are_passed_on(self):
+        """Providers locating by coordinates do not geocode known places."""
+        self.assertEqual(weather_query("Oslo").coordinates, (59.91273, 10.74609))
+        query = weather_query("59.9127,10.7461")
+        self.assertEqual(query.redis_key, f"weather_{query.city}")
+        self.assertEqual(query.coordinates, tuple(map(float, query.city.split(","))))
+
+
+if __name__ == '__main__':
+    unittest.main()
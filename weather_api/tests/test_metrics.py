@@ -0,0 +1,90 @@
+"""Unit tests for metrics and structured logging."""
+import json
+import logging
+import unittest
+from unittest.mock import patch
+
+import requests_mock
+from prometheus_client import REGISTRY
+
+from weather_api import create_app
+from weather_api.logs import JsonFormatter
+from weather_api.payload import CachedPayload
+from weather_api.services import BASE_URL, get_weather
+
+
+def sample(name: str, **labels) -> float:
+    """Current value of a sample, 0 when it was never recorded."""
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class TestMetrics(unittest.TestCase):
+    """Test the hot path is measured and exposed."""
+
+    def setUp(self):
+        """App without API keys, cache mocked."""
+        self.app = create_app()
+        self.app.config['API_AUTH_ENABLED'] = False
+        self.client = self.app.test_client()
+        self.mock_cache_get = patch('weather_api.services.cache.get').start()
+        patch('weather_api.services.cache.set').start()
+        patch('weather_api.services.refresher.record').start()
+
+    def tearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    def test_requests_and_cache_hits(self):
+        """Requests are timed and cache hits counted per endpoint."""
+        self.mock_cache_get.return_value = CachedPayload.from_data({"days": []})
+        requests = sample("weather_request_duration_seconds_count",
+                          endpoint="weather.city_forecast", method="GET")
+        hits = sample("weather_cache_lookups_total", endpoint="forecast", result="hit")
+
+        self.client.get('/api/forecast/Rome')
+
+        self.assertEqual(sample("weather_request_duration_seconds_count",
+                                endpoint="weather.city_forecast", method="GET"), requests + 1)
+        self.assertEqual(sample("weather_cache_lookups_total",
+                                endpoint="forecast", result="hit"), hits + 1)
+
+    @requests_mock.Mocker()
+    def test_upstream_errors_by_status(self, mock_request):
+        """Failed upstream calls are counted by status code."""
+        self.mock_cache_get.return_value = None
+        mock_request.get(f'{BASE_URL}/Nowhere/today', status_code=400, text="Bad")
+        errors = sample("weather_upstream_errors_total", endpoint="weather", status="400")
+
+        with self.app.app_context(), self.assertRaises(Exception):
+            get_weather("Nowhere")
+
+        self.assertEqual(sample("weather_upstream_errors_total",
+                                endpoint="weather", status="400"), errors + 1)
+
+    def test_metrics_endpoint(self):
+        """Metrics are served in the Prometheus text format."""
+        response = self.client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'weather_cache_duration_seconds_bucket', response.data)
+        self.assertIn(b'weather_upstream_budget_remaining_records', response.data)
+
+
+class TestJsonFormatter(unittest.TestCase):
+    """Test log records are formatted as JSON objects."""
+
+    def test_extra_fields(self):
+        """Fields passed with extra= are part of the object."""
+        record = logging.makeLogRecord({
+            "name": "weather_api.services", "levelname": "WARNING",
+            "msg": "Upstream call failed", "status": 500})
+
+        document = json.loads(JsonFormatter().format(record))
+
+        self.assertEqual(document["message"], "Upstream call failed")
+        self.assertEqual(document["level"], "WARNING")
+        self.assertEqual(document["status"], 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
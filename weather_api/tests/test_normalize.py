@@ -0,0 +1,91 @@
+"""Unit tests for forecast normalization."""
+import json
+import unittest
+from array import array
+from unittest.mock import patch
+
+from weather_api.normalize import (UnknownUnitsError, columnar,
+                                   normalize_payload, to_columns)
+from weather_api.payload import CachedPayload
+
+FORECAST = {
+    "address": "Rome",
+    "timezone": "Europe/Rome",
+    "queryCost": 1,
+    "days": [
+        {"datetime": "2025-01-01", "tempmax": 12, "tempmin": 2, "precip": 25.4,
+         "conditions": "Rain",
+         "hours": [{"datetime": "00:00:00", "temp": 10, "dew": 5, "windspeed": 10},
+                   {"datetime": "01:00:00", "temp": 0, "dew": -1.5}]},
+        {"datetime": "2025-01-02", "tempmax": 14.5, "tempmin": 4, "precip": 0,
+         "conditions": "Clear",
+         "hours": [{"datetime": "00:00:00", "temp": 100, "dew": 20, "windspeed": 0}]},
+    ],
+    "currentConditions": {"datetime": "10:00:00", "temp": 9, "visibility": 10},
+}
+
+
+class TestNormalize(unittest.TestCase):
+    """Test timeline documents are normalized and converted."""
+
+    def test_to_columns(self):
+        """Numbers go to arrays, missing numbers are NaN, the rest stays."""
+        columns = to_columns([{"temp": 1, "icon": "rain"}, {"temp": 2.5}, {"temp": 3}])
+
+        self.assertEqual(columns["temp"], array("d", [1, 2.5, 3]))
+        self.assertEqual(columns["icon"], ["rain", None, None])
+        self.assertEqual(to_columns([{"epoch": 1}, {"epoch": 2}])["epoch"].typecode, "q")
+
+    def test_hours_of_all_days_form_one_section(self):
+        """Hourly rows are flattened and keep the date they belong to."""
+        forecast = columnar(FORECAST)
+
+        self.assertEqual(forecast.location, {"address": "Rome", "timezone": "Europe/Rome"})
+        self.assertEqual(forecast.sections["hourly"]["date"],
+                         ["2025-01-01", "2025-01-01", "2025-01-02"])
+        self.assertNotIn("hours", forecast.sections["daily"])
+
+    def test_metric(self):
+        """Metric documents keep upstream values and gain derived fields."""
+        document = json.loads(normalize_payload(CachedPayload.from_data(FORECAST)).body)
+
+        self.assertEqual(document["units"]["temperature"], "C")
+        self.assertEqual(document["daily"]["temprange"], [10, 10.5])
+        self.assertEqual(document["hourly"]["temp"], [10, 0, 100])
+        self.assertEqual(document["hourly"]["windspeed"], [10, None, 0])
+        self.assertEqual(document["hourly"]["dewspread"], [5, 1.5, 80])
+        self.assertEqual(document["current"], {"datetime": "10:00:00", "temp": 9,
+                                               "visibility": 10})
+
+    def test_us_units(self):
+        """US units convert every dimension, missing values stay missing."""
+        document = json.loads(normalize_payload(
+            CachedPayload.from_data(FORECAST), "us").body)
+
+        self.assertEqual(document["units"]["speed"], "mph")
+        self.assertEqual(document["hourly"]["temp"], [50, 32, 212])
+        self.assertEqual(document["hourly"]["windspeed"], [6.21, None, 0])
+        self.assertEqual(document["daily"]["precip"], [1, 0])
+        self.assertEqual(document["daily"]["temprange"], [18, 18.9])
+        self.assertEqual(document["current"]["visibility"], 6.21)
+
+    def test_conversions_are_reused(self):
+        """The columnar form is built once, each conversion encoded once."""
+        payload = CachedPayload.from_data({**FORECAST, "address": "Milan"})
+        with patch('weather_api.normalize.columnar', wraps=columnar) as mock_columnar:
+            first = normalize_payload(payload, "uk")
+            second = normalize_payload(payload, "uk")
+            normalize_payload(payload, "us")
+
+        mock_columnar.assert_called_once()
+        self.assertIs(first, second)
+        self.assertEqual(first.created_at, payload.created_at)
+
+    def test_unknown_units(self):
+        """Only known unit systems are accepted."""
+        with self.assertRaises(UnknownUnitsError):
+            normalize_payload(CachedPayload.from_data(FORECAST), "imperial")
+
+
+if __name__ == '__main__':
+    unittest.main()
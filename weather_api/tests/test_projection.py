@@ -0,0 +1,88 @@
+"""Unit tests for elements projection."""
+import unittest
+from unittest.mock import patch
+
+from weather_api.payload import CachedPayload
+from weather_api.projection import (needs_upstream, project_document,
+                                    project_payload, today_document,
+                                    today_payload)
+
+FORECAST = {
+    "address": "Rome",
+    "timezone": "Europe/Rome",
+    "days": [
+        {"datetime": "2025-01-01", "temp": 10, "humidity": 70,
+         "hours": [{"datetime": "00:00", "temp": 8, "humidity": 75},
+                   {"datetime": "01:00", "temp": 7}]},
+        {"datetime": "2025-01-02", "temp": 11, "humidity": 60},
+    ],
+    "currentConditions": {"datetime": "10:00", "temp": 9, "humidity": 72},
+}
+
+
+class TestProjection(unittest.TestCase):
+    """Test elements are projected out of a full forecast."""
+
+    def test_project_document(self):
+        """Rows keep only the requested elements and their datetime."""
+        projected = project_document(FORECAST, ["humidity"])
+
+        self.assertEqual(projected["address"], "Rome")
+        self.assertEqual(projected["days"][0]["hours"], [
+            {"datetime": "00:00", "humidity": 75}, {"datetime": "01:00"}])
+        self.assertEqual(projected["days"][1],
+                         {"datetime": "2025-01-02", "humidity": 60})
+        self.assertEqual(projected["currentConditions"],
+                         {"datetime": "10:00", "humidity": 72})
+
+    def test_unknown_elements_are_left_out(self):
+        """Elements no row has do not show up as empty fields."""
+        projected = project_document(FORECAST, ["snow"])
+        self.assertEqual(projected["days"][1], {"datetime": "2025-01-02"})
+
+    def test_projection_is_reused(self):
+        """The same forecast and elements are only projected once."""
+        payload = CachedPayload.from_data(FORECAST)
+        with patch('weather_api.projection.project_document',
+                   wraps=project_document) as mock_project:
+            first = project_payload(payload, ["temp"])
+            second = project_payload(payload, ["temp"])
+
+        mock_project.assert_called_once()
+        self.assertIs(first, second)
+        self.assertEqual(first.created_at, payload.created_at)
+
+    def test_needs_upstream(self):
+        """Only on request elements need their own upstream call."""
+        self.assertFalse(needs_upstream(["temp", "humidity"]))
+        self.assertTrue(needs_upstream(["temp", "aqius"]))
+
+
+class TestTodayProjection(unittest.TestCase):
+    """Test today's weather is taken out of a forecast timeline."""
+
+    def test_today_document(self):
+        """The first day and the current conditions are kept."""
+        today = today_document(FORECAST)
+
+        self.assertEqual([day["datetime"] for day in today["days"]], ["2025-01-01"])
+        self.assertEqual(today["currentConditions"], FORECAST["currentConditions"])
+        self.assertIsNone(today_document({**FORECAST, "currentConditions": None}))
+
+    def test_today_payload(self):
+        """Derived once per timeline, with an ETag of its own."""
+        payload = CachedPayload.from_data(FORECAST)
+        with patch('weather_api.projection.today_document',
+                   wraps=today_document) as mock_today:
+            first = today_payload(payload)
+            second = today_payload(payload)
+            self.assertIsNone(today_payload(CachedPayload.from_data({"days": []})))
+
+        self.assertEqual(mock_today.call_count, 2)
+        self.assertIs(first, second)
+        self.assertNotEqual(first.etag, payload.etag)
+        self.assertTrue(today_payload(payload.as_stale()).stale)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+"""Unit tests for the weather providers and hedged upstream calls."""
+import asyncio
+import unittest
+
+import fakeredis
+
+from weather_api import metrics
+from weather_api.breaker import AsyncCircuitBreaker, CircuitBreaker
+from weather_api.providers import (AsyncProviderRouter, LatencyTracker,
+                                   OpenMeteo, Provider, ProviderRouter,
+                                   StubProvider, providers_from_names)
+from weather_api.services import elements_query, forecast_query, weather_query
+
+
+def hedged(provider: str) -> float:
+    """Queries hedged so far because `provider` was slow."""
+    return metrics.HEDGED_REQUESTS.labels(provider)._value.get()  # pylint: disable=protected-access
+
+
+class TestProviderRouter(unittest.TestCase):
+    """Test queries go to the fastest provider and are hedged when it is slow."""
+
+    def setUp(self):
+        """Breakers on a fake redis, hedging after 50ms."""
+        self.breaker = CircuitBreaker(fakeredis.FakeRedis(), min_calls=2)
+        self.tracker = LatencyTracker(min_samples=2)
+
+    def router(self, *providers) -> ProviderRouter:
+        """Router over `providers`, preferred first."""
+        return ProviderRouter(list(providers), self.breaker, self.tracker,
+                              hedge_delay=0.05, workers=4)
+
+    def test_slow_primary_is_hedged(self):
+        """The secondary is asked once the primary took too long, and wins."""
+        slow, fast = StubProvider("slow", latency=0.5), StubProvider("fast")
+        before = hedged("slow")
+
+        answer = self.router(slow, fast).fetch(None, weather_query("Oslo"), 10)
+
+        self.assertIs(answer.provider, fast)
+        self.assertEqual(answer.called, (slow, fast))
+        self.assertEqual(answer.response.json()["address"], "Oslo")
+        self.assertEqual(hedged("slow"), before + 1)
+
+    def test_fast_primary_is_not_hedged(self):
+        """A primary answering in time is the only one called."""
+        primary, secondary = StubProvider("primary"), StubProvider("secondary")
+
+        answer = self.router(primary, secondary).fetch(None, weather_query("Oslo"), 10)
+
+        self.assertIs(answer.provider, primary)
+        self.assertEqual(answer.called, (primary,))
+
+    def test_failing_primary_fails_over(self):
+        """A primary failing fast does not wait for the hedge delay."""
+        failing, backup = StubProvider("failing", status=503), StubProvider("backup")
+        router = self.router(failing, backup)
+        router.hedge_delay_default = 5
+
+        answer = router.fetch(None, forecast_query("Oslo"), 10)
+
+        self.assertIs(answer.provider, backup)
+        self.assertEqual(len(answer.response.json()["days"]), 15)
+
+    def test_open_breaker_skips_provider(self):
+        """Once its breaker opened, a failing provider is not called."""
+        failing, backup = StubProvider("failing", status=503), StubProvider("backup")
+        router = self.router(failing, backup)
+        for _ in range(2):
+            router.fetch(None, weather_query("Oslo"), 10)
+
+        answer = router.fetch(None, weather_query("Oslo"), 10)
+
+        self.assertEqual(answer.called, (backup,))
+
+    def test_ranked_by_latency(self):
+        """Providers with a known better latency are asked first."""
+        first, second = StubProvider("first"), StubProvider("second")
+        for seconds in (0.3, 0.4):
+            self.tracker.observe("first", seconds)
+        for seconds in (0.1, 0.2):
+            self.tracker.observe("second", seconds)
+
+        self.assertEqual(self.router(first, second).ranked(weather_query("Oslo")),
+                         [second, first])
+
+    def test_unsupported_queries_skip_provider(self):
+        """Only the timeline API knows on request elements."""
+        stub, open_meteo = StubProvider(), OpenMeteo()
+        router = self.router(open_meteo, stub)
+
+        self.assertEqual(router.ranked(elements_query("Oslo", ["aqius"])), [stub])
+
+    def test_unknown_provider_name(self):
+        """Configuration typos are caught at startup."""
+        self.assertEqual([provider.name for provider in
+                          providers_from_names("openmeteo, stub")], ["openmeteo", "stub"])
+        with self.assertRaises(ValueError):
+            providers_from_names("visualcrossing,metoffice")
+
+
+class TestAsyncProviderRouter(unittest.IsolatedAsyncioTestCase):
+    """Test the asyncio router hedges like the sync one."""
+
+    async def test_slow_primary_is_hedged(self):
+        """The secondary wins, the losing call completes in the background."""
+        slow, fast = StubProvider("slow", latency=0.2), StubProvider("fast")
+        router = AsyncProviderRouter([slow, fast], AsyncCircuitBreaker(
+            fakeredis.FakeAsyncRedis()), LatencyTracker(min_samples=2), hedge_delay=0.05)
+
+        answer = await router.fetch(None, weather_query("Oslo"), 10)
+
+        self.assertIs(answer.provider, fast)
+        self.assertEqual(answer.response.json()["address"], "Oslo")
+        await asyncio.sleep(0.3)
+        self.assertEqual(len(router.tracker._calls["slow"]), 1)  # pylint: disable=protected-access
+
+
+class TestOpenMeteo(unittest.TestCase):
+    """Test Open-Meteo documents are normalized to the timeline schema."""
+
+    def test_normalize(self):
+        """Daily, hourly and current values land where the timeline has them."""
+        provider = OpenMeteo()
+        provider.remember_location("Bergen", {"results": [{
+            "name": "Bergen", "country": "Norway", "latitude": 60.39, "longitude": 5.32}]})
+        data = {
+            "latitude": 60.39, "longitude": 5.32, "timezone": "Europe/Oslo",
+            "utc_offset_seconds": 7200,
+            "daily": {"time": ["2024-06-01"], "temperature_2m_max": [18.2],
+                      "temperature_2m_min": [9.1], "weather_code": [3],
+                      "sunrise": ["2024-06-01T03:58"]},
+            "hourly": {"time": ["2024-06-01T00:00", "2024-06-01T01:00"],
+                       "temperature_2m": [10.1, 9.8], "visibility": [24140, None]},
+            "current": {"time": "2024-06-01T12:15", "temperature_2m": 16.4,
+                        "weather_code": 0},
+        }
+
+        document = provider.normalize(data, weather_query("Bergen"))
+
+        self.assertEqual(document["resolvedAddress"], "Bergen, Norway")
+        self.assertEqual(document["tzoffset"], 2)
+        day = document["days"][0]
+        self.assertEqual((day["tempmax"], day["tempmin"]), (18.2, 9.1))
+        self.assertEqual((day["conditions"], day["icon"]), ("Overcast", "cloudy"))
+        self.assertEqual(day["sunrise"], "03:58:00")
+        self.assertEqual(day["hours"][0], {"datetime": "00:00:00", "temp": 10.1,
+                                           "visibility": 24.1})
+        self.assertNotIn("visibility", day["hours"][1])
+        self.assertEqual(document["currentConditions"],
+                         {"datetime": "12:15:00", "temp": 16.4, "conditions": "Clear",
+                          "icon": "clear-day"})
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestProvider(unittest.TestCase):
+    """Test the provider interface."""
+
+    def test_incomplete_provider_is_rejected(self):
+        """A provider without both fetch variants cannot be built."""
+        class SyncOnly(Provider):  # pylint: disable=abstract-method
+            """Provider missing the asyncio fetch."""
+            def fetch(self, client, query, timeout):
+                return None
+
+        with self.assertRaises(TypeError):
+            SyncOnly()  # pylint: disable=abstract-class-instantiated
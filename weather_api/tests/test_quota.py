@@ -0,0 +1,143 @@
+"""Unit tests for the upstream records budget."""
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import fakeredis
+
+from weather_api import create_app
+from weather_api.quota import Priority, QuotaExceededError, UpstreamBudget
+from weather_api.payload import CachedPayload
+from weather_api.services import (FORECAST_HARD_TTL, fetch_query,
+                                  forecast_query, get_forecast)
+
+
+class TestUpstreamBudget(unittest.TestCase):
+    """Test records are taken from the shared bucket and daily budget."""
+
+    def setUp(self):
+        """Budget of 100 records a day, 20 at once, no waiting."""
+        self.redis = fakeredis.FakeRedis()
+        self.budget = UpstreamBudget(self.redis, daily_records=100, burst=20,
+                                     wait_timeout=0)
+
+    def test_take_within_budget(self):
+        """Records are counted for the day and taken from the bucket."""
+        self.budget.take(5)
+        self.budget.take(3, Priority.BACKGROUND)
+
+        stats = self.budget.stats()
+        self.assertEqual(stats["spent"], 8)
+        self.assertEqual(stats["remaining"], 92)
+        self.assertAlmostEqual(stats["burst_remaining"], 12, places=1)
+
+    def test_low_priority_leaves_a_reserve(self):
+        """When the bucket runs low only interactive calls go through."""
+        self.budget.take(14)
+        with self.assertRaises(QuotaExceededError):
+            self.budget.take(2, Priority.BACKGROUND)
+        self.budget.take(2, Priority.BATCH)
+        with self.assertRaises(QuotaExceededError):
+            self.budget.take(3, Priority.BATCH)
+        self.budget.take(3)
+
+    def test_daily_budget_is_enforced(self):
+        """Once spent, the budget is back the next day."""
+        other = UpstreamBudget(self.redis, daily_records=100, burst=1000,
+                               wait_timeout=5)
+        other.take(100)
+        with self.assertRaises(QuotaExceededError) as error:
+            other.take(1)
+        self.assertGreater(error.exception.retry_after, 0)
+        self.assertLessEqual(error.exception.retry_after, 86401)
+
+    def test_calls_bigger_than_the_bucket(self):
+        """A call costing more than the burst goes through a full bucket."""
+        self.budget.take(30)
+        with self.assertRaises(QuotaExceededError):
+            self.budget.take(1)
+
+    def test_settle_gives_records_back(self):
+        """Unbilled records go back to the budget."""
+        self.budget.take(15)
+        self.budget.settle(-15)
+        self.assertEqual(self.budget.refresh_stats()["spent"], 0)
+
+    def test_saved_calls_are_counted_once(self):
+        """Workers serving the same shared document count it once."""
+        other = UpstreamBudget(self.redis, daily_records=100)
+
+        self.assertTrue(self.budget.record_saved("weather:abc", 1))
+        self.assertFalse(other.record_saved("weather:abc", 1))
+        self.assertTrue(other.record_saved("elements:def", 15))
+        self.assertEqual(self.budget.refresh_stats()["saved"], {"calls": 2, "records": 16})
+
+    def test_disabled_budget(self):
+        """A budget of 0 records never limits nor reaches Redis."""
+        redis = MagicMock()
+        UpstreamBudget(redis, daily_records=0).take(1000)
+        redis.eval.assert_not_called()
+
+
+class TestBudgetedFetch(unittest.TestCase):
+    """Test upstream calls are charged to the budget."""
+
+    def setUp(self):
+        """Mock the cache, upstream and the budget."""
+        patch('weather_api.services.cache.get', return_value=None).start()
+        patch('weather_api.services.cache.set').start()
+        self.mock_take = patch('weather_api.services.upstream_budget.take').start()
+        self.mock_settle = patch('weather_api.services.upstream_budget.settle').start()
+        self.mock_upstream = patch('weather_api.services.http_client.get').start()
+
+    def tearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    def test_billed_records_are_settled(self):
+        """The estimate is corrected with the cost upstream reports."""
+        self.mock_upstream.return_value.ok = True
+        self.mock_upstream.return_value.json.return_value = {"queryCost": 16}
+
+        fetch_query(forecast_query("Rome"))
+
+        self.mock_take.assert_called_once_with(15, Priority.INTERACTIVE)
+        self.mock_settle.assert_called_once_with(1)
+
+    def test_failed_calls_are_refunded(self):
+        """Unsuccessful upstream responses are not billed."""
+        self.mock_upstream.return_value.ok = False
+        self.mock_upstream.return_value.status_code = 500
+        fetch_query(forecast_query("Rome"))
+        self.mock_settle.assert_called_once_with(-15)
+
+    def test_exhausted_budget_is_a_503(self):
+        """Clients are told when to come back, upstream is not called."""
+        self.mock_take.side_effect = QuotaExceededError("spent", retry_after=30)
+        app = create_app()
+        app.config['API_AUTH_ENABLED'] = False
+        client = app.test_client()
+
+        response = client.get('/api/forecast/Rome')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "30")
+        self.mock_upstream.assert_not_called()
+
+
+    def test_exhausted_budget_serves_expired_entry(self):
+        """An entry kept past its hard TTL is served, marked as stale."""
+        self.mock_take.side_effect = QuotaExceededError("spent", retry_after=30)
+        expired = CachedPayload.from_data(
+            {"days": []}, created_at=time.time() - FORECAST_HARD_TTL - 60)
+
+        with patch('weather_api.services.cache.get', return_value=expired):
+            response = get_forecast("Rome")
+
+        self.assertTrue(response.payload.stale)
+        self.assertEqual(response.json(), {"days": []})
+        self.mock_upstream.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
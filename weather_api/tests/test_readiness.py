@@ -0,0 +1,107 @@
+"""Unit tests for lazy startup and the readiness probe."""
+import json
+import os
+import subprocess
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+import fakeredis
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from weather_api import create_app, services
+from weather_api.extensions import cache
+from weather_api.lazy import LazyClient
+from weather_api.tiered_cache import TieredRedisCache
+
+# Creates the app in a fresh interpreter, without any setting
+STARTUP = """
+import json
+from weather_api import create_app, extensions
+app = create_app()
+print(json.dumps({"redis": extensions.redis.created,
+                  "async_redis": extensions.async_redis.created,
+                  "seconds": app.config["STARTUP_SECONDS"]}))
+"""
+
+
+class TestLazyStartup(unittest.TestCase):
+    """Test importing and creating the app opens no connection."""
+
+    def test_no_client_created(self):
+        """The app is created without Redis, its URL or the API key."""
+        env = {name: value for name, value in os.environ.items()
+               if name not in ("REDIS_URL", "WEATHER_API_KEY")}
+        output = subprocess.run([sys.executable, "-c", STARTUP], env=env, check=True,
+                                capture_output=True, text=True, timeout=60).stdout
+
+        started = json.loads(output.splitlines()[-1])
+        self.assertFalse(started["redis"])
+        self.assertFalse(started["async_redis"])
+        self.assertGreater(started["seconds"], 0)
+
+    def test_lazy_client(self):
+        """The client is built once, on first use."""
+        factory = MagicMock()
+        client = LazyClient(factory, "redis")
+        factory.assert_not_called()
+
+        client.ping()
+        client.get("key")
+
+        factory.assert_called_once_with()
+        self.assertTrue(client.created)
+        with self.assertRaises(AttributeError):
+            _ = client._pool  # pylint: disable=protected-access
+
+    def test_api_key_read_on_use(self):
+        """The API key set after import is the one sent upstream."""
+        with patch.dict(os.environ, {"WEATHER_API_KEY": "late-key"}):
+            self.assertEqual(services.API_KEY, "late-key")
+            self.assertEqual(services.weather_query("Oslo").params["key"], "late-key")
+
+    def test_config_overrides(self):
+        """Settings passed to the factory win over the defaults."""
+        app = create_app({"CACHE_L1_MAX_TTL": 5, "STARTUP_BUDGET": 0})
+
+        with app.app_context():
+            self.assertEqual(cache.cache.local.max_ttl, 5)
+        self.assertIn("STARTUP_SECONDS", app.config)
+
+
+class TestReadiness(unittest.TestCase):
+    """Test /ready opens the connections of the worker."""
+
+    def setUp(self):
+        """App with Redis on a fake server."""
+        self.app = create_app()
+        self.client = self.app.test_client()
+        self.redis = fakeredis.FakeRedis()
+        patch('weather_api.readiness.redis', self.redis).start()
+        self.mock_cache_ping = patch.object(TieredRedisCache, 'ping').start()
+
+    def tearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    def test_ready(self):
+        """Every step is timed, no API key is needed."""
+        response = self.client.get('/ready')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json["warmup_seconds"]),
+                         {"redis", "cache", "upstream", "gazetteer"})
+        self.assertEqual(response.json["startup_seconds"], self.app.config["STARTUP_SECONDS"])
+        self.mock_cache_ping.assert_called_once_with()
+
+    def test_redis_unreachable(self):
+        """Workers without Redis are not sent traffic."""
+        with patch.object(self.redis, 'ping', side_effect=RedisConnectionError("refused")):
+            response = self.client.get('/ready')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json["status"], "unavailable")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,260 @@
+"""Unit tests for background refresh and pre-warming."""
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import fakeredis
+from flask import Flask
+
+from weather_api import create_app
+from weather_api.extensions import refresh_queue
+from weather_api.payload import CachedPayload
+from weather_api.quota import QuotaExceededError
+from weather_api.refresh import Refresher
+from weather_api.refresh_queue import RefreshQueue
+from weather_api.services import (FORECAST_SOFT_TTL, forecast_query,
+                                  get_forecast, prewarm_popular,
+                                  refresh_popular)
+
+
+class TestRefresher(unittest.TestCase):
+    """Test the refresher runs work once and tracks popularity."""
+
+    def setUp(self):
+        """Refresher backed by a fake redis."""
+        self.redis = fakeredis.FakeRedis()
+        self.refresher = Refresher(self.redis, workers=2, interval=3600, top_n=2)
+
+    def test_refresh_is_deduplicated(self):
+        """A key already refreshing is not scheduled again."""
+        release = threading.Event()
+        fetch = MagicMock(side_effect=lambda: release.wait(2))
+
+        self.assertTrue(self.refresher.refresh("London", fetch))
+        self.assertFalse(self.refresher.refresh("London", fetch))
+        release.set()
+        self.refresher._executor.shutdown(wait=True)  # pylint: disable=protected-access
+
+        fetch.assert_called_once()
+
+    def test_failed_refresh_can_be_retried(self):
+        """Errors are logged and release the key."""
+        fetch = MagicMock(side_effect=ValueError("boom"))
+        self.refresher.refresh("Paris", fetch)
+        self.refresher._executor.shutdown(wait=True)  # pylint: disable=protected-access
+        self.assertEqual(self.refresher._pending, set())  # pylint: disable=protected-access
+
+    def test_popular_members(self):
+        """Request counts are shared through redis, most popular first."""
+        for member in ["forecast:Rome"] * 3 + ["weather:Oslo"] * 5 + ["forecast:Sofia"]:
+            self.refresher.record(member)
+        self.refresher.flush_counts()
+
+        self.assertEqual(self.refresher.popular(), ["weather:Oslo", "forecast:Rome"])
+
+    def test_one_prewarm_pass_per_interval(self):
+        """Only the first process in an interval pre-warms."""
+        prewarm = MagicMock()
+        self.refresher.init_app(None, prewarm=prewarm)
+        other = Refresher(self.redis, interval=3600)
+        other.init_app(None, prewarm=prewarm)
+
+        self.refresher.record("forecast:Rome")
+        self.refresher.run_once()
+        other.run_once()
+
+        prewarm.assert_called_once_with(["forecast:Rome"])
+
+    def test_counts_decay(self):
+        """Counts halve every half life, old favourites fall behind."""
+        self.refresher.half_life = 60
+        for member in ["forecast:Rome"] * 4 + ["weather:Oslo"] * 3:
+            self.refresher.record(member)
+        self.refresher.flush_counts()
+        self.refresher.decay(now=1000)
+        self.refresher.decay(now=1060)
+
+        self.assertEqual(self.redis.zscore("refresh:popular", "forecast:Rome"), 2.0)
+        self.refresher.record("weather:Oslo")
+        self.refresher.flush_counts()
+        self.assertEqual(self.refresher.popular(), ["weather:Oslo", "forecast:Rome"])
+
+
+class TestRefreshQueue(unittest.TestCase):
+    """Test refresh jobs are run by popularity."""
+
+    def setUp(self):
+        """Queue backed by a fake redis, with request counts."""
+        self.redis = fakeredis.FakeRedis()
+        self.redis.zadd("refresh:popular", {"forecast:Rome": 5, "weather:Oslo": 9})
+        self.run = MagicMock(return_value=True)
+        self.queue = RefreshQueue(self.redis, workers=0)
+        self.queue.run = self.run
+
+    def test_most_popular_first(self):
+        """Jobs are taken by request count, queued twice they run once."""
+        self.assertEqual(self.queue.push(["forecast:Rome", "weather:Oslo"], now=100), 2)
+        self.assertEqual(self.queue.push(["forecast:Rome", "weather:Sofia"]), 3)
+
+        job = self.queue.pop()
+        self.assertEqual(job, ("weather:Oslo", 9.0, 100.0))
+        while self.queue.work_once():
+            pass
+
+        self.assertEqual([call.args[0] for call in self.run.call_args_list],
+                         ["forecast:Rome", "weather:Sofia"])
+        self.assertIsNone(self.queue.pop())
+
+    def test_spent_budget_pauses_the_workers(self):
+        """A job the budget has no room for is queued back as it was."""
+        self.run.side_effect = QuotaExceededError("spent", retry_after=30)
+        self.queue.push(["forecast:Rome"], now=100)
+
+        self.assertTrue(self.queue.work_once())
+
+        self.assertEqual(self.queue.pop(), ("forecast:Rome", 5.0, 100.0))
+        self.assertGreater(self.queue._resume_at, time.monotonic())  # pylint: disable=protected-access
+
+    def test_workers(self):
+        """Started workers run the queued jobs until stopped."""
+        self.queue.poll_interval = 0.01
+        self.queue.push(["forecast:Rome", "weather:Oslo"])
+        threads = self.queue.start(2)
+        try:
+            deadline = time.monotonic() + 2
+            while self.run.call_count < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            self.queue.stop()
+
+        self.assertEqual(self.run.call_count, 2)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_web_workers_are_opt_in(self):
+        """Web processes leave the queue to refresh-worker unless told otherwise."""
+        app = Flask(__name__)
+        self.queue.init_app(app, run=self.run)
+        self.assertEqual(app.before_request_funcs, {})
+        self.assertIn("refresh-worker", app.cli.commands)
+
+    def test_one_leased_process_per_host(self):
+        """Web processes of a host take turns, only the lease holder takes jobs."""
+        other = RefreshQueue(self.redis, lease=0.2)
+        self.queue.lease = 0.2
+        with patch('weather_api.refresh_queue.os.getpid', return_value=1):
+            self.assertTrue(self.queue.holds_lease())
+        with patch('weather_api.refresh_queue.os.getpid', return_value=2):
+            self.assertFalse(other.holds_lease())
+            time.sleep(0.25)
+            self.assertTrue(other.holds_lease())
+
+    def test_default_app_drains_pushed_jobs(self):
+        """An app created with the default config runs the jobs it queues."""
+        create_app()
+        patch.object(refresh_queue, "redis", self.redis).start()
+        patch.object(refresh_queue, "run", self.run).start()
+        patch.object(refresh_queue, "poll_interval", 0.01).start()
+        self.addCleanup(refresh_queue.stop)
+        self.addCleanup(patch.stopall)
+
+        refresh_queue.push(["forecast:Rome", "weather:Oslo"])
+
+        deadline = time.monotonic() + 2
+        while self.run.call_count < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.run.call_count, 2)
+        self.assertIsNone(refresh_queue.pop())
+
+    def test_failed_job_is_dropped(self):
+        """Errors are logged, the worker moves on."""
+        self.run.side_effect = ValueError("boom")
+        self.queue.push(["forecast:Rome"])
+
+        self.assertTrue(self.queue.work_once())
+        self.assertIsNone(self.queue.pop())
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+    """Test services serve stale entries while refreshing them."""
+
+    def setUp(self):
+        """Mock the cache and the refresher."""
+        self.mock_cache_get = patch('weather_api.services.cache.get').start()
+        self.mock_refresh = patch('weather_api.services.refresher.refresh').start()
+        patch('weather_api.services.refresher.record').start()
+        self.mock_upstream = patch('weather_api.services.http_client.get').start()
+
+    def tearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    def test_fresh_entry(self):
+        """Entries within their soft TTL are served as is."""
+        self.mock_cache_get.return_value = CachedPayload.from_data({"days": []})
+        get_forecast("Madrid")
+        self.mock_refresh.assert_not_called()
+
+    def test_stale_entry_is_served_and_refreshed(self):
+        """Past the soft TTL the stale entry is served and refreshed."""
+        stale = CachedPayload(body=b'{"days":[]}', etag="x",
+                              created_at=time.time() - FORECAST_SOFT_TTL - 1)
+        self.mock_cache_get.return_value = stale
+
+        response = get_forecast("Madrid")
+
+        self.assertIs(response.payload, stale)
+        self.mock_upstream.assert_not_called()
+        self.mock_refresh.assert_called_once()
+        self.assertEqual(self.mock_refresh.call_args.args[0],
+                         forecast_query("Madrid").redis_key)
+
+    @patch('weather_api.services.refresh_queue.push')
+    @patch('weather_api.services.cache.get_many')
+    def test_prewarm_queues_stale_and_missing(self, mock_get_many, mock_push):
+        """Hot entries about to go stale, or missing, are queued for a refresh."""
+        # no forecast timeline to answer today's weather
+        self.mock_cache_get.return_value = None
+        mock_get_many.return_value = [
+            CachedPayload.from_data({"fresh": True}),
+            CachedPayload(body=b'{}', etag="x", created_at=time.time() - FORECAST_SOFT_TTL),
+            None,
+        ]
+
+        prewarm_popular(["forecast:Rome", "forecast:Oslo", "weather:Sofia",
+                         "unknown:Paris"])
+
+        mock_push.assert_called_once_with(["forecast:Oslo", "weather:Sofia"])
+        self.mock_refresh.assert_not_called()
+
+    @patch('weather_api.services.single_flight.do')
+    @patch('weather_api.services.refresh_queue.push')
+    @patch('weather_api.services.cache.get_many', return_value=[None])
+    def test_weather_served_from_timeline(self, _, mock_push, mock_do):
+        """Popular weather a fresh timeline answers is neither queued nor fetched."""
+        timeline = CachedPayload.from_data({"currentConditions": {"temp": 19.0},
+                                            "days": [{"datetime": "2025-06-01"}]})
+        self.mock_cache_get.side_effect = lambda key: (
+            timeline if key == "forecast_Rome" else None)
+
+        prewarm_popular(["weather:Rome"])
+
+        mock_push.assert_called_once_with([])
+        self.assertFalse(refresh_popular("weather:Rome"))
+        mock_do.assert_not_called()
+        self.mock_upstream.assert_not_called()
+
+    @patch('weather_api.services.single_flight.do')
+    def test_queued_refresh(self, mock_do):
+        """Entries refreshed since they were queued are skipped."""
+        self.mock_cache_get.return_value = CachedPayload.from_data({"days": []})
+        self.assertFalse(refresh_popular("forecast:Rome"))
+        self.assertFalse(refresh_popular("unknown:Rome"))
+
+        self.mock_cache_get.return_value = None
+        self.assertTrue(refresh_popular("forecast:Rome"))
+        self.assertEqual(mock_do.call_args.args[0], "forecast_Rome")
+
+
+if __name__ == '__main__':
+    unittest.main()
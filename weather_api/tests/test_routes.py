@@ -0,0 +1,323 @@
+"""Unit tests for our routes."""
+import gzip
+import json
+import time
+import unittest
+from unittest.mock import patch
+
+import brotli
+import fakeredis
+import requests_mock
+
+from weather_api import create_app
+from weather_api.extensions import cache
+from weather_api.payload import CachedPayload
+from weather_api.projection import today_etag
+from weather_api.quota import UpstreamBudget
+from weather_api.services import (BASE_URL, FORECAST_SOFT_TTL, WEATHER_SOFT_TTL,
+                                  count_saved)
+
+FORECAST = {"address": "Madrid", "days": [{"temp": 21.5}] * 100}
+
+
+class TestPayloadRoutes(unittest.TestCase):
+    """Test cached payloads are sent without re-encoding."""
+
+    def setUp(self):
+        """Set up the Flask app and test client."""
+        self.app = create_app()
+        self.app.config['TESTING'] = True
+        self.app.config['API_AUTH_ENABLED'] = False
+        self.client = self.app.test_client()
+        self.payload = CachedPayload.from_data(FORECAST)
+        self.mock_cache_get = patch(
+            'weather_api.services.cache.get', return_value=self.payload).start()
+        self.mock_cache_set = patch('weather_api.services.cache.set').start()
+
+    def tearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    def test_cache_hit_sends_stored_bytes(self):
+        """The body is the compact bytes stored in cache."""
+        # only the payload module, logging a first gazetteer load encodes too
+        with patch('weather_api.payload.json', wraps=json) as mock_json:
+            response = self.client.get('/api/forecast/Madrid')
+            mock_json.dumps.assert_not_called()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.payload.body)
+        self.assertEqual(response.headers['ETag'], f'"{self.payload.etag}"')
+        self.assertEqual(int(response.headers['Content-Length']),
+                         self.payload.content_length)
+
+    def test_gzip_variant_is_negotiated(self):
+        """Clients accepting gzip get the precompressed body."""
+        response = self.client.get('/api/forecast/Madrid',
+                                   headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.data, self.payload.gzip_body)
+        self.assertEqual(json.loads(gzip.decompress(response.data)), FORECAST)
+
+    @requests_mock.Mocker()
+    def test_cache_miss_caches_compact_payload(self, mock_request):
+        """Upstream JSON is compacted once and cached as a payload."""
+        self.mock_cache_get.return_value = None
+        mock_request.get(f'{BASE_URL}/Madrid', status_code=200,
+                         text=json.dumps(FORECAST, indent=4))
+
+        response = self.client.get('/api/forecast/Madrid')
+
+        cached = self.mock_cache_set.call_args.args[1]
+        self.assertIsInstance(cached, CachedPayload)
+        self.assertNotIn(b' ', cached.body)
+        self.assertEqual(response.data, cached.body)
+
+    def test_legacy_cache_entry(self):
+        """Entries cached as plain dicts are still served."""
+        self.mock_cache_get.return_value = {"address": "Madrid"}
+        response = self.client.get('/api/weather/Madrid')
+        self.assertEqual(response.get_json(), {"address": "Madrid"})
+
+    def test_normalized_forecast(self):
+        """The cached forecast is normalized to the requested units."""
+        response = self.client.get('/api/forecast/Madrid/normalized?units=us')
+
+        self.assertEqual(response.status_code, 200)
+        document = response.get_json()
+        self.assertEqual(document["location"], {"address": "Madrid"})
+        self.assertEqual(document["daily"]["temp"], [70.7] * 100)
+
+    def test_normalized_unknown_units(self):
+        """Unknown units are rejected before reaching the cache."""
+        response = self.client.get('/api/weather/Madrid/normalized?units=kelvin')
+
+        self.assertEqual(response.status_code, 400)
+        self.mock_cache_get.assert_not_called()
+
+
+class TestConditionalRequests(unittest.TestCase):
+    """Test validators, cache headers and compressed variants."""
+
+    def setUp(self):
+        """A forecast cached in a fake redis a minute ago."""
+        self.app = create_app()
+        self.app.config['API_AUTH_ENABLED'] = False
+        self.client = self.app.test_client()
+        redis = fakeredis.FakeRedis()
+        with self.app.app_context():
+            backend = cache.cache
+            patch.multiple(backend, _read_client=redis, _write_client=redis).start()
+            patch.object(backend, '_publish').start()
+            backend.local.clear()
+            self.payload = CachedPayload.from_data(FORECAST, created_at=time.time() - 60)
+            cache.set('forecast_Madrid', self.payload, timeout=86400)
+        patch('weather_api.services.refresher.record').start()
+        self.mock_upstream = patch('weather_api.services.http_client.get').start()
+
+    def tearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    def test_matching_etag_is_not_modified(self):
+        """A fresh entry is validated without reading its body."""
+        with patch('weather_api.services.cache.get') as mock_get:
+            response = self.client.get('/api/forecast/madrid', headers={
+                'If-None-Match': f'"{self.payload.etag}"'})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], f'"{self.payload.etag}"')
+        mock_get.assert_not_called()
+        self.mock_upstream.assert_not_called()
+
+    def test_each_coding_has_its_own_etag(self):
+        """Identity, gzip and brotli bodies are validated by different ETags."""
+        etags = {coding: self.client.get('/api/forecast/Madrid', headers={
+            'Accept-Encoding': coding}).headers['ETag'] for coding in ('identity', 'gzip', 'br')}
+        self.assertEqual(len(set(etags.values())), 3)
+
+        for coding, etag in etags.items():
+            with self.subTest(coding=coding), \
+                    patch('weather_api.services.cache.get') as mock_get:
+                response = self.client.get('/api/forecast/Madrid', headers={
+                    'Accept-Encoding': coding, 'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.headers['ETag'], etag)
+                mock_get.assert_not_called()
+
+    def test_derived_representations_are_validated(self):
+        """Projections and normalized forms have their own stable ETag."""
+        for url in ('/api/forecast-elements/Madrid?elements=temp',
+                    '/api/forecast/Madrid/normalized?units=us'):
+            with self.subTest(url=url):
+                etag = self.client.get(url).headers['ETag']
+                self.assertNotEqual(etag, f'"{self.payload.etag}"')
+                with patch('weather_api.services.cache.get') as mock_get:
+                    response = self.client.get(url, headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                mock_get.assert_not_called()
+
+    def test_changed_etag_is_sent(self):
+        """Clients holding an older version get the body."""
+        response = self.client.get('/api/forecast/Madrid',
+                                   headers={'If-None-Match': '"outdated"'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.payload.body)
+
+    def test_cache_headers_follow_the_ttl(self):
+        """Fresh for what is left of the soft TTL, then stale while revalidating."""
+        response = self.client.get('/api/forecast/Madrid')
+
+        directives = response.cache_control
+        self.assertTrue(directives.public)
+        self.assertAlmostEqual(directives.max_age, FORECAST_SOFT_TTL - 60, delta=2)
+        self.assertIn('stale-while-revalidate=', response.headers['Cache-Control'])
+        self.assertEqual(response.last_modified.timestamp(),
+                         int(self.payload.created_at))
+
+    def test_brotli_variant_is_preferred(self):
+        """Clients accepting brotli get the precompressed brotli body."""
+        response = self.client.get('/api/forecast/Madrid',
+                                   headers={'Accept-Encoding': 'gzip, br'})
+
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(response.data)), FORECAST)
+        self.assertLess(len(response.data), len(self.payload.gzip_body))
+
+
+class TestSharedTimeline(unittest.TestCase):
+    """Test today's weather is served out of the forecast timeline."""
+
+    def setUp(self):
+        """A timeline with current conditions cached in a fake redis."""
+        self.app = create_app()
+        self.app.config['API_AUTH_ENABLED'] = False
+        self.client = self.app.test_client()
+        redis = fakeredis.FakeRedis()
+        with self.app.app_context():
+            backend = cache.cache
+            patch.multiple(backend, _read_client=redis, _write_client=redis).start()
+            patch.object(backend, '_publish').start()
+            backend.local.clear()
+        self.timeline = {"address": "Madrid", "currentConditions": {"temp": 19.0},
+                         "days": [{"datetime": "2025-06-01", "temp": 21.5},
+                                  {"datetime": "2025-06-02", "temp": 23.0}]}
+        self.budget = UpstreamBudget(fakeredis.FakeRedis(), daily_records=100)
+        patch('weather_api.services.upstream_budget', self.budget).start()
+        patch('weather_api.routes.upstream_budget', self.budget).start()
+        patch('weather_api.services.refresher.record').start()
+        count_saved.cache_clear()
+
+    def tearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    def cache_timeline(self, age: float) -> CachedPayload:
+        """Cache the timeline of Madrid fetched `age` seconds ago."""
+        payload = CachedPayload.from_data(self.timeline, created_at=time.time() - age)
+        with self.app.app_context():
+            cache.set('forecast_Madrid', payload, timeout=86400)
+        return payload
+
+    @requests_mock.Mocker()
+    def test_weather_from_timeline(self, mock_request):
+        """No upstream call, the call saved is counted once."""
+        self.cache_timeline(60)
+
+        first = self.client.get('/api/weather/Madrid')
+        second = self.client.get('/api/weather/Madrid')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json["days"], self.timeline["days"][:1])
+        self.assertEqual(first.json["currentConditions"], {"temp": 19.0})
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertFalse(mock_request.called)
+        self.assertEqual(self.client.get('/api/quota').json["saved"],
+                         {"calls": 1, "records": 1})
+
+    def test_timeline_validates_weather(self):
+        """Clients holding today's weather of a timeline get a 304."""
+        payload = self.cache_timeline(60)
+        with patch('weather_api.services.cache.get') as mock_get:
+            response = self.client.get('/api/weather/Madrid', headers={
+                'If-None-Match': f'"{today_etag(payload.etag)}"'})
+
+        self.assertEqual(response.status_code, 304)
+        mock_get.assert_not_called()
+
+    @requests_mock.Mocker()
+    def test_older_timeline_is_not_shared(self, mock_request):
+        """Past the weather soft TTL, today's weather is fetched."""
+        self.cache_timeline(WEATHER_SOFT_TTL + 60)
+        mock_request.get(f'{BASE_URL}/Madrid/today', json={"days": [{"temp": 20.0}]})
+
+        response = self.client.get('/api/weather/Madrid')
+
+        self.assertEqual(response.json, {"days": [{"temp": 20.0}]})
+        self.assertEqual(self.budget.refresh_stats()["saved"], {"calls": 0, "records": 0})
+
+
+class TestBatchRoute(unittest.TestCase):
+    """Test the multi-city batch endpoint."""
+
+    def setUp(self):
+        """Set up the Flask app and test client."""
+        self.app = create_app()
+        self.app.config['TESTING'] = True
+        self.app.config['API_AUTH_ENABLED'] = False
+        self.client = self.app.test_client()
+        self.payload = CachedPayload.from_data({"address": "London"})
+        self.mock_get_many = patch('weather_api.services.cache.get_many').start()
+        patch('weather_api.services.cache.get', return_value=None).start()
+        patch('weather_api.services.cache.set').start()
+
+    def tearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    def post_batch(self, cities):
+        """Post a batch and decode its NDJSON lines by city."""
+        response = self.client.post('/api/weather/batch', json={"cities": cities})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        return {line["city"]: line for line in lines}
+
+    @requests_mock.Mocker()
+    def test_hits_misses_and_errors(self, mock_request):
+        """Hits come from one cache read, misses and failures per city."""
+        self.mock_get_many.return_value = [self.payload, None, None]
+        mock_request.get(f'{BASE_URL}/Paris/today', json={"address": "Paris"})
+        mock_request.get(f'{BASE_URL}/Nowhere/today', status_code=400,
+                         text="Bad API Request")
+
+        results = self.post_batch(["London", "Paris", "Nowhere", "London"])
+
+        self.mock_get_many.assert_called_once()
+        self.assertEqual(results["London"]["data"], {"address": "London"})
+        self.assertEqual(results["Paris"]["data"], {"address": "Paris"})
+        self.assertEqual(results["Nowhere"]["status"], "error")
+        self.assertEqual(results["Nowhere"]["code"], 400)
+        self.assertEqual(mock_request.call_count, 2)
+
+    def test_invalid_body(self):
+        """Anything but a list of city names is rejected."""
+        for body in [{}, {"cities": "London"}, {"cities": []}, ["London"],
+                     {"cities": ["London", 1]}]:
+            with self.subTest(body=body):
+                response = self.client.post('/api/weather/batch', json=body)
+                self.assertEqual(response.status_code, 400)
+
+    def test_too_many_cities(self):
+        """Batches are bounded."""
+        with patch('weather_api.routes.BATCH_MAX_CITIES', 2):
+            response = self.client.post('/api/weather/batch',
+                                        json={"cities": ["a", "b", "c"]})
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
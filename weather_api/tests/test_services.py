@@ -6,8 +6,10 @@ import requests_mock
 from requests.exceptions import HTTPError, RequestException, Timeout
 
 from weather_api import create_app
-from weather_api.services import (API_KEY, BASE_URL, get_forecast,
-                                  get_forecast_elements, get_weather)
+from weather_api.payload import CachedPayload
+from weather_api.services import (BASE_URL, api_key, get_forecast,
+                                  get_forecast_elements, get_weather,
+                                  parse_elements)
 
 # python -m unittest weather_api.tests.test_services
 
@@ -100,6 +102,19 @@ class TestGetWeather(unittest.TestCase):
         self.assertIn("weather", response.text)
         mock_set.assert_not_called()  # Ensure cache.set is not called
 
+    def test_cache_hit_decoded_on_read(self):
+        """A payload cached compressed is only decompressed when read."""
+        payload = CachedPayload.from_data({"address": "Bucharest", "days": [{"temp": 1}] * 200})
+        stored = CachedPayload(br_body=payload.br_body, etag=payload.etag,
+                               created_at=payload.created_at)
+        with patch('weather_api.services.cache.get', return_value=stored):
+            response = get_weather("Bucharest")
+
+        # pylint: disable=protected-access
+        self.assertEqual(list(response.payload._bodies), ["br"])
+        self.assertEqual(response.json()["address"], "Bucharest")
+        self.assertEqual(response.content, payload.body)
+
 
 class TestForecast(unittest.TestCase):
     """Test that get forecast feature works as expected."""
@@ -137,7 +152,7 @@ class TestForecast(unittest.TestCase):
 
     @patch('weather_api.services.cache.get')
     @patch('weather_api.services.cache.set')
-    @patch('weather_api.services.requests.get')
+    @patch('weather_api.services.http_client.get')
     def test_response_in_cache(self, mock_request_get, mock_set, mock_get):
         """If response is in cache, request.get and cache.set should not be called."""
         mock_get.return_value = {"address": "Madrid", "days": []}
@@ -204,27 +219,30 @@ class TestElements(unittest.TestCase):
         self.assertEqual(response.json()['address'], 'London')
         self.mock_cache_set.assert_called_once()
 
-    @patch('weather_api.services.requests.get')
+    @patch('weather_api.services.http_client.get')
     def test_get_forceast_calls_requests_correctly(self, mock_requests_get):
-        """Ensure requests.get is called with correct URL and parameters."""
+        """Elements are projected out of the full forecast."""
 
         mock_response = MagicMock()
         mock_response.ok = True
-        mock_response.json.return_value = {"address": "Berlin"}
+        mock_response.json.return_value = {
+            "address": "Berlin",
+            "days": [{"datetime": "2025-01-01", "humidity": 80, "wind": 10,
+                      "temp": 2, "hours": [{"datetime": "00:00", "temp": 1,
+                                            "humidity": 85}]}]
+        }
         mock_requests_get.return_value = mock_response
 
         city = "Berlin"
         elements_list = ["humidity", "wind"]
-        elements_str = "humidity,wind"
 
-        get_forecast_elements(city, elements_list)
+        response = get_forecast_elements(city, elements_list)
 
         expected_url = f"{BASE_URL}/{city}"
         expected_params = {
             "unitGroup": "metric",
-            "include": "obs,fcst",
-            "key": API_KEY,
-            "elements": elements_str
+            "include": "obs,fcst,current",
+            "key": api_key()
         }
 
         mock_requests_get.assert_called_once_with(
@@ -232,17 +250,56 @@ class TestElements(unittest.TestCase):
             params=expected_params,
             timeout=10
         )
+        self.assertEqual(response.json(), {
+            "address": "Berlin",
+            "days": [{"datetime": "2025-01-01", "humidity": 80, "wind": 10,
+                      "hours": [{"datetime": "00:00", "humidity": 85}]}]
+        })
+
+    @patch('weather_api.services.http_client.get')
+    def test_projected_elements_keep_observations(self, mock_requests_get):
+        """Hours already observed are projected as observed, like upstream sends them."""
+        mock_response = MagicMock()
+        mock_response.ok = True
+        mock_response.json.return_value = {
+            "address": "Berlin",
+            "days": [{"datetime": "2025-01-01", "temp": 2, "source": "comb",
+                      "hours": [{"datetime": "00:00", "temp": 1.4, "source": "obs"},
+                                {"datetime": "23:00", "temp": 0, "source": "fcst"}]}]
+        }
+        mock_requests_get.return_value = mock_response
+
+        response = get_forecast_elements("Berlin", ["temp", "source"])
+
+        self.assertIn("obs", mock_requests_get.call_args.kwargs["params"]["include"])
+        self.assertEqual(response.json()["days"][0]["hours"], [
+            {"datetime": "00:00", "temp": 1.4, "source": "obs"},
+            {"datetime": "23:00", "temp": 0, "source": "fcst"}])
 
-    @patch('weather_api.services.requests.get')
-    def test_elements_variations(self, mock_requests_get):
-        """Ensure requests.get is called with correct URL and parameters."""
+    @patch('weather_api.services.http_client.get')
+    def test_on_request_elements_call_upstream(self, mock_requests_get):
+        """Elements missing from a full forecast are requested upstream."""
 
         mock_response = MagicMock()
         mock_response.ok = True
-        mock_response.json.return_value = {"address": "Paris"}
+        mock_response.json.return_value = {"address": "Berlin"}
         mock_requests_get.return_value = mock_response
 
-        city = "Paris"
+        get_forecast_elements("Berlin", ["temp", "pm2p5"])
+
+        mock_requests_get.assert_called_once_with(
+            f"{BASE_URL}/Berlin",
+            params={
+                "unitGroup": "metric",
+                "include": "obs,fcst",
+                "key": api_key(),
+                "elements": "temp,pm2p5"
+            },
+            timeout=10
+        )
+
+    def test_elements_variations(self):
+        """Ensure elements arguments are parsed correctly."""
 
         test_cases = [
             # Regular multiple keys: like ?elements=humidity&elements=wind
@@ -266,25 +323,12 @@ class TestElements(unittest.TestCase):
 
         for input_list, expected_elements_str in test_cases:
             with self.subTest(input_list=input_list):
-                get_forecast_elements(city, input_list)
-
-                expected_url = f"{BASE_URL}/{city}"
-                expected_params = {
-                    "unitGroup": "metric",
-                    "include": "obs,fcst",
-                    "key": API_KEY,
-                    "elements": expected_elements_str
-                }
-                mock_requests_get.assert_called_with(
-                    expected_url,
-                    params=expected_params,
-                    timeout=10
-                )
-                mock_requests_get.reset_mock()
+                self.assertEqual(','.join(parse_elements(input_list)),
+                                 expected_elements_str)
 
     @patch('weather_api.services.cache.get')
     @patch('weather_api.services.cache.set')
-    @patch('weather_api.services.requests.get')
+    @patch('weather_api.services.http_client.get')
     def test_response_in_cache(self, mock_request_get, mock_set, mock_get):
         """If response is in cache, request.get and cache.set should not be called."""
         mock_get.return_value = {"address": "Berlin"}
@@ -300,14 +344,14 @@ class TestElements(unittest.TestCase):
         with self.assertRaises(HTTPError):
             get_forecast_elements('Madrid', ['wind'])
 
-    @patch('weather_api.services.requests.get', side_effect=Timeout)
+    @patch('weather_api.services.http_client.get', side_effect=Timeout)
     # pylint: disable=unused-argument
     def test_timeout_error_handling(self, mock_requests_get):
         """Ensure timeouts are handled gracefully."""
         with self.assertRaises(Timeout):
             get_forecast_elements("InvalidCity", ["humidity"])
 
-    @patch('weather_api.services.requests.get')
+    @patch('weather_api.services.http_client.get')
     def test_empty_elements_returns_full_forecast(self, mock_requests_get):
         """If elements is empty, the full forecast is returned from the API."""
         mock_response = MagicMock()
@@ -324,9 +368,8 @@ class TestElements(unittest.TestCase):
         expected_url = f"{BASE_URL}/{city}"
         expected_params = {
             "unitGroup": "metric",
-            "include": "obs,fcst",
-            "key": API_KEY,
-            "elements": ""
+            "include": "obs,fcst,current",
+            "key": api_key()
         }
 
         mock_requests_get.assert_called_once_with(
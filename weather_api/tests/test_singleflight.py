@@ -0,0 +1,84 @@
+"""Unit tests for single-flight coalescing."""
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+import fakeredis
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from weather_api.singleflight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Test concurrent misses result in a single fetch."""
+
+    def setUp(self):
+        """Share one fake redis between flights."""
+        self.redis = fakeredis.FakeRedis()
+        self.flight = SingleFlight(self.redis, lease_seconds=5,
+                                   wait_timeout=2, poll_interval=0.01)
+
+    def test_concurrent_callers_share_one_fetch(self):
+        """Threads missing the same key wait on the first one."""
+        release = threading.Event()
+        fetch = MagicMock(side_effect=lambda: release.wait(2) and "fresh")
+        results = []
+
+        def call():
+            results.append(self.flight.do("London_today", fetch, lambda: None))
+
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        fetch.assert_called_once()
+        self.assertEqual(results, ["fresh"] * 5)
+        self.assertEqual(self.flight.in_flight(), 0)
+        self.assertIsNone(self.redis.get(SingleFlight.lease_key("London_today")))
+
+    def test_errors_are_shared_with_waiters(self):
+        """Waiters see the leader's exception."""
+        fetch = MagicMock(side_effect=ValueError("boom"))
+        with self.assertRaises(ValueError):
+            self.flight.do("Madrid", fetch, lambda: None)
+        self.assertEqual(self.flight.in_flight(), 0)
+
+    def test_other_process_holds_the_lease(self):
+        """With the lease taken elsewhere we wait for the cache instead."""
+        self.redis.set(SingleFlight.lease_key("Paris"), "other-node")
+        loads = iter([None, None, "from cache"])
+        fetch = MagicMock()
+
+        result = self.flight.do("Paris", fetch, lambda: next(loads))
+
+        self.assertEqual(result, "from cache")
+        fetch.assert_not_called()
+
+    def test_cache_filled_before_lease_acquired(self):
+        """The leader re-checks the cache once it owns the lease."""
+        fetch = MagicMock()
+        result = self.flight.do("Rome", fetch, lambda: "from cache")
+        self.assertEqual(result, "from cache")
+        fetch.assert_not_called()
+
+    def test_wait_timeout_falls_back_to_fetch(self):
+        """A stuck lease does not block callers forever."""
+        self.redis.set(SingleFlight.lease_key("Oslo"), "other-node")
+        self.flight.wait_timeout = 0.05
+        result = self.flight.do("Oslo", lambda: "fetched", lambda: None)
+        self.assertEqual(result, "fetched")
+
+    def test_redis_down_falls_back_to_fetch(self):
+        """Lease errors never prevent serving the request."""
+        broken = MagicMock()
+        broken.set.side_effect = RedisConnectionError("down")
+        flight = SingleFlight(broken)
+        self.assertEqual(flight.do("Sofia", lambda: "fetched", lambda: None),
+                         "fetched")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""Unit tests for cache snapshots."""
+import io
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock
+
+import fakeredis
+from flask import Flask
+
+from weather_api import snapshot
+from weather_api.snapshot import SnapshotError, export_snapshot, import_snapshot
+
+
+class TestSnapshot(unittest.TestCase):
+    """Test cache entries survive a trip through a snapshot."""
+
+    def setUp(self):
+        """A cache in one Redis, a fresh Redis to load it into."""
+        self.source = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        self.target = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        self.source.set("flask_cache_weather_Oslo", b"oslo", px=60_000)
+        self.source.set("flask_cache_forecast_Oslo", b"forecast", px=5_000)
+        self.source.set("flask_cache_Oslo+aqius", b"elements")
+        self.source.set("api_key:acme", b"not cached")
+
+    def snapshot(self, batch_size: int = 2) -> io.BytesIO:
+        """Snapshot of the cache entries of the source."""
+        stream = io.BytesIO()
+        self.assertEqual(export_snapshot(self.source, stream, "flask_cache_*",
+                                         batch_size=batch_size), 3)
+        stream.seek(0)
+        return stream
+
+    def test_round_trip(self):
+        """Entries come back with what was left of their TTL."""
+        restored, skipped = import_snapshot(self.target, self.snapshot(), batch_size=2)
+
+        self.assertEqual((restored, skipped), (3, 0))
+        self.assertEqual(self.target.get("flask_cache_weather_Oslo"), b"oslo")
+        self.assertIsNone(self.target.get("api_key:acme"))
+        self.assertEqual(self.target.pttl("flask_cache_Oslo+aqius"), -1)
+        self.assertLessEqual(self.target.pttl("flask_cache_weather_Oslo"), 60_000)
+
+    def test_ttl_runs_from_snapshot_time(self):
+        """Time spent between export and import is taken off the TTLs."""
+        restored, skipped = import_snapshot(self.target, self.snapshot(),
+                                            now=time.time() + 10)
+
+        self.assertEqual((restored, skipped), (2, 1))
+        self.assertIsNone(self.target.get("flask_cache_forecast_Oslo"))
+        self.assertLessEqual(self.target.pttl("flask_cache_weather_Oslo"), 50_000)
+
+    def test_existing_entries_are_kept(self):
+        """Newer entries are not overwritten unless asked to."""
+        self.target.set("flask_cache_weather_Oslo", b"newer")
+
+        self.assertEqual(import_snapshot(self.target, self.snapshot()), (2, 1))
+        self.assertEqual(self.target.get("flask_cache_weather_Oslo"), b"newer")
+        self.assertEqual(import_snapshot(self.target, self.snapshot(), replace=True), (3, 0))
+        self.assertEqual(self.target.get("flask_cache_weather_Oslo"), b"oslo")
+
+    def test_not_a_snapshot(self):
+        """Other files are refused before anything is written."""
+        with self.assertRaises(SnapshotError):
+            import_snapshot(self.target, io.BytesIO(b"flask_cache_weather_Oslo"))
+        self.assertEqual(self.target.dbsize(), 0)
+
+    def test_cli(self):
+        """Export to a file, import it and drop the local tiers."""
+        app = Flask(__name__)
+        invalidate = MagicMock()
+        snapshot.init_app(app, self.source, "flask_cache_*", invalidate)
+        runner = app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.snap")
+
+            exported = runner.invoke(args=["cache-snapshot", "export", path])
+            self.source.flushall()
+            imported = runner.invoke(args=["cache-snapshot", "import", path])
+
+        self.assertIn("Exported 3 entries", exported.output)
+        self.assertIn("Imported 3 entries", imported.output)
+        self.assertEqual(self.source.get("flask_cache_weather_Oslo"), b"oslo")
+        invalidate.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,252 @@
+"""Unit tests for forecast change streams."""
+import copy
+import json
+import unittest
+from unittest.mock import patch
+
+from prometheus_client import REGISTRY
+
+from weather_api import create_app
+from weather_api.extensions import stream_hub
+from weather_api.payload import CachedPayload
+from weather_api.stream import StreamHub, SubscribersExceededError, json_diff
+
+
+def apply_patch(document, patch_ops):
+    """Apply the add, remove and replace operations of a JSON patch."""
+    document = copy.deepcopy(document)
+    for operation in patch_ops:
+        if operation["path"] == "":
+            document = copy.deepcopy(operation["value"])
+            continue
+        *parents, last = [token.replace("~1", "/").replace("~0", "~")
+                          for token in operation["path"].split("/")[1:]]
+        target = document
+        for token in parents:
+            target = target[int(token)] if isinstance(target, list) else target[token]
+        if isinstance(target, list):
+            index = len(target) if last == "-" else int(last)
+            if operation["op"] == "add":
+                target.insert(index, operation["value"])
+            elif operation["op"] == "remove":
+                del target[index]
+            else:
+                target[index] = operation["value"]
+        elif operation["op"] == "remove":
+            del target[last]
+        else:
+            target[last] = operation["value"]
+    return document
+
+
+def forecast(first_day: int, temp: float = 20.0) -> dict:
+    """15 days forecast starting on the `first_day` of June."""
+    return {"address": "Oslo", "days": [
+        {"datetime": f"2024-06-{day:02d}", "temp": temp,
+         "hours": [{"datetime": f"{hour:02d}:00:00", "temp": temp} for hour in range(24)]}
+        for day in range(first_day, first_day + 15)]}
+
+
+class TestJsonDiff(unittest.TestCase):
+    """Test patches only carry what changed and rebuild the new document."""
+
+    def assert_patches(self, old, new):
+        """The patch turns `old` into `new`, and is returned."""
+        patch_ops = json_diff(old, new)
+        self.assertEqual(apply_patch(old, patch_ops), new)
+        return patch_ops
+
+    def test_changed_values_only(self):
+        """A single temperature change is a single replace."""
+        old, new = forecast(1), forecast(1)
+        new["days"][3]["hours"][5]["temp"] = 22.5
+
+        self.assertEqual(self.assert_patches(old, new), [
+            {"op": "replace", "path": "/days/3/hours/5/temp", "value": 22.5}])
+
+    def test_day_rollover(self):
+        """Moving on by a day removes the first one and adds the last one."""
+        patch_ops = self.assert_patches(forecast(1), forecast(2))
+
+        self.assertEqual([(op["op"], op["path"]) for op in patch_ops],
+                         [("remove", "/days/0"), ("add", "/days/14")])
+
+    def test_objects_and_lists(self):
+        """Members added and removed, lists shrinking and growing, escaped keys."""
+        cases = [
+            ({"a": 1, "b": {"c": 2}}, {"b": {"c": 3, "d/e~": 4}}),
+            ({"values": [1, 2, 3]}, {"values": [1, 5]}),
+            ({"values": [1]}, {"values": [1, 2, 3]}),
+            ({"days": [{"datetime": "b"}, {"datetime": "a"}]},
+             {"days": [{"datetime": "a"}, {"datetime": "b"}]}),
+            ({"alerts": None}, {"alerts": [{"event": "Wind"}]}),
+            ([1], {"a": 1}),
+        ]
+        for old, new in cases:
+            with self.subTest(old=old, new=new):
+                self.assert_patches(old, new)
+        self.assertEqual(json_diff(forecast(1), forecast(1)), [])
+
+
+class TestStreamHub(unittest.TestCase):
+    """Test changes are diffed once and fanned out to every subscriber."""
+
+    def setUp(self):
+        """Hub loading forecasts out of a dict."""
+        self.forecasts = {"Oslo": CachedPayload.from_data(forecast(1))}
+        self.hub = StreamHub(interval=3600, queue_size=2)
+        self.hub.init_app(None, load=lambda city: (f"forecast_{city}", self.forecasts[city]))
+
+    def test_subscribers_share_a_patch(self):
+        """Both subscribers get the same patch, from the snapshot they got."""
+        first, snapshots = self.hub.subscribe(["Oslo"])
+        second, _ = self.hub.subscribe(["Oslo", "Oslo"])
+        snapshot = json.loads(snapshots[0].data)
+        self.assertEqual(snapshot["data"], forecast(1))
+
+        self.forecasts["Oslo"] = CachedPayload.from_data(forecast(1, temp=21.0))
+        self.hub.update("forecast_Oslo")
+
+        event = first.get(0)
+        self.assertIs(second.get(0), event)
+        patch_event = json.loads(event.data)
+        self.assertEqual(patch_event["base"], snapshot["etag"])
+        self.assertEqual(patch_event["etag"], self.forecasts["Oslo"].etag)
+        self.assertEqual(apply_patch(snapshot["data"], patch_event["patch"]),
+                         forecast(1, temp=21.0))
+
+    def test_unchanged_forecast_is_not_sent(self):
+        """Reloading the same forecast sends nothing."""
+        subscription, _ = self.hub.subscribe(["Oslo"])
+
+        self.hub.run_once()
+
+        self.assertTrue(subscription.events.empty())
+
+    def test_notify_only_watched_keys(self):
+        """Writes of forecasts nobody watches are ignored."""
+        subscription, _ = self.hub.subscribe(["Oslo"])
+        self.hub.notify("forecast_Paris")
+        self.hub.notify("forecast_Oslo")
+        self.assertEqual(self.hub._changes.qsize(), 1)  # pylint: disable=protected-access
+
+        self.hub.unsubscribe(subscription)
+        self.hub.notify("forecast_Oslo")
+        self.assertEqual(self.hub._changes.qsize(), 1)  # pylint: disable=protected-access
+
+    def test_slow_subscriber_is_dropped(self):
+        """A full queue ends the stream instead of holding the hub back."""
+        slow, _ = self.hub.subscribe(["Oslo"])
+        for temp in (21.0, 22.0, 23.0):
+            self.forecasts["Oslo"] = CachedPayload.from_data(forecast(1, temp=temp))
+            self.hub.update("forecast_Oslo")
+
+        self.assertIsNone(slow.get(0))
+        self.assertEqual(self.hub._watched, {})  # pylint: disable=protected-access
+
+    def test_subscribers_limit(self):
+        """Subscribers past the limit are refused, until one leaves."""
+        self.hub.max_subscribers = 1
+        first, _ = self.hub.subscribe(["Oslo"])
+        with self.assertRaises(SubscribersExceededError):
+            self.hub.subscribe(["Oslo"])
+
+        self.hub.unsubscribe(first)
+        with self.assertRaises(KeyError):
+            self.hub.subscribe(["Paris"])
+        second, _ = self.hub.subscribe(["Oslo"])
+        self.assertEqual(self.hub.subscribers, 1)
+        self.hub.unsubscribe(second)
+
+    def test_subscribers_gauge(self):
+        """Subscribers are counted until unsubscribed, dropped ones included."""
+        def subscribers():
+            return REGISTRY.get_sample_value("weather_stream_subscribers") or 0.0
+        before = subscribers()
+        first, _ = self.hub.subscribe(["Oslo"])
+        slow, _ = self.hub.subscribe(["Oslo"])
+        self.assertEqual(subscribers(), before + 2)
+
+        self.hub.unsubscribe(first)
+        for temp in (21.0, 22.0, 23.0):
+            self.forecasts["Oslo"] = CachedPayload.from_data(forecast(1, temp=temp))
+            self.hub.update("forecast_Oslo")
+        self.assertEqual(subscribers(), before)
+        # the stream of the dropped subscriber ends and unsubscribes again
+        self.hub.unsubscribe(slow)
+        self.hub.unsubscribe(first)
+        self.assertEqual(subscribers(), before)
+
+
+class TestStreamRoute(unittest.TestCase):
+    """Test the stream endpoint."""
+
+    def setUp(self):
+        """Forecasts served from a mocked cache."""
+        self.app = create_app()
+        self.app.config['API_AUTH_ENABLED'] = False
+        self.client = self.app.test_client()
+        self.payload = CachedPayload.from_data(forecast(1))
+        patch('weather_api.services.cache.get', return_value=self.payload).start()
+        patch('weather_api.services.refresher.record').start()
+
+    def tearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    def test_snapshot_then_patches(self):
+        """The cached forecast is sent first, then what changed."""
+        response = self.client.get('/api/stream?city=Oslo&format=ndjson', buffered=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        lines = iter(response.response)
+
+        snapshot = json.loads(next(lines))
+        self.assertEqual((snapshot["event"], snapshot["data"]), ("snapshot", forecast(1)))
+        stream_hub.publish("forecast_Oslo", CachedPayload.from_data(forecast(2)))
+        change = json.loads(next(lines))
+        self.assertEqual(apply_patch(snapshot["data"], change["patch"]), forecast(2))
+
+        response.close()
+        self.assertNotIn("forecast_Oslo", stream_hub._watched)  # pylint: disable=protected-access
+
+    def test_server_sent_events(self):
+        """Events are framed for EventSource clients by default."""
+        response = self.client.get('/api/stream?city=Oslo', buffered=False)
+
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertTrue(next(iter(response.response)).startswith(
+            f"event: snapshot\nid: {self.payload.etag}\ndata: ".encode()))
+        response.close()
+
+    def test_subscribers_limit(self):
+        """A process streaming to as many subscribers as it may answers a 503."""
+        patch.object(stream_hub, 'max_subscribers', 1).start()
+        first = self.client.get('/api/stream?city=Oslo', buffered=False)
+
+        response = self.client.get('/api/stream?city=Oslo')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response.headers)
+        first.close()
+        response = self.client.get('/api/stream?city=Oslo', buffered=False)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_error_ends_the_stream(self):
+        """An error once streaming ends the stream with an error event."""
+        patch('weather_api.stream.Subscription.get', side_effect=RuntimeError("boom")).start()
+        response = self.client.get('/api/stream?city=Oslo&format=ndjson')
+
+        events = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual([event["event"] for event in events], ["snapshot", "error"])
+        self.assertNotIn("forecast_Oslo", stream_hub._watched)  # pylint: disable=protected-access
+
+    def test_invalid_subscriptions(self):
+        """No city or an unknown format is a 400."""
+        self.assertEqual(self.client.get('/api/stream').status_code, 400)
+        self.assertEqual(self.client.get('/api/stream?city=Oslo&format=xml').status_code,
+                         400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""Unit tests for the two-tier cache backend."""
+import time
+import unittest
+from unittest.mock import patch
+
+import fakeredis
+from prometheus_client import REGISTRY
+
+from weather_api.payload import CachedPayload
+from weather_api.tiered_cache import LocalLRU, TieredRedisCache
+
+
+class TestLocalLRU(unittest.TestCase):
+    """Test the in-process tier."""
+
+    def test_evicts_least_recently_used_by_bytes(self):
+        """Entries are evicted oldest first once max_bytes is exceeded."""
+        lru = LocalLRU(max_bytes=10, max_ttl=60)
+        lru.set("a", 1, 4, 60)
+        lru.set("b", 2, 4, 60)
+        lru.get("a")
+        lru.set("c", 3, 4, 60)
+
+        self.assertEqual(lru.get("a"), 1)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.stats()["bytes"], 8)
+        self.assertEqual(lru.stats()["evictions"], 1)
+
+    def test_entries_expire(self):
+        """An entry never outlives its ttl."""
+        lru = LocalLRU(max_bytes=100, max_ttl=60)
+        lru.set("a", 1, 1, 0.01)
+        time.sleep(0.02)
+        self.assertIsNone(lru.get("a"))
+        self.assertEqual(lru.stats()["entries"], 0)
+
+    def test_oversized_values_are_not_kept(self):
+        """A value bigger than the tier is left to redis."""
+        lru = LocalLRU(max_bytes=10, max_ttl=60)
+        lru.set("a", "big", 11, 60)
+        self.assertIsNone(lru.get("a"))
+
+
+class TestTieredRedisCache(unittest.TestCase):
+    """Test the redis backend with the L1 tier in front."""
+
+    def setUp(self):
+        """Two workers sharing one fake redis."""
+        self.redis = fakeredis.FakeRedis()
+        self.cache = TieredRedisCache(host=self.redis, key_prefix="test_")
+        self.other = TieredRedisCache(host=self.redis, key_prefix="test_")
+        patch.object(TieredRedisCache, "_ensure_listener").start()
+
+    def tearDown(self):
+        """Stop all mocks after each test."""
+        patch.stopall()
+
+    def test_second_get_is_served_locally(self):
+        """Only the first read goes to redis."""
+        self.cache.set("London", {"temp": 20}, timeout=100)
+        self.other.get("London")
+        with patch.object(self.redis, "pipeline") as pipeline:
+            self.assertEqual(self.other.get("London"), {"temp": 20})
+            pipeline.assert_not_called()
+
+        stats = self.other.tier_stats()
+        self.assertEqual(stats["l1"]["hits"], 1)
+        self.assertEqual(stats["redis"]["hits"], 1)
+
+    def test_tier_metrics(self):
+        """Hits and misses of each tier are exported."""
+        def lookups(tier, result):
+            return REGISTRY.get_sample_value("weather_cache_tier_lookups_total",
+                                             {"tier": tier, "result": result}) or 0.0
+        before = {(tier, result): lookups(tier, result)
+                  for tier in ("l1", "redis") for result in ("hit", "miss")}
+        self.cache.set("Lisbon", {"temp": 25}, timeout=100)
+
+        self.other.get("Lisbon")
+        self.other.get("Lisbon")
+        self.other.get("Porto")
+
+        self.assertEqual(lookups("l1", "hit") - before["l1", "hit"], 1)
+        self.assertEqual(lookups("l1", "miss") - before["l1", "miss"], 2)
+        self.assertEqual(lookups("redis", "hit") - before["redis", "hit"], 1)
+        self.assertEqual(lookups("redis", "miss") - before["redis", "miss"], 1)
+
+    def test_local_copy_respects_redis_ttl(self):
+        """A local copy expires with the redis entry it was read from."""
+        self.redis.set("test_Paris", self.cache.serializer.dumps("x"), px=20)
+        self.assertEqual(self.cache.get("Paris"), "x")
+        time.sleep(0.03)
+        self.assertIsNone(self.cache.get("Paris"))
+
+    def test_get_many_mixes_tiers(self):
+        """Locally cached keys are not requested from redis again."""
+        self.cache.set("a", 1, timeout=100)
+        self.cache.set("b", "two", timeout=100)
+        self.cache.local.delete("b")
+        self.assertEqual(self.cache.get_many("a", "b", "c"), [1, "two", None])
+        self.assertEqual(self.cache.tier_stats()["redis"]["misses"], 1)
+
+    def test_invalidation_from_other_worker(self):
+        """A write in another worker drops our local copy."""
+        self.cache.set("Rome", "old", timeout=100)
+        self.other.set("Rome", "new", timeout=100)
+        message = f"{self.other._origin}:Rome".encode()  # pylint: disable=protected-access
+
+        self.cache.handle_invalidation(message)
+
+        self.assertEqual(self.cache.get("Rome"), "new")
+
+    def test_own_invalidations_are_ignored(self):
+        """Our own writes do not evict what we just cached."""
+        self.cache.set("Oslo", "v", timeout=100)
+        self.cache.handle_invalidation(
+            f"{self.cache._origin}:Oslo".encode())  # pylint: disable=protected-access
+        self.assertTrue(self.cache.local.peek("Oslo"))
+
+    def test_delete_clears_both_tiers(self):
+        """Deleted keys are gone locally and in redis."""
+        self.cache.set("Sofia", "v", timeout=100)
+        self.cache.delete("Sofia")
+        self.assertIsNone(self.cache.get("Sofia"))
+
+    def test_invalidation_follows_the_write(self):
+        """A worker refilling its local copy on an invalidation reads the new value."""
+        for city in ("Sofia", "Varna"):
+            self.cache.set(city, "v", timeout=100)
+            self.other.get(city)
+        seen = {}
+
+        def deliver(key):
+            # the other worker gets the message and reads right away
+            self.other.handle_invalidation(f"{self.cache._origin}:{key}".encode())  # pylint: disable=protected-access
+            seen[key] = self.other.get(key)
+
+        with patch.object(self.cache, "_publish", side_effect=deliver):
+            self.cache.delete("Sofia")
+            self.cache.delete_many("Varna")
+
+        self.assertEqual(seen, {"Sofia": None, "Varna": None})
+
+    def test_payload_validator(self):
+        """Payloads are cached with a validator other workers read alone."""
+        payload = CachedPayload.from_data({"temp": 20})
+        self.cache.set("Lima", payload, timeout=100)
+
+        self.assertEqual(self.other.get_validator("Lima"),
+                         (payload.etag, payload.created_at))
+        self.assertFalse(self.other.local.peek("Lima"))
+        self.assertIsNone(self.other.get_validator("Quito"))
+
+        self.cache.delete("Lima")
+        self.other.local.clear()
+        self.assertIsNone(self.other.get_validator("Lima"))
+
+
+if __name__ == '__main__':
+    unittest.main()
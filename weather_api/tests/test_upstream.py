@@ -0,0 +1,104 @@
+"""Unit tests for the pooled upstream client."""
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import requests_mock
+from prometheus_client import REGISTRY
+
+from weather_api.upstream import UpstreamClient
+
+
+class _OkHandler(BaseHTTPRequestHandler):
+    """Keep-alive handler answering every GET with a small json body."""
+    protocol_version = "HTTP/1.1"
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """Answer with a fixed json document."""
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # pylint: disable=redefined-builtin
+    def log_message(self, format, *args):
+        """Keep test output quiet."""
+
+
+class TestUpstreamClient(unittest.TestCase):
+    """Test the shared client reuses connections and reports it."""
+
+    def setUp(self):
+        """Start a local keep-alive server."""
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _OkHandler)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/timeline"
+        self.client = UpstreamClient(pool_maxsize=2, max_retries=0)
+
+    def tearDown(self):
+        """Stop the server and drop pooled connections."""
+        self.client.reset()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        """Sequential calls share one keep-alive connection."""
+        for _ in range(3):
+            response = self.client.get(self.url, timeout=5)
+            self.assertEqual(response.json(), {"ok": True})
+
+        stats = self.client.stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 2)
+        host = f"http://127.0.0.1:{self.server.server_port}"
+        self.assertEqual(stats["hosts"][host]["maxsize"], 2)
+        self.assertEqual(REGISTRY.get_sample_value(
+            "weather_upstream_pool_requests", {"host": host}), 3)
+        self.assertEqual(REGISTRY.get_sample_value(
+            "weather_upstream_pool_connections", {"host": host}), 1)
+
+    def test_read_timeouts_are_not_retried(self):
+        """Connection errors and error statuses are retried, slow reads are not."""
+        retry = UpstreamClient(max_retries=2).session.get_adapter(self.url).max_retries
+        self.assertEqual(retry.total, 2)
+        self.assertEqual(retry.read, 0)
+
+    def test_too_many_requests_is_not_retried(self):
+        """A 429 is returned at once, the breaker and the budget back off from it."""
+        retry = UpstreamClient(max_retries=2).session.get_adapter(self.url).max_retries
+        self.assertFalse(retry.is_retry("GET", 429, has_retry_after=True))
+        self.assertTrue(retry.is_retry("GET", 503, has_retry_after=True))
+        # the wait between retries stays bounded whatever Retry-After says
+        self.assertFalse(retry.respect_retry_after_header)
+        self.assertEqual(retry.backoff_max, 2)
+
+    def test_stats_before_first_call(self):
+        """No session is created until the first request."""
+        self.assertEqual(self.client.stats(),
+                         {"hits": 0, "misses": 0, "hosts": {}})
+
+    @requests_mock.Mocker()
+    def test_error_status_is_returned(self, mock_request):
+        """Error responses are handed back for raise_for_status."""
+        mock_request.get(self.url, status_code=503)
+        response = self.client.get(self.url, params={"key": "x"}, timeout=5)
+        self.assertEqual(response.status_code, 503)
+
+    def test_from_env(self):
+        """Pool sizing can be configured from the environment."""
+        with patch.dict("os.environ", {
+                "UPSTREAM_POOL_MAXSIZE": "50",
+                "UPSTREAM_MAX_RETRIES": "0"}):
+            client = UpstreamClient.from_env()
+        self.assertEqual(client.pool_maxsize, 50)
+        self.assertEqual(client.max_retries, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,406 @@
+"""
+Two-tier cache backend: a bounded in-process LRU in front of Redis.
+
+Hot keys are answered from worker memory without a Redis round trip or
+an unpickle. Local copies never outlive the Redis entry they were read
+from, and writes are broadcast over Redis pub/sub so other workers drop
+their stale copy.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+from flask_caching.backends.rediscache import RedisCache
+from redis.exceptions import RedisError
+
+from . import metrics
+from .codec import CacheCodec
+from .payload import CachedPayload
+
+logger = logging.getLogger(__name__)
+
+# Published instead of a key when every local copy has to go
+CLEAR_ALL = "*"
+# Channel carrying invalidation messages
+L1_CHANNEL = "weather_api:l1:invalidate"
+
+
+def validator_key(key: str) -> str:
+    """
+    Key of the (etag, created_at) validator stored next to a payload, so
+    conditional requests are answered without reading the payload.
+    """
+    return f"{key}:validator"
+
+
+class LocalLRU:  # pylint: disable=too-many-instance-attributes
+    """
+    Thread safe LRU cache bounded by the byte size of its values,
+    every entry also carries its own expiry time.
+    """
+
+    def __init__(self, max_bytes: int, max_ttl: float, metered: bool = False):
+        """
+        :param max_bytes: evict least recently used entries past this size
+        :param max_ttl: upper bound for how long an entry is kept
+        :param metered: count lookups in the L1 tier metrics
+        """
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self.metered = metered
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (value, size, expires_at)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        """
+        :returns: the cached value, None if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if self.metered:
+                    metrics.L1_HITS.inc()
+                return entry[0]
+            if entry is not None:
+                self._discard(key)
+            self.misses += 1
+            if self.metered:
+                metrics.L1_MISSES.inc()
+            return None
+
+    def peek(self, key: str) -> bool:
+        """Check a key is cached without touching LRU order or stats."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[2] > time.monotonic()
+
+    def set(self, key: str, value: Any, size: int, ttl: float) -> None:
+        """
+        Store a value for at most min(ttl, max_ttl) seconds.
+        :param size: byte size the value is accounted for
+        """
+        ttl = min(ttl, self.max_ttl)
+        if ttl <= 0 or size > self.max_bytes:
+            self.delete(key)
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, size, time.monotonic() + ttl)
+            self.size += size
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        """Drop a key if present."""
+        with self._lock:
+            self._discard(key)
+
+    def clear(self) -> None:
+        """Drop every entry."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _discard(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def stats(self) -> dict:
+        """Hit rate and occupancy of the local tier."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+
+class TieredRedisCache(RedisCache):  # pylint: disable=too-many-instance-attributes
+    """
+    Flask-Caching Redis backend with an in-process L1 tier.
+    Configured with CACHE_L1_MAX_BYTES, CACHE_L1_MAX_TTL and
+    CACHE_L1_CHANNEL on top of the regular CACHE_REDIS_* settings.
+    """
+    # compact versioned encoding instead of plain pickle
+    serializer = CacheCodec.from_env()
+
+    def __init__(self, *args, l1_max_bytes: int = 64 * 1024 * 1024,
+                 l1_max_ttl: float = 300,
+                 l1_channel: str = L1_CHANNEL, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local = LocalLRU(l1_max_bytes, l1_max_ttl, metered=True)
+        self.channel = l1_channel
+        self.redis_hits = 0
+        self.redis_misses = 0
+        # tells our own invalidation messages apart from other workers
+        self._origin = uuid.uuid4().hex
+        self._listener: Optional[threading.Thread] = None
+        self._listener_pid: Optional[int] = None
+        self._listener_lock = threading.Lock()
+        # called with every key written or dropped by any worker
+        self._change_hooks: list[Callable[[str], None]] = []
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(
+            l1_max_bytes=int(config.get("CACHE_L1_MAX_BYTES", 64 * 1024 * 1024)),
+            l1_max_ttl=float(config.get("CACHE_L1_MAX_TTL", 300)),
+            l1_channel=config.get("CACHE_L1_CHANNEL", L1_CHANNEL),
+        )
+        return super().factory(app, config, args, kwargs)
+
+    def _full_key(self, key: str) -> str:
+        return f"{self._get_prefix()}{key}"
+
+    def get(self, key: str) -> Any:
+        self._ensure_listener()
+        started = time.perf_counter()
+        value = self.local.get(key)
+        if value is not None:
+            metrics.CACHE_GET_L1.observe(time.perf_counter() - started)
+            return value
+        pipe = self._read_client.pipeline(transaction=False)
+        pipe.get(self._full_key(key))
+        pipe.pttl(self._full_key(key))
+        raw, pttl = pipe.execute()
+        value = self._remember(key, raw, pttl)
+        metrics.CACHE_GET_REDIS.observe(time.perf_counter() - started)
+        return value
+
+    def get_many(self, *keys: str) -> list:
+        self._ensure_listener()
+        with metrics.CACHE_GET_MANY.time():
+            return self._get_many(keys)
+
+    def _get_many(self, keys: tuple[str, ...]) -> list:
+        values = [self.local.get(key) for key in keys]
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if missing:
+            # one MGET plus the TTLs, in a single round trip
+            pipe = self._read_client.pipeline(transaction=False)
+            pipe.mget([self._full_key(key) for key in missing])
+            for key in missing:
+                pipe.pttl(self._full_key(key))
+            raws, *pttls = pipe.execute()
+            fetched = {key: self._remember(key, raw, pttl)
+                       for key, raw, pttl in zip(missing, raws, pttls)}
+            values = [fetched[key] if key in fetched else value
+                      for key, value in zip(keys, values)]
+        return values
+
+    def _remember(self, key: str, raw: Optional[bytes], pttl: int) -> Any:
+        """Decode a Redis reply and keep it locally for its remaining TTL."""
+        if raw is None:
+            self.redis_misses += 1
+            metrics.REDIS_MISSES.inc()
+            return None
+        self.redis_hits += 1
+        metrics.REDIS_HITS.inc()
+        value = self.serializer.loads(raw)
+        if value is not None:
+            # pttl is -1 for keys without expiry
+            ttl = pttl / 1000 if pttl >= 0 else self.local.max_ttl
+            self.local.set(key, value, len(raw), ttl)
+        return value
+
+    def get_validator(self, key: str) -> Optional[tuple[str, float]]:
+        """
+        ETag and fetch time of the payload cached under `key`, without
+        reading the payload itself.
+        :returns: None if there is none
+        """
+        self._ensure_listener()
+        name = validator_key(key)
+        value = self.local.get(name)
+        if value is None:
+            pipe = self._read_client.pipeline(transaction=False)
+            pipe.get(self._full_key(name))
+            pipe.pttl(self._full_key(name))
+            value = self._remember(name, *pipe.execute())
+        return tuple(value) if value else None
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = None) -> Any:
+        self._ensure_listener()
+        timeout = self._normalize_timeout(timeout)
+        dumps = {key: self.serializer.dumps(value)}
+        if isinstance(value, CachedPayload):
+            dumps[validator_key(key)] = self.serializer.dumps((value.etag, value.created_at))
+        with metrics.CACHE_SET.time():
+            pipe = self._write_client.pipeline(transaction=False)
+            for name, dump in dumps.items():
+                if timeout == -1:
+                    pipe.set(name=self._full_key(name), value=dump)
+                else:
+                    pipe.setex(name=self._full_key(name), value=dump, time=timeout)
+            result = pipe.execute()[0]
+        self._publish(key)
+        ttl = self.local.max_ttl if timeout == -1 else timeout
+        self.local.set(key, value, len(dumps[key]), ttl)
+        if len(dumps) > 1:
+            self.local.set(validator_key(key), (value.etag, value.created_at),
+                           len(dumps[validator_key(key)]), ttl)
+        return result
+
+    def set_many(self, mapping: dict, timeout: Optional[int] = None) -> list:
+        result = super().set_many(mapping, timeout)
+        for key in mapping:
+            self._drop_local(key)
+            self._publish(key)
+        return result
+
+    def add(self, key: str, value: Any, timeout: Optional[int] = None) -> Any:
+        created = super().add(key, value, timeout)
+        if created:
+            self._publish(key)
+        return created
+
+    def has(self, key: str) -> bool:
+        return self.local.peek(key) or super().has(key)
+
+    # invalidations are published once Redis has the change, so another
+    # worker refilling its L1 on them cannot read the old value back
+    def delete(self, key: str) -> bool:
+        deleted = super().delete(key)
+        super().delete(validator_key(key))
+        self._drop_local(key)
+        self._publish(key)
+        return deleted
+
+    def delete_many(self, *keys: str) -> list:
+        # the base class deletes one key at a time through delete()
+        pipe = self._write_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.delete(self._full_key(key))
+            pipe.delete(self._full_key(validator_key(key)))
+        deleted = [key for key, count in zip(keys, pipe.execute()[::2]) if count]
+        for key in keys:
+            self._drop_local(key)
+            self._publish(key)
+        return deleted
+
+    def clear(self) -> bool:
+        cleared = super().clear()
+        self.local.clear()
+        self._publish(CLEAR_ALL)
+        return cleared
+
+    def inc(self, key: str, delta: int = 1) -> Any:
+        value = super().inc(key, delta)
+        self.local.delete(key)
+        self._publish(key)
+        return value
+
+    def dec(self, key: str, delta: int = 1) -> Any:
+        value = super().dec(key, delta)
+        self.local.delete(key)
+        self._publish(key)
+        return value
+
+    def ping(self) -> None:
+        """
+        Open a connection of both Redis clients and start the invalidation
+        listener, instead of on the first request.
+        :raises RedisError: when Redis cannot be reached
+        """
+        self._read_client.ping()
+        self._write_client.ping()
+        self._ensure_listener()
+
+    def invalidate_local(self) -> None:
+        """Drop the local tier of every worker, Redis is left as it is."""
+        self.local.clear()
+        self._publish(CLEAR_ALL)
+
+    def tier_stats(self) -> dict:
+        """Per tier hit rates, the redis tier only sees L1 misses."""
+        lookups = self.redis_hits + self.redis_misses
+        return {
+            "l1": self.local.stats(),
+            "redis": {
+                "hits": self.redis_hits,
+                "misses": self.redis_misses,
+                "hit_rate": self.redis_hits / lookups if lookups else 0.0,
+            },
+        }
+
+    def _publish(self, key: str) -> None:
+        try:
+            self._write_client.publish(self.channel, f"{self._origin}:{key}")
+        except RedisError as redis_error:
+            # other workers fall back on the L1 max TTL
+            logger.warning("Could not publish invalidation for %s: %s",
+                           key, redis_error)
+
+    def on_change(self, hook: Callable[[str], None]) -> None:
+        """
+        Call `hook` with the keys changed by any worker, once the local
+        copy is gone. Hooks run on the listener thread and must not block.
+        """
+        self._change_hooks.append(hook)
+
+    def handle_invalidation(self, message: bytes) -> None:
+        """Drop the local copy named by an invalidation message."""
+        origin, _, key = message.decode().partition(":")
+        if origin != self._origin:
+            if key == CLEAR_ALL:
+                self.local.clear()
+            else:
+                self._drop_local(key)
+        for hook in self._change_hooks:
+            hook(key)
+
+    def _drop_local(self, key: str) -> None:
+        """Drop the local copy of a key and of its validator."""
+        self.local.delete(key)
+        self.local.delete(validator_key(key))
+
+    def _ensure_listener(self) -> None:
+        """Start the invalidation listener once per (forked) process."""
+        if self._listener_pid == os.getpid():
+            return
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            # whatever we hold may have been invalidated before the fork
+            self.local.clear()
+            self._listener_pid = os.getpid()
+            self._listener = threading.Thread(
+                target=self._listen, name="l1-invalidation", daemon=True)
+            self._listener.start()
+
+    def _listen(self) -> None:
+        delay = 1.0
+        while True:
+            try:
+                pubsub = self._read_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                delay = 1.0
+                for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self.handle_invalidation(message["data"])
+            except RedisError as redis_error:
+                logger.warning("L1 invalidation listener disconnected: %s",
+                               redis_error)
+            # anything published while disconnected is lost
+            self.local.clear()
+            time.sleep(delay)
+            delay = min(delay * 2, 30.0)
@@ -0,0 +1,223 @@
+"""
+Pooled HTTP client shared by every call to the 3rd party weather API.
+"""
+import asyncio
+import os
+import threading
+from typing import Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import metrics
+
+# Upstream statuses worth retrying, everything else is returned as is.
+# A 429 is not: retrying spends the quota it reports as exhausted, the
+# breaker and the upstream budget back off from it instead
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class UpstreamClient:  # pylint: disable=too-many-instance-attributes
+    """
+    Process-wide keep-alive client for the 3rd party weather API.
+
+    One `requests.Session` is shared by all services so connections
+    (DNS, TCP and TLS) are reused between cache misses instead of being
+    opened for every call.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 20,
+                 pool_block: bool = False, max_retries: int = 2,
+                 backoff_factor: float = 0.3, backoff_max: float = 2):
+        """
+        :param pool_connections: number of per-host pools to keep around
+        :param pool_maxsize: max keep-alive connections kept per host
+        :param pool_block: wait for a free connection instead of opening
+            a throwaway one when the host pool is exhausted
+        :param max_retries: retries for connection errors and RETRY_STATUSES,
+            read timeouts are not retried
+        :param backoff_factor: exponential backoff factor between retries
+        :param backoff_max: max seconds between two retries
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self._session: Optional[requests.Session] = None
+        self._adapter: Optional[HTTPAdapter] = None
+        self._lock = threading.Lock()
+        # sockets must never be shared between a forked worker and its parent
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self.reset)
+
+    @classmethod
+    def from_env(cls) -> "UpstreamClient":
+        """Build a client configured from UPSTREAM_* environment variables."""
+        return cls(
+            pool_connections=int(os.getenv("UPSTREAM_POOL_CONNECTIONS", "10")),
+            pool_maxsize=int(os.getenv("UPSTREAM_POOL_MAXSIZE", "20")),
+            pool_block=os.getenv("UPSTREAM_POOL_BLOCK", "false").lower() == "true",
+            max_retries=int(os.getenv("UPSTREAM_MAX_RETRIES", "2")),
+            backoff_factor=float(os.getenv("UPSTREAM_BACKOFF_FACTOR", "0.3")),
+            backoff_max=float(os.getenv("UPSTREAM_BACKOFF_MAX", "2")),
+        )
+
+    @property
+    def session(self) -> requests.Session:
+        """Lazily create the shared session on first use."""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._build_session()
+        return self._session
+
+    def _build_session(self) -> requests.Session:
+        retry = Retry(
+            total=self.max_retries,
+            # a call timing out on read would hold the worker for another
+            # read timeout per retry
+            read=0,
+            backoff_factor=self.backoff_factor,
+            backoff_max=self.backoff_max,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(["GET"]),
+            # a 503 Retry-After of minutes would hold the worker that long,
+            # the wait is bounded by backoff_max instead
+            respect_retry_after_header=False,
+            # hand the last response back so raise_for_status reports it
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            pool_block=self.pool_block,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self._adapter = adapter
+        return session
+
+    def get(self, url: str, params: Optional[dict] = None,
+            timeout: Optional[float] = None) -> requests.Response:
+        """Send a GET request through the shared connection pool."""
+        try:
+            return self.session.get(url, params=params, timeout=timeout)
+        finally:
+            self.report()
+
+    def stats(self) -> dict:
+        """
+        Connection pool usage, to help size the pool.
+        A hit is a request served on a reused keep-alive connection,
+        a miss is a request that had to open a new connection.
+        :returns: totals and a per-host breakdown
+        """
+        hosts = {}
+        if self._adapter is not None:
+            pools = self._adapter.poolmanager.pools
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                misses = pool.num_connections
+                hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                    "requests": pool.num_requests,
+                    "hits": max(pool.num_requests - misses, 0),
+                    "misses": misses,
+                    "idle": pool.pool.qsize() if pool.pool else 0,
+                    "maxsize": pool.pool.maxsize if pool.pool else 0,
+                }
+        return {
+            "hits": sum(host["hits"] for host in hosts.values()),
+            "misses": sum(host["misses"] for host in hosts.values()),
+            "hosts": hosts,
+        }
+
+    def report(self) -> None:
+        """Publish the pool usage of each host as metrics gauges."""
+        for host, usage in self.stats()["hosts"].items():
+            metrics.UPSTREAM_POOL_REQUESTS.labels(host).set(usage["requests"])
+            metrics.UPSTREAM_POOL_CONNECTIONS.labels(host).set(usage["misses"])
+            metrics.UPSTREAM_POOL_IDLE.labels(host).set(usage["idle"])
+
+    def reset(self) -> None:
+        """Drop the session and its pooled connections."""
+        session, self._session, self._adapter = self._session, None, None
+        self._lock = threading.Lock()
+        if session is not None:
+            session.close()
+
+
+class AsyncUpstreamClient:
+    """
+    Asyncio counterpart of UpstreamClient, one keep-alive pool per event
+    loop so a single process can hold many concurrent upstream waits.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, max_connections: int = 200, max_keepalive: int = 20,
+                 max_retries: int = 2, backoff_factor: float = 0.3,
+                 backoff_max: float = 2):
+        """
+        :param max_connections: max concurrent connections, all hosts
+        :param max_keepalive: max idle keep-alive connections kept
+        :param max_retries: retries for connection errors and RETRY_STATUSES
+        :param backoff_factor: exponential backoff factor between retries
+        :param backoff_max: max seconds between two retries
+        """
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @classmethod
+    def from_env(cls) -> "AsyncUpstreamClient":
+        """Build a client configured from UPSTREAM_* environment variables."""
+        return cls(
+            max_connections=int(os.getenv("UPSTREAM_ASYNC_MAX_CONNECTIONS", "200")),
+            max_keepalive=int(os.getenv("UPSTREAM_POOL_MAXSIZE", "20")),
+            max_retries=int(os.getenv("UPSTREAM_MAX_RETRIES", "2")),
+            backoff_factor=float(os.getenv("UPSTREAM_BACKOFF_FACTOR", "0.3")),
+            backoff_max=float(os.getenv("UPSTREAM_BACKOFF_MAX", "2")),
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Lazily create the pool of the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            limits = httpx.Limits(max_connections=self.max_connections,
+                                  max_keepalive_connections=self.max_keepalive)
+            # the transport retries failed connects, statuses are retried below
+            self._client = httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(
+                retries=self.max_retries, limits=limits))
+            self._loop = loop
+        return self._client
+
+    async def get(self, url: str, params: Optional[dict] = None,
+                  timeout: Optional[float] = None) -> httpx.Response:
+        """Send a GET request through the loop's connection pool."""
+        attempt = 0
+        while True:
+            response = await self.client.get(url, params=params, timeout=timeout)
+            if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                return response
+            await response.aclose()
+            await asyncio.sleep(min(self.backoff_factor * 2 ** attempt, self.backoff_max))
+            attempt += 1
+
+    async def aclose(self) -> None:
+        """Close the pool of the current event loop."""
+        client, self._client, self._loop = self._client, None, None
+        if client is not None:
+            await client.aclose()